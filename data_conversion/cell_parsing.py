@@ -0,0 +1,65 @@
+'''
+
+cell_parsing.py parses the point list and subtask answer cells of the point extract. The same
+cell values turn up again and again (e.g. [[{'None': 1}]] subtask answers, short point lists),
+so the parsed values are kept in a bounded LRU cache keyed by the raw cell string. The parsed
+values are tuples, so a cached value can't be changed by the code using it.
+
+'''
+
+from functools import lru_cache
+import ujson
+
+default_cache_size = 2**16
+
+def point_cell_marks(point_cell):
+    # the json list of a marking tool's pixel coords
+    return tuple(float(mark) for mark in ujson.loads(point_cell))
+
+def subtask_cell_answers(subtask_cell):
+    # extractor subtask lists strings are single quotes and non-valid json
+    subtask_json = ujson.loads(str(subtask_cell).replace("'", '"'))
+
+    # unpack the subtasks annotation values
+    # each point gets a subtask annotation, e.g. for 3 points
+    # the data can look like a list of subtask annotation payloads
+    # [ [{'None': 1}], [{'2': 1}], [{'2': 1}] ]
+    # [ [point 1   ]. [point 2], [ point 3]
+    # and each [point 1] can contain multiple subtask answers
+    # [{subtask_1_answer}, {subtask_2_answer}, ...]
+    # 'None' here corresponds to no subtask value for this point
+    return tuple(tuple(tuple(answer for answer in subtask_answers.keys() if answer != 'None') for subtask_answers in point_subtask_answers)
+        for point_subtask_answers in subtask_json)
+
+def configure(cache_size=default_cache_size):
+    '''
+    (Re)create the parse caches, holding up to cache_size parsed cells each.
+    '''
+    global parse_point_cell, parse_subtask_cell, reported_cache_counts
+    parse_point_cell = lru_cache(maxsize=cache_size)(point_cell_marks)
+    parse_subtask_cell = lru_cache(maxsize=cache_size)(subtask_cell_answers)
+    reported_cache_counts = {}
+
+configure()
+
+def take_cache_counts():
+    '''
+    Return a dict of the parser name to its cache (hits, misses) since the last call, for the
+    conversion worker processes to report their cache use with each chunk.
+    '''
+    global reported_cache_counts
+    cache_counts = {}
+    for name, parser in [('points', parse_point_cell), ('subtasks', parse_subtask_cell)]:
+        cache_info = parser.cache_info()
+        reported_hits, reported_misses = reported_cache_counts.get(name, (0, 0))
+        cache_counts[name] = (cache_info.hits - reported_hits, cache_info.misses - reported_misses)
+        reported_cache_counts[name] = (cache_info.hits, cache_info.misses)
+    return cache_counts
+
+def describe_cache_counts(cache_counts):
+    descriptions = []
+    for name, (hits, misses) in sorted(cache_counts.items()):
+        lookups = hits + misses
+        hit_rate = 100.0 * hits / lookups if lookups > 0 else 0
+        descriptions.append(name + ' ' + f"{hit_rate:.1f}" + '% of ' + f"{lookups:,d}")
+    return 'Parse cache hits: ' + ', '.join(descriptions)
@@ -0,0 +1,221 @@
+'''
+
+column_plan.py works out once, from the point extract headers and the workflow task labels,
+what convert_to_ibcc.py does with each extract column:
+  point       - the data.frameN.TN_toolN_x / _y pixel coords, converted to lon / lat
+  subtask     - the data.frameN.TN_toolN_details subtask answers, converted to their labels
+  metadata    - the subject geo metadata added to each row as the image_* columns
+  passthrough - the classification columns copied as they are
+and then applies that plan to the extract rows a column at a time. The plan also groups the
+x / y / subtask columns of each marking tool and frame to explode the rows to one row per mark.
+
+'''
+
+import re
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+import geo_coords
+import cell_parsing
+import subject_index
+
+# point extractor labels don't have labels on them
+# https://github.com/zooniverse/aggregation-for-caesar/issues/115
+# let's just convert them ourselves to keep the extractor outputs
+# consistently formatted as a sparse matrix for points, questions, shortcuts
+frame_header_re = re.compile(r'\Adata\.frame.+', re.IGNORECASE)
+point_header_re = re.compile(r'\Adata\.frame(\d+)\.(T\d+)_tool(\d+)_([xy])\Z', re.IGNORECASE)
+subtask_header_re = re.compile(r'\Adata\.frame(\d+)\.(T\d+)_tool(\d+)_details\Z', re.IGNORECASE)
+subtask_label_re = re.compile(r'\A(T\d+)\.tools\.(\d+)\.details\.(\d+)\.(question|answers\.(\d+)\.label)\Z', re.IGNORECASE)
+
+PointColumn = namedtuple('PointColumn', 'header output_header frame task tool label axis')
+SubtaskQuestion = namedtuple('SubtaskQuestion', 'output_header mark_header question_num answer_labels')
+SubtaskColumn = namedtuple('SubtaskColumn', 'header frame task tool questions')
+MarkTool = namedtuple('MarkTool', 'frame task tool label x_header y_header subtask_column')
+
+# the classification columns of the one row per mark output
+mark_classification_headers = ['classification_id', 'subject_id', 'user_id']
+
+# take the first line of the task label
+def format_task_label(label):
+    label_lines = label.splitlines()
+    hyphenated_label = label_lines[0].replace(" ", "-")
+    return hyphenated_label.lower()
+
+def add_data_prefix(label):
+    return "%s.%s" % ('data', label)
+
+def point_subtask_questions(task_labels_dict):
+    '''
+    Return a dict of (task, tool) to a dict of subtask question num to its question
+    label and {answer num: answer label} lookup, from the task labels.
+    '''
+    subtask_questions = {}
+    for label_key, label in task_labels_dict.items():
+        matchObj = subtask_label_re.match(label_key)
+        if matchObj:
+            task, tool, question_num = matchObj.group(1), matchObj.group(2), int(matchObj.group(3))
+            question = subtask_questions.setdefault((task, tool), {}).setdefault(question_num, {'label': None, 'answer_labels': {}})
+            if matchObj.group(5) is None:
+                question['label'] = label
+            else:
+                question['answer_labels'][matchObj.group(5)] = label
+    return subtask_questions
+
+def subtask_question_labels(point_answers, question):
+    # combine the per point annotation labels for the question, using ; delimiters
+    # here to avoid clashes with the ',' csv delim
+    # Note: only handle question subtasks right now, not marking, etc
+    point_labels = []
+    for point_subtask_answers in point_answers:
+        answers = point_subtask_answers[question.question_num] if question.question_num < len(point_subtask_answers) else ()
+        point_labels.append(';'.join(question.answer_labels[answer] for answer in answers))
+    return point_labels
+
+class ColumnPlan(object):
+    def __init__(self, extract_headers, task_labels_dict):
+        self.passthrough_headers = []
+        self.point_columns = []
+        self.subtask_columns = []
+        subtask_questions = point_subtask_questions(task_labels_dict)
+
+        for header in extract_headers:
+            point_match = point_header_re.match(header)
+            subtask_match = subtask_header_re.match(header)
+            if point_match:
+                frame, task, tool, axis = point_match.groups()
+                label = task_labels_dict["%s.tools.%s.label" % (task, tool)]
+                output_header = add_data_prefix("frame.%s.%s-%s" % (frame, format_task_label(label), axis))
+                self.point_columns.append(PointColumn(header, output_header, int(frame), task, int(tool), label, axis))
+            elif subtask_match:
+                frame, task, tool = subtask_match.groups()
+                questions = []
+                for question_num, question in sorted(subtask_questions.get((task, tool), {}).items()):
+                    question_label = question['label'] or "subtask %s" % question_num
+                    mark_header = format_task_label(question_label)
+                    output_header = add_data_prefix("frame.%s.%s" % (frame, mark_header))
+                    questions.append(SubtaskQuestion(output_header, mark_header, question_num, question['answer_labels']))
+                self.subtask_columns.append(SubtaskColumn(header, int(frame), task, int(tool), questions))
+            elif not frame_header_re.match(header):
+                # get the header columns that are't frame point tool marks
+                self.passthrough_headers.append(header)
+
+        # subject metadata headers for recording original coords
+        self.metadata_columns = [(header, "image_%s" % header) for header in subject_index.geo_fields]
+
+        # the output column ordering
+        self.output_headers = self.passthrough_headers \
+            + [point_column.output_header for point_column in self.point_columns] \
+            + [question.output_header for subtask_column in self.subtask_columns for question in subtask_column.questions] \
+            + [output_header for _, output_header in self.metadata_columns]
+
+        # the x / y and subtask columns of each marking tool in each frame
+        tool_subtask_columns = dict(((subtask_column.frame, subtask_column.task, subtask_column.tool), subtask_column) for subtask_column in self.subtask_columns)
+        tool_point_headers = {}
+        for point_column in self.point_columns:
+            tool_point_headers.setdefault((point_column.frame, point_column.task, point_column.tool, point_column.label), {})[point_column.axis] = point_column.header
+        self.mark_tools = []
+        for (frame, task, tool, label), point_headers in tool_point_headers.items():
+            if 'x' in point_headers and 'y' in point_headers:
+                self.mark_tools.append(MarkTool(frame, task, tool, label, point_headers['x'], point_headers['y'], tool_subtask_columns.get((frame, task, tool))))
+        self.mark_labels = list(dict.fromkeys(mark_tool.label for mark_tool in self.mark_tools))
+        self.mark_subtask_headers = list(dict.fromkeys(question.mark_header for subtask_column in self.subtask_columns for question in subtask_column.questions))
+        self.mark_headers = mark_classification_headers + ['tool', 'label', 'frame', 'x', 'y', 'lon', 'lat'] + self.mark_subtask_headers
+
+    def apply(self, extract_df, subjects_geo_df):
+        '''
+        Convert the extract rows to the output columns, with the subject geo metadata
+        in subjects_geo_df (indexed by subject_id).
+        '''
+        row_geo_bounds = geo_coords.subject_geo_bounds(extract_df['subject_id'], subjects_geo_df)
+        output_columns = {}
+
+        for header in self.passthrough_headers:
+            output_columns[header] = extract_df[header]
+
+        # convert the x,y to lat/long coord using subject geo metadata
+        for point_column in self.point_columns:
+            if point_column.axis == 'x':
+                coords_from_pixels = geo_coords.get_lon_coords_from_pixels
+            else:
+                coords_from_pixels = geo_coords.get_lat_coords_from_pixels
+            output_columns[point_column.output_header] = geo_coords.convert_point_column(extract_df[point_column.header], row_geo_bounds, coords_from_pixels)
+
+        # parse each subtask cell once for all its questions
+        for subtask_column in self.subtask_columns:
+            subtask_cells = extract_df[subtask_column.header]
+            cell_answers = [None if pd.isnull(subtask_value) else cell_parsing.parse_subtask_cell(subtask_value) for subtask_value in subtask_cells.values]
+            for question in subtask_column.questions:
+                question_labels = np.full(len(cell_answers), None, dtype=object)
+                for row, point_answers in enumerate(cell_answers):
+                    if point_answers is not None:
+                        question_labels[row] = subtask_question_labels(point_answers, question)
+                output_columns[question.output_header] = pd.Series(question_labels, index=extract_df.index)
+
+        for header, output_header in self.metadata_columns:
+            output_columns[output_header] = row_geo_bounds[header]
+
+        return pd.DataFrame(output_columns, index=extract_df.index, columns=self.output_headers)
+
+    def tool_marks(self, extract_df, row_geo_bounds, mark_tool):
+        # the marks of one marking tool in one frame, as columns with a value per mark
+        mark_row_positions, mark_counts, x = geo_coords.point_column_marks(extract_df[mark_tool.x_header])
+        y_row_positions, y_counts, y = geo_coords.point_column_marks(extract_df[mark_tool.y_header])
+        if not (np.array_equal(mark_row_positions, y_row_positions) and np.array_equal(mark_counts, y_counts)):
+            raise ValueError("The %s and %s columns have different numbers of marks" % (mark_tool.x_header, mark_tool.y_header))
+
+        mark_rows = np.repeat(mark_row_positions, mark_counts)
+        mark_count = len(mark_rows)
+        tool_marks = dict((header, extract_df[header].values[mark_rows]) for header in mark_classification_headers)
+        tool_marks['row_position'] = mark_rows
+        tool_marks['tool'] = np.full(mark_count, mark_tool.tool, dtype=np.int8)
+        tool_marks['label'] = np.full(mark_count, mark_tool.label, dtype=object)
+        tool_marks['frame'] = np.full(mark_count, mark_tool.frame, dtype=np.int8)
+        tool_marks['x'] = x
+        tool_marks['y'] = y
+        geo_bounds = geo_coords.mark_geo_bounds(row_geo_bounds, mark_row_positions, mark_counts)
+        tool_marks['lon'] = geo_coords.get_lon_coords_from_pixels(x, geo_bounds)
+        tool_marks['lat'] = geo_coords.get_lat_coords_from_pixels(y, geo_bounds)
+
+        # each mark's answers to the tool's subtask questions, None if it has none
+        for header in self.mark_subtask_headers:
+            tool_marks[header] = np.full(mark_count, None, dtype=object)
+        if mark_tool.subtask_column is not None:
+            subtask_cells = extract_df[mark_tool.subtask_column.header].values
+            mark_index = 0
+            for row, row_mark_count in zip(mark_row_positions, mark_counts):
+                subtask_value = subtask_cells[row]
+                if not pd.isnull(subtask_value):
+                    point_answers = cell_parsing.parse_subtask_cell(subtask_value)[:row_mark_count]
+                    for question in mark_tool.subtask_column.questions:
+                        point_labels = subtask_question_labels(point_answers, question)
+                        tool_marks[question.mark_header][mark_index:mark_index + len(point_labels)] = [label or None for label in point_labels]
+                mark_index += row_mark_count
+        return tool_marks
+
+    def apply_marks(self, extract_df, subjects_geo_df):
+        '''
+        Convert the extract rows to one row per mark, with the mark_headers columns, in the
+        extract row order. The labels are categorical and the coords float32.
+        '''
+        row_geo_bounds = geo_coords.subject_geo_bounds(extract_df['subject_id'], subjects_geo_df)
+        tools_marks = [self.tool_marks(extract_df, row_geo_bounds, mark_tool) for mark_tool in self.mark_tools]
+
+        marks = {}
+        for header in self.mark_headers + ['row_position']:
+            if len(tools_marks) > 0:
+                marks[header] = np.concatenate([tool_marks[header] for tool_marks in tools_marks])
+            else:
+                marks[header] = np.array([], dtype=object)
+        marks_df = pd.DataFrame(marks, columns=self.mark_headers + ['row_position'])
+
+        # back into the extract row order, keeping the tool order within each row
+        marks_df = marks_df.sort_values('row_position', kind='mergesort').drop('row_position', axis=1).reset_index(drop=True)
+        # the anonymous classifications have no user_id
+        marks_df['user_id'] = pd.Series([None if pd.isnull(user_id) else int(user_id) for user_id in marks_df['user_id']], dtype=object)
+        marks_df['label'] = pd.Categorical(marks_df['label'], categories=self.mark_labels)
+        for header in self.mark_subtask_headers:
+            marks_df[header] = pd.Categorical(marks_df[header])
+        for header in ['x', 'y', 'lon', 'lat']:
+            marks_df[header] = marks_df[header].astype(np.float32)
+        return marks_df
@@ -13,9 +13,17 @@ workflow_ids=($(tail -n +2 ${WORKFLOW_FILE} | cut -d',' -f1 | uniq))
 
 CONFIG_DIR="${DATA_OUT_DIR}/configs"
 mkdir -p $CONFIG_DIR
-# store the configs in outputs
-for workflow_id in "${workflow_ids[@]}"
-do
+# the number of workflows to extract and convert at once, each conversion
+# can also use CONVERT_WORKERS processes (see convert_to_ibcc.py --workers)
+WORKFLOW_JOBS=${WORKFLOW_JOBS:-1}
+LOG_DIR="${DATA_OUT_DIR}/logs"
+if [ "$WORKFLOW_JOBS" -gt 1 ]; then
+  mkdir -p $LOG_DIR
+fi
+
+# configure, extract and convert the data for a workflow, storing the configs in outputs
+process_workflow() {
+  local workflow_id=$1
   printf "\n###############-START WORKFLOW_ID:${workflow_id}-###############\n"
 
   # https://aggregation-caesar.zooniverse.org/Scripts.html#configure-the-extractors-and-reducers
@@ -55,4 +63,20 @@ do
   fi
 
   printf "###############-END WORKFLOW_ID:${workflow_id}-###############\n"
+}
+
+for workflow_id in "${workflow_ids[@]}"
+do
+  if [ "$WORKFLOW_JOBS" -gt 1 ]; then
+    # run the workflows in the background, logging each to its own file,
+    # and wait for one to finish before starting more than WORKFLOW_JOBS
+    while [ "$(jobs -rp | wc -l)" -ge "$WORKFLOW_JOBS" ]; do
+      wait -n
+    done
+    printf "Processing workflow: ${workflow_id}, see ${LOG_DIR}/workflow_${workflow_id}.log\n"
+    process_workflow $workflow_id > "${LOG_DIR}/workflow_${workflow_id}.log" 2>&1 &
+  else
+    process_workflow $workflow_id
+  fi
 done
+wait
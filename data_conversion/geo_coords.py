@@ -0,0 +1,83 @@
+'''
+
+geo_coords.py converts the pixel coords of the point extract marks to lat / lon from the
+geo metadata of their subject, all the marks in an extract column at once.
+
+'''
+
+import numpy as np
+import pandas as pd
+import subject_index
+import cell_parsing
+
+class MissingCoordinateMetadata(Exception):
+    # see tiling/convert_tiles_to_jpg.py
+    """Raised when the subject doesn't have the metadata for pixel conversion to lat/lon"""
+    pass
+
+# I am not sure why this is setup this way, to do with origin points?
+# https://github.com/zooniverse/Data-digging/blob/90677ac24681de834caceaa622f61a2fcc3cbbe1/example_scripts/planetary_response_network/caribbean_irma_2017/extract_markings_to1file.py#L564
+x_min = 1
+y_min = 1
+
+def pixels_to_coords(pixels, pixel_min, pixel_max, coord_min, coord_max):
+    # the linear map from the [pixel_min, pixel_max] image edges to the [coord_min, coord_max]
+    # subject bounds, for every mark at once (the bounds are arrays with a value per mark)
+    pixels = np.asarray(pixels, dtype=float)
+    coords = coord_min + (pixels - pixel_min) * ((coord_max - coord_min) / (pixel_max - pixel_min))
+    # don't throw an error if the coords are out of bounds, but also don't extrapolate
+    return np.where((pixels >= pixel_min) & (pixels <= pixel_max), coords, np.nan)
+
+def get_lat_coords_from_pixels(marks, geo_metadata):
+    return pixels_to_coords(marks, y_min, geo_metadata['imsize_y_pix'], geo_metadata['lat_min'], geo_metadata['lat_max'])
+
+def get_lon_coords_from_pixels(marks, geo_metadata):
+    return pixels_to_coords(marks, x_min, geo_metadata['imsize_x_pix'], geo_metadata['lon_min'], geo_metadata['lon_max'])
+
+def subject_geo_bounds(subject_ids, subjects_geo_df):
+    # join the subject geo metadata to each extract row as columns of floats
+    row_geo_bounds = subjects_geo_df.reindex(subject_ids.values)[subject_index.geo_fields]
+    row_geo_bounds.index = subject_ids.index
+    # missing data for the converstion to lat / lon
+    missing_rows = row_geo_bounds.isnull().any(axis=1).values
+    if missing_rows.any():
+        subject_id = subject_ids.values[missing_rows][0]
+        if subject_id not in subjects_geo_df.index:
+            raise MissingCoordinateMetadata("subject %s isn't in the subjects export" % subject_id)
+        missing_subject_geo = row_geo_bounds[missing_rows].iloc[0]
+        missing_headers = missing_subject_geo.index[missing_subject_geo.isnull()]
+        raise MissingCoordinateMetadata("subject %s has no %s" % (subject_id, ', '.join(missing_headers)))
+    return row_geo_bounds
+
+def point_column_marks(point_cells):
+    '''
+    Parse a column of point extract cells (json lists of pixel coords), returning the positions
+    of the rows with marks, the number of marks in each of them and all the marks in one array.
+    '''
+    mark_row_positions = np.flatnonzero(point_cells.notnull().values)
+    mark_lists = [cell_parsing.parse_point_cell(cell) for cell in point_cells.values[mark_row_positions]]
+    mark_counts = np.array([len(marks) for marks in mark_lists], dtype=int)
+    pixels = np.array([mark for marks in mark_lists for mark in marks], dtype=float)
+    return mark_row_positions, mark_counts, pixels
+
+def mark_geo_bounds(row_geo_bounds, mark_row_positions, mark_counts):
+    # repeat each row's subject bounds for each of its marks
+    mark_rows = np.repeat(mark_row_positions, mark_counts)
+    return dict((header, row_geo_bounds[header].values[mark_rows]) for header in row_geo_bounds.columns)
+
+def convert_point_column(point_cells, row_geo_bounds, coords_from_pixels):
+    '''
+    Convert a column of point extract cells (json lists of pixel coords) to lists of lat / lon
+    coords, with one transform over all the marks in the column and their row's subject bounds.
+    '''
+    converted_cells = np.full(len(point_cells), None, dtype=object)
+    mark_row_positions, mark_counts, pixels = point_column_marks(point_cells)
+    if len(mark_row_positions) == 0:
+        return pd.Series(converted_cells, index=point_cells.index)
+
+    coords = coords_from_pixels(pixels, mark_geo_bounds(row_geo_bounds, mark_row_positions, mark_counts))
+
+    # and split the coords back up into the lists of marks for each row
+    for row, row_coords in zip(mark_row_positions, np.split(coords, np.cumsum(mark_counts)[:-1])):
+        converted_cells[row] = row_coords.tolist()
+    return pd.Series(converted_cells, index=point_cells.index)
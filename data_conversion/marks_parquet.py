@@ -0,0 +1,42 @@
+'''
+
+marks_parquet.py writes the one row per mark output of convert_to_ibcc.py to a Parquet file,
+a row group per extract chunk, with the label columns dictionary encoded and the coords as
+float32, so downstream loads can filter by subject or tool without parsing text.
+
+'''
+
+# pyarrow is optional, it's only needed for the parquet output
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+def marks_schema(points_plan):
+    # the same types for every chunk, whichever labels turn up in it
+    label_type = pa.dictionary(pa.int32(), pa.string())
+    fields = [
+        ('classification_id', pa.int64()),
+        ('subject_id', pa.int64()),
+        ('user_id', pa.int64()),
+        ('tool', pa.int8()),
+        ('label', label_type),
+        ('frame', pa.int8()),
+        ('x', pa.float32()),
+        ('y', pa.float32()),
+        ('lon', pa.float32()),
+        ('lat', pa.float32()),
+    ] + [(header, label_type) for header in points_plan.mark_subtask_headers]
+    return pa.schema(fields)
+
+class MarksWriter(object):
+    def __init__(self, parquet_path, points_plan):
+        self.schema = marks_schema(points_plan)
+        self.writer = pq.ParquetWriter(parquet_path, self.schema)
+
+    def write(self, marks_df):
+        self.writer.write_table(pa.Table.from_pandas(marks_df, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        self.writer.close()
@@ -0,0 +1,67 @@
+'''
+
+point_conversion.py converts the chunks of a point extract with the column plan for
+convert_to_ibcc.py, either in process or on a pool of worker processes that each open the
+subject index read only. The converted chunks come back in the extract order, as csv text or
+for the parquet output as a DataFrame with one row per mark.
+
+'''
+
+import signal, collections, multiprocessing
+import subject_index
+import cell_parsing
+
+def convert_chunk(points_plan, subjects_index, classifications_points, output_format):
+    '''
+    Convert an extract chunk, returning the (output, row count, parse cache counts).
+    '''
+    # load just the subjects in this chunk from the index
+    subjects_geo_df = subjects_index.geo_metadata(classifications_points['subject_id'])
+    if output_format == 'parquet':
+        output = points_plan.apply_marks(classifications_points, subjects_geo_df)
+    else:
+        output = points_plan.apply(classifications_points, subjects_geo_df).to_csv(index=False, header=False)
+    return output, len(classifications_points), cell_parsing.take_cache_counts()
+
+def init_worker(points_plan, subject_index_path, output_format, parse_cache_size):
+    global worker_settings
+    # the main process handles Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cell_parsing.configure(parse_cache_size)
+    worker_settings = (points_plan, subject_index.SubjectIndex(subject_index_path, read_only=True), output_format)
+
+def convert_worker_chunk(classifications_points):
+    points_plan, subjects_index, output_format = worker_settings
+    return convert_chunk(points_plan, subjects_index, classifications_points, output_format)
+
+def iter_converted_chunks(chunks, points_plan, subject_index_path, output_format='csv', workers=1, parse_cache_size=cell_parsing.default_cache_size):
+    '''
+    Convert the extract chunks, yielding the (output, row count, parse cache counts) of each
+    in order as it's done.
+
+    With more than one worker only a couple of chunks per worker are read ahead of the ones
+    yielded, so the memory used stays bounded.
+    '''
+    if workers <= 1:
+        cell_parsing.configure(parse_cache_size)
+        subjects_index = subject_index.SubjectIndex(subject_index_path, read_only=True)
+        try:
+            for classifications_points in chunks:
+                yield convert_chunk(points_plan, subjects_index, classifications_points, output_format)
+        finally:
+            subjects_index.close()
+        return
+
+    max_pending = workers * 2
+    pending = collections.deque()
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(points_plan, subject_index_path, output_format, parse_cache_size))
+    try:
+        for classifications_points in chunks:
+            pending.append(pool.apply_async(convert_worker_chunk, (classifications_points,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,115 @@
+'''
+
+question_outputs.py splits the question extract rows into the questions, shortcuts and blanks
+outputs of convert_to_ibcc.py in one pass over each chunk of the extract:
+  questions - the answers to the question tasks (e.g. the number of structures)
+  shortcuts - the shortcut answers (e.g. Unclassifiable Image, Ocean Only (no land))
+  blanks    - the classifications with no answer
+with boolean masks over the extract's answer columns rather than a loop over the rows, and
+the subject geo metadata joined on by subject_id. The shortcut answers are the answers of the
+tasks without a question in the task labels.
+
+'''
+
+import re
+import numpy as np
+import subject_index
+
+base_headers = ['classification_id', 'user_name', 'user_id', 'workflow_id', 'task',
+                'created_at', 'subject_id', 'extractor', 'data.aggregation_version']
+# the question extractor's answer for a classification without one
+no_answer_header = 'data.None'
+
+answer_label_re = re.compile(r'\A(T\d+)\.answers\.(\d+)\.label\Z', re.IGNORECASE)
+question_label_re = re.compile(r'\A(T\d+)\.question\Z', re.IGNORECASE)
+
+def slugify(label):
+    # the extractor names the answer columns by the slug of their label, e.g. 'up-to-10'
+    return re.sub(r'[^a-z0-9]+', '-', label.lower()).strip('-')
+
+def task_questions_and_answers(task_labels_dict):
+    '''
+    Return a dict of task to its question label, and a dict of answer slug to answer label,
+    from the task labels.
+    '''
+    questions = {}
+    answer_labels = {}
+    for label_key, label in task_labels_dict.items():
+        question_match = question_label_re.match(label_key)
+        answer_match = answer_label_re.match(label_key)
+        if question_match:
+            questions[question_match.group(1)] = label
+        elif answer_match:
+            answer_labels.setdefault(answer_match.group(1), {})[slugify(label)] = label
+    return questions, answer_labels
+
+class QuestionOutputs(object):
+    def __init__(self, extract_headers, task_labels_dict, shortcut_tasks=None):
+        self.questions, task_answer_labels = task_questions_and_answers(task_labels_dict)
+        # the shortcuts are the tasks with answers but no question, unless we're told which they are
+        if shortcut_tasks is None:
+            shortcut_tasks = [task for task in task_answer_labels if task not in self.questions]
+        answer_labels = {}
+        shortcut_slugs = set()
+        for task, task_labels in task_answer_labels.items():
+            answer_labels.update(task_labels)
+            if task in shortcut_tasks:
+                shortcut_slugs.update(task_labels.keys())
+
+        # split the answer columns into the question and shortcut answers, the columns
+        # without a label in the task labels are question answers and keep the extractor's slug
+        self.question_headers = []
+        self.shortcut_headers = []
+        for header in extract_headers:
+            if header.startswith('data.') and header not in base_headers and header != no_answer_header:
+                slug = header[len('data.'):]
+                if slug in shortcut_slugs:
+                    self.shortcut_headers.append(header)
+                else:
+                    self.question_headers.append(header)
+        self.question_labels = np.array([answer_labels.get(header[len('data.'):], header[len('data.'):]) for header in self.question_headers], dtype=object)
+        self.shortcut_labels = np.array([answer_labels[header[len('data.'):]] for header in self.shortcut_headers], dtype=object)
+
+        self.base_headers = [header for header in base_headers if header in extract_headers]
+        self.question_output_headers = self.base_headers + ['question', 'label'] + subject_index.geo_fields
+        self.shortcut_output_headers = self.base_headers + ['label'] + subject_index.geo_fields
+        self.blank_output_headers = self.base_headers + subject_index.geo_fields
+
+    def answered(self, extract_df, headers):
+        # a boolean matrix of the rows x answer columns with an answer count
+        return extract_df[headers].fillna(0).values > 0
+
+    def answer_labels(self, answered, labels):
+        # the label of each row's answer, joined with ; for the rows with more than one
+        if len(labels) == 0:
+            return np.full(len(answered), None, dtype=object)
+        row_labels = labels[answered.argmax(axis=1)]
+        for row in np.flatnonzero(answered.sum(axis=1) > 1):
+            row_labels[row] = ';'.join(labels[answered[row]])
+        return row_labels
+
+    def split(self, extract_df, subjects_geo_df):
+        '''
+        Split the extract rows to the (questions, shortcuts, blanks) output DataFrames, with the
+        subject geo metadata in subjects_geo_df (indexed by subject_id).
+        '''
+        question_answered = self.answered(extract_df, self.question_headers)
+        shortcut_answered = self.answered(extract_df, self.shortcut_headers)
+        shortcut_rows = shortcut_answered.any(axis=1)
+        question_rows = question_answered.any(axis=1) & ~shortcut_rows
+        # nothing answered, including the extractor's data.None rows
+        blank_rows = ~(question_rows | shortcut_rows)
+
+        output_df = extract_df[self.base_headers].copy()
+        output_df['question'] = extract_df['task'].map(self.questions).values
+        output_df['label'] = np.where(shortcut_rows,
+            self.answer_labels(shortcut_answered, self.shortcut_labels),
+            self.answer_labels(question_answered, self.question_labels))
+        # the questions don't need converting, so subjects missing from the export just get empty geo metadata
+        row_geo_metadata = subjects_geo_df.reindex(extract_df['subject_id'].values)
+        for header in subject_index.geo_fields:
+            output_df[header] = row_geo_metadata[header].values
+
+        return output_df.loc[question_rows, self.question_output_headers], \
+            output_df.loc[shortcut_rows, self.shortcut_output_headers], \
+            output_df.loc[blank_rows, self.blank_output_headers]
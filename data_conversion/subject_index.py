@@ -0,0 +1,121 @@
+'''
+
+subject_index.py keeps the subject geo metadata convert_to_ibcc.py needs from a project subjects
+export in a SQLite database keyed by subject_id, so the export's metadata json only gets parsed
+once instead of on every conversion run.
+
+The index stores the hash of the export file it was built from and is rebuilt when the export
+changes. Conversion runs then load just the subjects in their extract file from it.
+
+'''
+
+import os, hashlib, sqlite3
+from urllib.request import pathname2url
+import numpy as np
+import pandas as pd
+import ujson
+
+# the subject metadata needed for pixel conversion to lat/lon, see tiling/convert_tiles_to_jpg.py
+geo_fields = [
+    'lon_min', 'lon_max',
+    'lat_min', 'lat_max',
+    'imsize_x_pix', 'imsize_y_pix'
+]
+
+# stay under the SQLite limit on query parameters
+query_batch_size = 500
+
+def file_hash(file_path, block_size=2**20):
+    file_sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_sha1.update(block)
+    return file_sha1.hexdigest()
+
+def geo_field_values(metadata):
+    # missing or non numeric fields are stored as NULL and reported when a conversion needs them
+    subject_metadata = ujson.loads(metadata)
+    values = []
+    for field in geo_fields:
+        try:
+            values.append(float(subject_metadata[field]))
+        except (KeyError, TypeError, ValueError):
+            values.append(None)
+    return values
+
+class SubjectIndex(object):
+    def __init__(self, index_path, read_only=False):
+        self.index_path = index_path
+        # wait for another conversion that is building the index rather than failing
+        if read_only:
+            # the conversion worker processes share the index, only reading it
+            self.connection = sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(index_path)), uri=True, timeout=600, isolation_level=None)
+            return
+        self.connection = sqlite3.connect(index_path, timeout=600, isolation_level=None)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS subjects (
+                subject_id INTEGER PRIMARY KEY,
+                %s
+            )''' % ',\n'.join('%s REAL' % field for field in geo_fields))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS export (export_hash TEXT NOT NULL)')
+
+    def close(self):
+        self.connection.close()
+
+    def export_hash(self):
+        row = self.connection.execute('SELECT export_hash FROM export').fetchone()
+        return None if row is None else row[0]
+
+    def update(self, subjects_export_path, chunksize=10**5):
+        '''
+        Rebuild the index from the subjects export file if it has changed since the index was
+        built. Returns True if the index was rebuilt.
+        '''
+        export_hash = file_hash(subjects_export_path)
+        if self.export_hash() == export_hash:
+            return False
+
+        # hold the write lock while building, and check again once we have it
+        # in case another conversion run has just built the index for this export
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            if self.export_hash() == export_hash:
+                self.connection.execute('ROLLBACK')
+                return False
+
+            self.connection.execute('DELETE FROM subjects')
+            self.connection.execute('DELETE FROM export')
+            insert_sql = 'INSERT OR REPLACE INTO subjects (subject_id, %s) VALUES (?, %s)' % (
+                ', '.join(geo_fields), ', '.join('?' * len(geo_fields)))
+            # subjects are listed once per subject set / workflow they are in, with the same metadata
+            for subjects_chunk in pd.read_csv(subjects_export_path, usecols=['subject_id', 'metadata'], chunksize=chunksize):
+                subjects_chunk = subjects_chunk.drop_duplicates('subject_id')
+                self.connection.executemany(insert_sql, [
+                    [int(subject_id)] + geo_field_values(metadata)
+                    for subject_id, metadata in zip(subjects_chunk['subject_id'], subjects_chunk['metadata'])])
+            self.connection.execute('INSERT INTO export (export_hash) VALUES (?)', (export_hash,))
+            self.connection.execute('COMMIT')
+        except:
+            self.connection.execute('ROLLBACK')
+            raise
+        return True
+
+    def subject_count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM subjects').fetchone()[0]
+
+    def geo_metadata(self, subject_ids):
+        '''
+        Return a DataFrame of the geo metadata fields (as floats, NaN if the subject doesn't
+        have them) indexed by subject_id, for the subject_ids that are in the index.
+        '''
+        subject_ids = [int(subject_id) for subject_id in pd.unique(np.asarray(subject_ids))]
+        rows = []
+        for start in range(0, len(subject_ids), query_batch_size):
+            batch_subject_ids = subject_ids[start:start + query_batch_size]
+            cursor = self.connection.execute(
+                'SELECT subject_id, %s FROM subjects WHERE subject_id IN (%s)' % (', '.join(geo_fields), ', '.join('?' * len(batch_subject_ids))),
+                batch_subject_ids)
+            rows.extend(cursor.fetchall())
+        geo_metadata_df = pd.DataFrame(rows, columns=['subject_id'] + geo_fields, dtype=float)
+        geo_metadata_df['subject_id'] = geo_metadata_df['subject_id'].astype(np.int64)
+        return geo_metadata_df.set_index('subject_id')
@@ -0,0 +1,131 @@
+'''
+
+benchmark_upload.py measures the subject upload throughput of uploader.py for different
+link batch sizes and worker counts, against the local Panoptes stand-in
+(see panoptes_standin.py) so it doesn't touch the production API.
+
+For each combination it uploads --subjects before / after jpg pairs and reports the
+subjects/sec, the p50 / p99 subject save latency and the p50 / p99 link batch latency, e.g.
+  python benchmark_upload.py --subjects 500 --batch-sizes 10,50,200 --workers 1,4,16 --api-latency 0.2 --rate-limit 50
+
+Use --endpoint to benchmark against another Panoptes API (e.g. staging) instead,
+with the ZOONIVERSE_USERNAME / ZOONIVERSE_PASSWORD credentials and --subject-set (required
+with --endpoint). The benchmark subjects are removed again after each run.
+
+'''
+
+import os, time, argparse, tempfile, shutil
+import numpy as np
+import pandas as pd
+from PIL import Image
+from panoptes_client import Panoptes, SubjectSet
+import uploader
+import upload_journal
+import pacing
+import panoptes_standin
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+parser = argparse.ArgumentParser(description='Benchmark the subject upload throughput against a local Panoptes API stand-in.')
+parser.add_argument('--subjects', dest='num_subjects', type=int, default=200, help='the number of subjects to upload for each run (default: 200)')
+parser.add_argument('--batch-sizes', dest='batch_sizes', type=int_list, default=[10, 50, 100], help='comma separated link batch sizes to run (default: 10,50,100)')
+parser.add_argument('--workers', dest='workers', type=int_list, default=[1, 4, 8], help='comma separated upload worker counts to run (default: 1,4,8)')
+parser.add_argument('--adaptive', dest='adaptive', action='store_true', help='adapt the link batch sizes to the link latency, starting from the --batch-sizes')
+parser.add_argument('--max-batch-size', dest='max_batch_size', type=int, default=500, help='with --adaptive, the largest link batch size (default: 500)')
+parser.add_argument('--target-link-latency', dest='target_link_latency', type=float, default=5.0, help='with --adaptive, the target link latency in seconds (default: 5)')
+parser.add_argument('--max-rate', dest='max_rate', type=float, default=uploader.default_max_rate, help='the most API requests per second for the uploads to make (default: %s)' % uploader.default_max_rate)
+parser.add_argument('--image-size', dest='image_size', type=int, default=500, help='pixel width / height of the test jpgs (default: 500)')
+parser.add_argument('--endpoint', dest='endpoint', default=None, help='benchmark against this Panoptes API endpoint instead of the local stand-in')
+parser.add_argument('--subject-set', dest='subject_set_id', default=None, help='the subject set to upload to, required with --endpoint')
+parser.add_argument('--output', dest='output', default=None, help='also write the results to this csv file')
+panoptes_standin.add_arguments(parser)
+args = parser.parse_args()
+
+# don't upload the benchmark subjects into whichever set happens to be 1 on a real endpoint
+if args.endpoint is not None and args.subject_set_id is None:
+    parser.error('--subject-set is required with --endpoint')
+if args.subject_set_id is None:
+    args.subject_set_id = '1'
+
+if args.endpoint is None:
+    standin, endpoint = panoptes_standin.start_server(args)
+    connect_kwargs = dict(username='standin', password='standin', endpoint=endpoint)
+    print("Started the Panoptes stand-in at %s" % endpoint)
+else:
+    standin = None
+    endpoint = args.endpoint
+    connect_kwargs = dict(username=os.environ.get('ZOONIVERSE_USERNAME'), password=os.environ.get('ZOONIVERSE_PASSWORD'), endpoint=endpoint)
+
+Panoptes.connect(**connect_kwargs)
+subject_set = SubjectSet.find(args.subject_set_id)
+project = subject_set.links.project
+
+# a before / after pair of noisy jpgs, about the size of the real tiles
+media_dir = tempfile.mkdtemp(prefix='benchmark_upload_')
+media_files = []
+for epoch in ['before', 'after']:
+    media_file = "%s/benchmark_%s.jpg" % (media_dir, epoch)
+    pixels = np.random.randint(0, 256, (args.image_size, args.image_size, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(media_file, quality=92)
+    media_files.append(media_file)
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) > 0 else float('nan')
+
+results = []
+try:
+    for workers in args.workers:
+        for batch_size in args.batch_sizes:
+            print("Uploading %d subjects with %d workers, linking %d at a time..." % (args.num_subjects, workers, batch_size))
+            journal = upload_journal.UploadJournal(':memory:', subject_set.id)
+            subject_rows = ((index, {'jpg_file_before': 'benchmark_%d.jpg' % index}, media_files) for index in range(args.num_subjects))
+            timings = {'save': [], 'link': []}
+            if args.adaptive:
+                batch_sizer = pacing.LinkBatchSizer(batch_size, maximum=args.max_batch_size, target_latency=args.target_link_latency)
+            else:
+                batch_sizer = pacing.LinkBatchSizer(batch_size, minimum=batch_size, maximum=batch_size)
+            standin_stats_before = standin.state.stats() if standin is not None else {}
+
+            started_at = time.time()
+            linked_count, failure = uploader.upload_subjects(subject_set, project, subject_rows, workers, batch_sizer, journal, pacer=pacing.RequestPacer(args.max_rate), connect_kwargs=connect_kwargs, timings=timings)
+            elapsed = time.time() - started_at
+            # every created subject is journaled, whether or not it was linked
+            benchmark_rows = journal.rows()
+            journal.close()
+
+            standin_stats = standin.state.stats() if standin is not None else {}
+            results.append({
+                'workers': workers,
+                'batch_size': batch_size,
+                'subjects': linked_count,
+                'failed': failure is not None,
+                'seconds': elapsed,
+                'subjects_per_sec': linked_count / elapsed,
+                'save_p50': percentile(timings['save'], 50),
+                'save_p99': percentile(timings['save'], 99),
+                'link_batches': len(timings['link']),
+                'final_batch_size': batch_sizer.size,
+                'link_p50': percentile(timings['link'], 50),
+                'link_p99': percentile(timings['link'], 99),
+                'rate_limited': standin_stats.get('rate_limited', 0) - standin_stats_before.get('rate_limited', 0),
+            })
+            if failure is not None:
+                print("  the run stopped on a failed save: %s" % failure[1])
+
+            # remove the benchmark subjects again, after the stats so the deletes aren't counted
+            benchmark_subject_ids = [subject_id for _, subject_id, _ in benchmark_rows.values() if subject_id is not None]
+            print("Removing the %d benchmark subjects..." % len(benchmark_subject_ids))
+            uploader.remove_subjects(benchmark_subject_ids, verbose=False)
+finally:
+    shutil.rmtree(media_dir)
+    if standin is not None:
+        standin.shutdown()
+
+results_df = pd.DataFrame(results)
+print('')
+print(results_df.to_string(index=False, float_format=lambda value: '%.3f' % value))
+
+if args.output is not None:
+    results_df.to_csv(args.output, index=False)
+    print("Wrote the results to %s" % args.output)
@@ -2,21 +2,29 @@
 
 convert_tiles_to_jpg is for converting tiles made with make_tiff_tiles into jpgs. It also pulls the tile coordinate information from the csv file exported by make_tiff_tiles.py and adds further columns to it, for manifest creation.
 
+The jpgs are rendered in-process on a process pool (see renderer.py), the old ImageMagick
+convert script can still be written with --imagemagick.
+
 
 
 '''
 
 import sys, os
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import pandas as pd
 import ujson
 import scipy.interpolate
 import scipy.ndimage
 from osgeo import gdal, osr
-from pyproj import Proj, transform
+from pyproj import Proj
 #import urllib
 #from PIL import ImageFile
 from PIL import Image
+import renderer
+import tile_coords
+import tiler
+import tile_index
 
 
 try:
@@ -29,10 +37,22 @@ except:
     print("  Optional extra inputs (no spaces):")
     print("    cparams=\"convert params\"")
     print("       parameters to feed into imagemagick convert command (in addition to epoch label)")
+    print("       only -magnify is supported when rendering the jpgs with --run")
     print("    proj=epsg:32620")
     print("       specify the projection rather than get it from a sample file (use with great caution)")
+    print("    corners=4")
+    print("       take the lat/lon bounds from all 4 tile corners rather than just the min and max corners (default: 2)")
+    print("    sizes=geo|open")
+    print("       work out the tile pixel sizes from the csv extents and the tile pixel size (geo, the default)")
+    print("       or by opening every tile (open)")
+    print("    verify=N")
+    print("       with sizes=geo, open a sample of N tiles to check the computed sizes (default: 0)")
     print("    --run")
-    print("       if you actually want to make the jpegs and not just generate a script to do so")
+    print("       if you actually want to make the jpegs and not just write out the tile csv")
+    print("    workers=N")
+    print("       number of processes to make the jpegs with (default: number of cpus)")
+    print("    --imagemagick")
+    print("       write a script to make the jpegs with imagemagick convert instead (all cparams are supported)")
     sys.exit(0)
 
 
@@ -58,8 +78,13 @@ if not os.path.exists(tiledir_jpg):
 
 cparams = ''
 run_maketiles = False
+use_imagemagick = False
+workers = None
 projection_in = 'epsg:32620'
 user_proj     = False
+all_corners   = False
+size_mode     = 'geo'
+verify_sample = 0
 
 # check for other command-line arguments
 if len(sys.argv) > 3:
@@ -72,8 +97,18 @@ if len(sys.argv) > 3:
         elif arg[0] == "proj":
             projection_in = arg[1]
             user_proj = True
+        elif arg[0] == "corners":
+            all_corners = int(arg[1]) == 4
         elif arg[0] == "--run":
             run_maketiles = True
+        elif arg[0] == "--imagemagick":
+            use_imagemagick = True
+        elif arg[0] == "workers":
+            workers = int(arg[1])
+        elif arg[0] == "sizes":
+            size_mode = arg[1]
+        elif arg[0] == "verify":
+            verify_sample = int(arg[1])
 
 
 convert_params = "%s -gravity south -stroke \"#000C\" -font Arial -pointsize 16 -strokewidth 3 -annotate 0 \"%s\" -stroke none -fill white -annotate 0 \"%s\"" % (cparams, epoch_t, epoch_t)
@@ -86,7 +121,7 @@ magfac = 2**convert_params.count("-magnify")
 # for high-res imaging like DigitalGlobe - 17
 # for medium stuff like Planet Labs - 15
 # for lower-res (~10 m) - 13
-mapzoom = os.environ.get('SUBJECT_METADATA_MAP_ZOOM',15)
+mapzoom = int(os.environ.get('SUBJECT_METADATA_MAP_ZOOM',15))
 
 
 def get_projection(imgfile):
@@ -107,19 +142,6 @@ def get_projection(imgfile):
         return proj_fallback, Proj(init=proj_fallback)
 
 
-# takes a single metadata row
-def get_corner_latlong(metadata, inProj, outProj):
-    x_m_min = metadata[1]['x_m_min']
-    x_m_max = metadata[1]['x_m_max']
-    y_m_min = metadata[1]['y_m_min']
-    y_m_max = metadata[1]['y_m_max']
-
-    lon_min, lat_min = transform(inProj,outProj,x_m_min,y_m_min)
-    lon_max, lat_max = transform(inProj,outProj,x_m_max,y_m_max)
-
-    return lon_min, lon_max, lat_min, lat_max
-
-
 def getsizes_local(imagefile):
     # get image size in pixels
     theimg = Image.open("%s/%s" % (tiledir_tiff, imagefile))
@@ -127,36 +149,47 @@ def getsizes_local(imagefile):
     theimg.close()
     return thesize
 
-def get_gmaps(row):
-    lon_ctr = row[1]['lon_ctr']
-    lat_ctr = row[1]['lat_ctr']
-    return "https://www.google.com/maps/@%.7f,%.7f,%dz" % (lat_ctr, lon_ctr, mapzoom)
-
-def get_osm(row):
-    lon_ctr = row[1]['lon_ctr']
-    lat_ctr = row[1]['lat_ctr']
-    return "http://www.openstreetmap.org/#map=%d/%.7f/%.7f" % (mapzoom, lat_ctr, lon_ctr)
-
-
-# if you're supplying anything with a colon like 'epsg:32619', you need init=.
-# if you are supplying something more like '+proj=utm +zone=19 +datum=WGS84 +units=m +no_defs ', which comes from e.g. gdal, using init= will crash things
-# even though those two strings represent the same projection
-# what fun this is
-try:
-    inProj  = Proj(projection_in)
-except:
-    inProj  = Proj(init=projection_in)
-
-# this is standard lat and lon
-outProj = Proj(init='epsg:4326')
+def get_pixel_size(imgfile):
+    # all the tiles share the source image geotransform pixel size
+    inDS = gdal.Open(imgfile)
+    geotransform = inDS.GetGeoTransform()
+    return abs(geotransform[1]), abs(geotransform[5])
+
+def getsizes_geo(tileparams, pixel_size):
+    # get image sizes in pixels from the tile extents without opening the tiles
+    pixel_size_x, pixel_size_y = pixel_size
+    size_x = np.rint((tileparams['x_m_max'] - tileparams['x_m_min']).values / pixel_size_x).astype(int)
+    size_y = np.rint((tileparams['y_m_max'] - tileparams['y_m_min']).values / pixel_size_y).astype(int)
+    return size_x, size_y
+
+def verify_sizes(tileparams, sample_size):
+    # open a sample of the tiles, in parallel as this is all waiting on the file system
+    sample = tileparams.sample(n=min(sample_size, len(tileparams)), random_state=0)
+    pool = ThreadPool(16)
+    try:
+        sample_sizes = pool.map(getsizes_local, sample.tif_file)
+    finally:
+        pool.close()
+    size_matches = (sample['tifsize_x_pix'].values == [q[0] for q in sample_sizes]) & (sample['tifsize_y_pix'].values == [q[1] for q in sample_sizes])
+    return sample.tif_file[~size_matches].tolist()
 
 infile_path = "%s/%s" % (tiled_data_dir, infile)
-tileparams = pd.read_csv(infile_path, header=None)
-# the output doesn't have a header automatically but we know what the parameters are
-# the output format is set by gdal_retile so unless that version changes, this shouldn't change
-#st_thomas_before_1_1.tif,285000.,289796.347102,2036082.130910,2041000.
-colnames = 'tif_file x_m_min x_m_max y_m_min y_m_max'.split()
-tileparams.columns = colnames
+# prefer the typed tile index from make_tiff_tiles.py over re-parsing the csv text
+index_path = tile_index.tile_index_path(tiled_data_dir, infile)
+use_tile_index = tile_index.available() and os.path.isfile(index_path)
+if use_tile_index:
+    print("Reading the tile index %s" % index_path)
+    tileparams = tile_index.read_tile_index(index_path, columns=tiler.tile_table_columns)
+    index_colnames = list(tileparams.columns)
+else:
+    tileparams = pd.read_csv(infile_path, header=None)
+    # the output doesn't have a header automatically but we know what the parameters are
+    # the output format is set by gdal_retile so unless that version changes, this shouldn't change
+    #st_thomas_before_1_1.tif,285000.,289796.347102,2036082.130910,2041000.
+    colnames = 'tif_file x_m_min x_m_max y_m_min y_m_max'.split()
+    tileparams.columns = colnames
+    # keep the (row, col) tile grid index, create_manifest.py pairs the before and after tiles with it
+    tileparams = pd.concat([tileparams, tiler.tile_grid_index(tileparams['tif_file'])], axis=1)
 
 # if the projection isn't supplied by the user, try to figure it out based on the first file
 if not user_proj:
@@ -170,43 +203,83 @@ tileparams['projection_orig'] = [projection_in for q in tileparams.x_m_min]
 
 tileparams['jpg_file'] = [q.replace(".tif", ".jpg") for q in tileparams['tif_file']]
 
-coords = [get_corner_latlong(q, inProj, outProj) for q in tileparams.iterrows()]
-
-tileparams['lon_min'] = [q[0] for q in coords]
-tileparams['lon_max'] = [q[1] for q in coords]
-tileparams['lat_min'] = [q[2] for q in coords]
-tileparams['lat_max'] = [q[3] for q in coords]
+# convert the whole tile table to lat / lon in one go
+tileparams = tile_coords.add_latlong_columns(tileparams, projection_in, all_corners=all_corners)
 
-tileparams['lon_ctr'] = 0.5*(tileparams['lon_min'] + tileparams['lon_max'])
-tileparams['lat_ctr'] = 0.5*(tileparams['lat_min'] + tileparams['lat_max'])
+if use_tile_index and size_mode == 'geo':
+    # the tiler records the exact tile sizes
+    print("Using the image sizes from the tile index")
+    size_mode = 'index'
 
-print("Fetching image sizes...")
-sizes = [getsizes_local(q) for q in tileparams.tif_file]
-tileparams['tifsize_x_pix'] = [q[0] for q in sizes]
-tileparams['tifsize_y_pix'] = [q[1] for q in sizes]
+if size_mode == 'geo':
+    print("Computing image sizes from the tile extents...")
+    try:
+        first_file_path = "%s/%s" % (tiledir_tiff, tileparams.tif_file.iloc[0])
+        tileparams['tifsize_x_pix'], tileparams['tifsize_y_pix'] = getsizes_geo(tileparams, get_pixel_size(first_file_path))
+    except Exception as e:
+        print(" Can't determine the tile pixel size (%s) -- opening every tile instead" % e)
+        size_mode = 'open'
+
+if size_mode == 'geo' and verify_sample > 0:
+    mismatched_tiles = verify_sizes(tileparams, verify_sample)
+    if len(mismatched_tiles) > 0:
+        print(" Computed sizes don't match the tiles for %s -- opening every tile instead" % ", ".join(mismatched_tiles))
+        size_mode = 'open'
+    else:
+        print(" Checked the computed sizes of %d tiles" % min(verify_sample, len(tileparams)))
+
+if size_mode == 'open':
+    print("Fetching image sizes...")
+    sizes = [getsizes_local(q) for q in tileparams.tif_file]
+    tileparams['tifsize_x_pix'] = [q[0] for q in sizes]
+    tileparams['tifsize_y_pix'] = [q[1] for q in sizes]
 tileparams['imsize_x_pix'] = magfac * tileparams['tifsize_x_pix']
 tileparams['imsize_y_pix'] = magfac * tileparams['tifsize_y_pix']
 
-tileparams['google_maps_link'] = [get_gmaps(q) for q in tileparams.iterrows()]
-tileparams['openstreetmap_link'] = [get_osm(q) for q in tileparams.iterrows()]
+tileparams = tile_coords.add_map_link_columns(tileparams, mapzoom)
 
 tileparams.to_csv(outfile_extra)
 print("Wrote new csv with extra columns to %s" % outfile_extra)
-print("  Now writing script to convert to jpg...")
 
+if use_tile_index:
+    tile_index.append_columns(index_path, tileparams[[q for q in tileparams.columns if q not in index_colnames]])
+    print("Added the extra columns to the tile index %s" % index_path)
+
+if use_imagemagick:
+    print("  Now writing script to convert to jpg...")
+
+    fout = open(outfile_jpgsh, "w")
+    for i, row in enumerate(tileparams.iterrows()):
+        fout.write("convert %s/%s %s %s/%s\n" % (tiledir_tiff, row[1]['tif_file'], convert_params, tiledir_jpg, row[1]['jpg_file']))
+    fout.close()
+
+    print("  ... script written to %s ." % outfile_jpgsh)
+
+    mktile_cmd = "sh < %s" % outfile_jpgsh
+
+    if run_maketiles:
+        os.system(mktile_cmd)
+    else:
+        print("You may want to run:\n%s" % mktile_cmd)
+
+elif run_maketiles:
+    unsupported_cparams = cparams.replace("-magnify", "").strip()
+    if len(unsupported_cparams) > 0:
+        print("WARNING: ignoring cparams \"%s\", only -magnify is supported, use --imagemagick for the rest" % unsupported_cparams)
 
-fout = open(outfile_jpgsh, "w")
-for i, row in enumerate(tileparams.iterrows()):
-    fout.write("convert %s/%s %s %s/%s\n" % (tiledir_tiff, row[1]['tif_file'], convert_params, tiledir_jpg, row[1]['jpg_file']))
-fout.close()
+    print("  Now converting %d tiles to jpg..." % len(tileparams))
+    tile_paths = [("%s/%s" % (tiledir_tiff, tif_file), "%s/%s" % (tiledir_jpg, jpg_file)) for tif_file, jpg_file in zip(tileparams['tif_file'], tileparams['jpg_file'])]
+    jpg_failures = renderer.render_tiles(tile_paths, epoch_t, magfac=magfac, workers=workers)
 
-print("  ... script written to %s ." % outfile_jpgsh)
+    if len(jpg_failures) > 0:
+        outfile_failures = outfile_extra.replace("_extra.csv", "_jpg_failures.csv")
+        pd.DataFrame(jpg_failures, columns=['jpg_file', 'error']).to_csv(outfile_failures, index=False)
+        print("ERROR: %d tiles failed to convert to jpg, see %s" % (len(jpg_failures), outfile_failures))
+        sys.exit(1)
 
-mktile_cmd = "sh < %s" % outfile_jpgsh
+    print("  ... jpgs written to %s" % tiledir_jpg)
 
-if run_maketiles:
-    os.system(mktile_cmd)
 else:
-    print("You may want to run:\n%s" % mktile_cmd)
+    print("You may want to re-run this with --run to make the jpgs.")
 
 #bye
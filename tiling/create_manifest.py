@@ -5,31 +5,33 @@ zooniverse upload csv manifest for use by the panoptes cli subject uploader
 
 '''
 
-import sys, os, re, argparse
+import sys, os, argparse
+import numpy as np
 import pandas as pd
-from difflib import SequenceMatcher as SM
+import tiler
+import tile_index
+import manifest
+import priority
 
 parser = argparse.ArgumentParser(description='Create a tiled image data csv manifest to upload subjects to the Zooniverse.')
-parser.add_argument('--source', dest='attribution_source', choices=['dg', 'planet', 'sentinel', 'landsat'], required=True)
-parser.add_argument('before_csv_infile',help='the before epoch file tile metadata from convert_tiles_to_jpg.py')
-parser.add_argument('after_csv_infile', help='the after epoch file tile metadata from convert_tiles_to_jpg.py')
+parser.add_argument('--source', dest='attribution_source', choices=sorted(manifest.attribution_texts.keys()), required=True)
+parser.add_argument('before_csv_infile',help='the before epoch file tile metadata (_extra.csv or _tiles.feather tile index) from convert_tiles_to_jpg.py')
+parser.add_argument('after_csv_infile', help='the after epoch file tile metadata (_extra.csv or _tiles.feather tile index) from convert_tiles_to_jpg.py')
+parser.add_argument('--coord-tolerance', dest='coord_tolerance', type=float, default=1e-6, help='the largest difference in the before and after tile lat / lon bounds (degrees) to accept (default: 1e-6)')
+parser.add_argument('--report', dest='report_name', default='subject_manifest_errors.csv', help='file name (in DATA_OUT_DIR) for the report of every before / after tile problem (default: subject_manifest_errors.csv)')
+priority.add_arguments(parser)
 args = parser.parse_args()
 
 before_csv_infile = args.before_csv_infile
 after_csv_infile  = args.after_csv_infile
 attribution_source  = args.attribution_source
 
-# TODO: fix the YEAR metadata input
-if attribution_source == 'dg':
-    attribution_text = 'DigitalGlobe Open Data Program - Creative Commons Attribution Non Commercial 4.0'
-elif attribution_source == 'planet':
-    attribution_text = 'Planet Team ([YEAR]). Planet Application Program Interface: In Space For Life on Earth. San Francisco, CA. https://api.planet.com License: CC-BY-SA'
-elif attribution_source == 'sentinel':
-    attribution_text = 'Copernicus Sentinel data [Year] for Sentinel data'
-elif attribution_source == 'landsat':
-    attribution_text = 'USGS/NASA Landsat'
-else:
-    print("Unknown image data source, muse be one of the --source opts only")
+attribution_text = manifest.attribution_texts[attribution_source]
+
+try:
+    priority_location = priority.from_args(args)
+except ValueError as e:
+    print("Error: %s" % e)
     sys.exit(1)
 
 print("Constructing the before / after manifest upload CSV...")
@@ -37,125 +39,109 @@ print("Constructing the before / after manifest upload CSV...")
 # use the data dir for outputs from the make tiles as inputs here
 tiled_data_dir = os.environ.get('DATA_OUT_DIR','outputs/')
 
-# read both into pandas data frames?
-before_manifest_df = pd.read_csv(before_csv_infile)
-after_manifest_df = pd.read_csv(after_csv_infile)
-
-# TODO: find a pandas way to compare the set of columns in each data from
-for index, row in before_manifest_df.iterrows():
-    try:
-        after_manifest_row = after_manifest_df.loc[index]
-    except KeyError as e:
-        print('\nError: files do not match!')
-        print('Unknown row %s in after manifest file: %s' % (index, e))
-        break
-
-    # check the file names match
-    before_prefix, before_suffix = re.split("before", row['tif_file'])
-    after_prefix, after_suffix = re.split("after", after_manifest_row['tif_file'])
-    tif_file_names_match = (before_prefix == after_prefix) and (before_suffix == after_suffix)
-
-    before_prefix, before_suffix = re.split("before", row['jpg_file'])
-    after_prefix, after_suffix = re.split("after", after_manifest_row['jpg_file'])
-    fuzzy_prefix_match_ratio = SM(None, before_prefix, after_prefix).ratio()
-    # super arbitrary cut off for fuzzy match - look into this further as example input files come in
-    # before_prefix = 'palu_2018_09_28_'
-    # after_prefix - 'palu_2018_09_29_10_01_'
-    # SM(None, before_prefix, after_prefix).ratio() =  0.7894736842105263
-    # SM(None, before_prefix, "blargh").ratio() =  0.09090909090909091
-    jpg_file_names_match = (fuzzy_prefix_match_ratio > 0.5) and (before_suffix == after_suffix)
-
-    if not (tif_file_names_match and jpg_file_names_match):
-        print('\nError: file tiling name parts do not match!')
-        print('Tile filenames in manifests for row %s do not match and can not be grouped into 1 subject!' % (index))
-        print('%s and %s' % (row['tif_file'], after_manifest_row['tif_file']))
-        print('%s and %s' % (row['jpg_file'], after_manifest_row['jpg_file']))
-        break
-
-    # The tif files are created by gdal so will exist
-    # jpg files are via a shell script using `convert`
-    # this program may error, report and continue leaving some missing JPG images
-    before_jpg_path = "%s/tiles_before_jpg/%s" % (tiled_data_dir, row['jpg_file'])
-    after_jpg_path = "%s/tiles_after_jpg/%s" % (tiled_data_dir, after_manifest_row['jpg_file'])
-    jpg_files_exist = os.path.isfile(before_jpg_path) and os.path.isfile(after_jpg_path)
-    if not jpg_files_exist:
-        print('\nError: missing JPG subject files!')
-        print('Check the before file exists: %s' % before_jpg_path)
-        print('Check the after file exists: %s' % after_jpg_path)
-        break
-
-    # TODO: a much better way of comparing col values
-    # cols_to_compare = ['lon_min', 'lon_max', 'lat_min', 'lat_max']
-    lon_min_match = row['lon_min'] == after_manifest_row['lon_min']
-    lon_max_match = row['lon_max'] == after_manifest_row['lon_max']
-    lat_min_match = row['lat_min'] == after_manifest_row['lat_min']
-    lat_max_match = row['lat_max'] == after_manifest_row['lat_max']
-
-    geo_cords_match = lon_min_match and lon_max_match and lat_min_match and lat_max_match
-    if not geo_cords_match:
-        print('\nError: files do not match!')
-        print('Geo coords in manifests for row %s have different coords!' % (index))
-        break
+# the before / after tile bounds that should match
+coord_columns = ['lon_min', 'lon_max', 'lat_min', 'lat_max']
+
+def read_tile_metadata(infile):
+    if infile.endswith(".feather"):
+        return tile_index.read_tile_index(infile, columns=manifest.manifest_input_columns)
+    return pd.read_csv(infile)
+
+# read both into pandas data frames
+before_manifest_df = read_tile_metadata(before_csv_infile)
+after_manifest_df = read_tile_metadata(after_csv_infile)
+
+# pair the before and after tiles by their (row, col) tile grid index
+# rather than by row position and fuzzy matching the file names
+grid_index_columns = ['tile_row', 'tile_col']
+def with_grid_index(manifest_df):
+    if set(grid_index_columns).issubset(manifest_df.columns):
+        return manifest_df
+    # older convert_tiles_to_jpg.py outputs, the grid index is in the file names
+    return pd.concat([manifest_df, tiler.tile_grid_index(manifest_df['tif_file'])], axis=1)
+
+before_manifest_df = with_grid_index(before_manifest_df)
+after_manifest_df = with_grid_index(after_manifest_df)
+
+# validate the whole before / after tables at once and report every problem row,
+# rather than stopping at the first one
+report_columns = grid_index_columns + ['jpg_file_before', 'jpg_file_after', 'problem', 'detail']
+problems = []
+
+def add_problems(rows, problem, detail=''):
+    if len(rows) == 0:
+        return
+    problem_df = rows.reindex(columns=report_columns)
+    problem_df['problem'] = problem
+    problem_df['detail'] = detail
+    problems.append(problem_df)
+
+def existing_jpg_files(jpg_dir):
+    # one directory listing per jpg folder instead of a stat per file
+    if not os.path.isdir(jpg_dir):
+        return set()
+    with os.scandir(jpg_dir) as entries:
+        return set(entry.name for entry in entries if entry.is_file())
+
+for epoch, manifest_df in [('before', before_manifest_df), ('after', after_manifest_df)]:
+    duplicated = manifest_df.duplicated(grid_index_columns, keep=False)
+    add_problems(manifest_df[duplicated].rename(columns={'jpg_file': 'jpg_file_%s' % epoch}), 'duplicate %s tile row / col' % epoch)
+
+validation_columns = grid_index_columns + ['jpg_file'] + coord_columns
+tile_pairs = before_manifest_df[validation_columns].drop_duplicates(grid_index_columns).merge(
+    after_manifest_df[validation_columns].drop_duplicates(grid_index_columns),
+    on=grid_index_columns, how='outer', suffixes=('_before', '_after'), indicator=True)
+
+add_problems(tile_pairs[tile_pairs['_merge'] == 'left_only'], 'no after tile')
+add_problems(tile_pairs[tile_pairs['_merge'] == 'right_only'], 'no before tile')
+tile_pairs = tile_pairs[tile_pairs['_merge'] == 'both']
+
+# The tif files are created by gdal so will exist
+# jpg files may fail to convert, leaving some missing JPG images
+for epoch in ['before', 'after']:
+    jpg_dir = "%s/tiles_%s_jpg" % (tiled_data_dir, epoch)
+    jpg_missing = ~tile_pairs['jpg_file_%s' % epoch].isin(existing_jpg_files(jpg_dir))
+    add_problems(tile_pairs[jpg_missing], 'missing %s jpg' % epoch, jpg_dir)
+
+# the paired tiles should cover the same ground, to within the tolerance
+for column_name in coord_columns:
+    coord_diff = (tile_pairs[column_name + '_before'] - tile_pairs[column_name + '_after']).abs()
+    # NaN coords count as a mismatch too
+    coords_differ = ~(coord_diff <= args.coord_tolerance)
+    add_problems(tile_pairs[coords_differ], '%s differs' % column_name, coord_diff[coords_differ].map('{:.3g}'.format))
+
+report_output_path = "%s/%s" % (tiled_data_dir, args.report_name)
+if len(problems) > 0:
+    report_df = pd.concat(problems, ignore_index=True).sort_values(grid_index_columns, kind='stable')
+    report_df.to_csv(report_output_path, index=False)
+
+    print('\nError: the before / after manifest files do not match!')
+    print('%d problems with %d tile pairs:' % (len(report_df), len(report_df.drop_duplicates(grid_index_columns))))
+    for problem, count in report_df['problem'].value_counts(sort=False).items():
+        print('  %s: %d' % (problem, count))
+    print('Every problem row is listed in %s' % report_output_path)
+    sys.exit(1)
+
+elif os.path.isfile(report_output_path):
+    # don't leave the report from an earlier failed run lying around
+    os.remove(report_output_path)
+
+# line the after tiles up with the before tiles by their grid row / col
+after_manifest_df = before_manifest_df[grid_index_columns].merge(after_manifest_df, on=grid_index_columns, how='left')
 
 # All input validations have passed!
 # add more in here as they come along
 
-# create the export data frame
-prn_zoo_manifest = pd.DataFrame(index=before_manifest_df.index, columns=[])
-
-# create the metadata to show to users
-prn_zoo_manifest['jpg_file_before'] = before_manifest_df['jpg_file']
-prn_zoo_manifest['jpg_file_after'] = after_manifest_df['jpg_file']
-prn_zoo_manifest['tif_file_before'] = before_manifest_df['tif_file']
-prn_zoo_manifest['tif_file_after'] = after_manifest_df['tif_file']
-prn_zoo_manifest['google_maps_link'] = after_manifest_df['google_maps_link']
-prn_zoo_manifest['openstreetmap_link'] = after_manifest_df['openstreetmap_link']
-prn_zoo_manifest['attribution'] = attribution_text
-
-# add image scale coords in (put this into the convert_tiles_to_jpg.py script?)
-def calculate_km_scale(row, col_name_prefix):
-    max_col = '%s_m_max' % col_name_prefix
-    min_col = '%s_m_min' % col_name_prefix
-    return (row[max_col] - row[min_col]) / 1000
-
-prn_zoo_manifest['x_km'] = before_manifest_df.apply(calculate_km_scale, args=('x'), axis=1)
-prn_zoo_manifest['y_km'] = before_manifest_df.apply(calculate_km_scale, args=('y'), axis=1)
-
-# create the metadata that will not be shown to users
-#
-# Headers that begin with "#" or "//" denote private fields that will not be
-#   visible to classifiers in the main classification interface or in the
-#   Talk discussion tool.
-#
-# Headers that begin with "!" denote fields that will not be visible to
-#    classifiers in the main classification interface but will be visible
-#    after classification in the Talk discussion tool.
-#
-# https://github.com/zooniverse/Panoptes-Front-End/blob/21cf42485929a62938112d5e2d4bca1a6702b00e/app/pages/lab/subject-set.cjsx#L212
-
-hidden_existing_output_columns = (
-    'projection_orig',
-    'lat_ctr',
-    'lat_max',
-    'lat_min',
-    'lon_ctr',
-    'lon_max',
-    'lon_min',
-    'x_m_ctr',
-    'x_m_max',
-    'x_m_min',
-    'y_m_ctr',
-    'y_m_max',
-    'y_m_min',
-    'imsize_x_pix',
-    'imsize_y_pix',
-    'tifsize_x_pix',
-    'tifsize_y_pix'
-)
-
-for column_name in hidden_existing_output_columns:
-    metadata_header = "!%s" % column_name
-    prn_zoo_manifest[metadata_header] = before_manifest_df[column_name]
+prn_zoo_manifest = manifest.build_manifest(before_manifest_df, after_manifest_df, attribution_text)
+
+# put the subjects nearest the priority location first, upload_manifest.py uploads them in the file order
+# the rows keep their index so an upload journal still lines up with the reordered manifest
+if priority_location is not None:
+    priority_point, priority_polygons = priority_location
+    distance_km = priority.priority_distance_km(before_manifest_df['lon_ctr'], before_manifest_df['lat_ctr'], point=priority_point, polygons=priority_polygons)
+    prn_zoo_manifest['!priority_distance_km'] = np.round(distance_km, 3)
+    prn_zoo_manifest = prn_zoo_manifest.sort_values('!priority_distance_km', kind='mergesort')
+    print("Ordered the subjects by distance from %s, %.1f to %.1f km" % (priority.describe(args), distance_km.min(), distance_km.max()))
 
 output_manifest_name = "subject_manifest.csv"
 csv_manifest_output_path = "%s/%s" % (tiled_data_dir, output_manifest_name)
@@ -0,0 +1,123 @@
+'''
+
+cull_tiles.py drops the empty before / after tile pairs, i.e. tiles that are all nodata
+collar, featureless or all water, before they are converted to jpg, put in the manifest
+and uploaded for volunteers to mark as "Ocean Only" or "Unclassifiable".
+
+Run it between make_tiff_tiles.py and convert_tiles_to_jpg.py on the csv files from
+make_tiff_tiles.py. A tile pair is only dropped when the tiles in both epochs are empty,
+a tile without a tile in the other epoch is reported and kept for create_manifest.py to flag.
+It writes *_culled.csv versions of the tile csv files to feed into convert_tiles_to_jpg.py
+and a *_tile_stats.csv file with the stats for every tile.
+
+'''
+
+import sys, os, argparse
+import pandas as pd
+import tiler
+import tile_stats
+import tile_index
+
+parser = argparse.ArgumentParser(description='Drop empty / nodata before and after tile pairs before converting them to jpg.')
+parser.add_argument('--max-nodata', dest='max_nodata', type=float, default=tile_stats.default_max_nodata, help='a tile with at least this fraction of nodata pixels is empty (default: %s)' % tile_stats.default_max_nodata)
+parser.add_argument('--min-std-dev', dest='min_std_dev', type=float, default=tile_stats.default_min_std_dev, help='a tile with a lower brightness standard deviation (8 bit scale, more than 8 bit imagery is stretched onto it) than this is empty (default: %s)' % tile_stats.default_min_std_dev)
+parser.add_argument('--max-water', dest='max_water', type=float, default=tile_stats.default_max_water, help='a tile with at least this fraction of water pixels is empty (default: %s)' % tile_stats.default_max_water)
+parser.add_argument('--overview-size', dest='overview_size', type=int, default=tile_stats.default_overview_size, help='compute the stats on a low resolution version of each tile this many pixels across, 0 to use the full tile (default: %d)' % tile_stats.default_overview_size)
+parser.add_argument('--workers', dest='workers', type=int, default=None, help='the number of processes to compute the tile stats with (default: number of cpus)')
+parser.add_argument('--band-order', dest='band_order', type=tile_stats.parse_band_order, default=None, help="the role of each image band, r / g / b / n (near infrared) or x, e.g. bgrn for 4 band Planet analytic imagery (default: the bands' colour interpretation)")
+parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='only report what would be culled')
+parser.add_argument('before_csv_infile', help='the before epoch tile csv file from make_tiff_tiles.py')
+parser.add_argument('after_csv_infile', help='the after epoch tile csv file from make_tiff_tiles.py')
+args = parser.parse_args()
+
+# use the data dir for outputs from the make tiles as inputs here
+tiled_data_dir = os.environ.get('DATA_OUT_DIR','outputs/')
+
+colnames = 'tif_file x_m_min x_m_max y_m_min y_m_max'.split()
+
+def read_tiles(csv_infile):
+    # prefer the typed tile index from make_tiff_tiles.py over re-parsing the csv text
+    index_path = tile_index.tile_index_path(tiled_data_dir, csv_infile)
+    if use_tile_index:
+        return tile_index.read_tile_index(index_path, columns=tiler.tile_table_columns)
+
+    # the make_tiff_tiles.py output doesn't have a header
+    tile_csv = pd.read_csv("%s/%s" % (tiled_data_dir, csv_infile), header=None, names=colnames)
+    return pd.concat([tile_csv, tiler.tile_grid_index(tile_csv['tif_file'])], axis=1)
+
+def is_empty(tile_pairs, epoch):
+    return tile_stats.is_empty(tile_pairs['nodata_fraction_%s' % epoch], tile_pairs['std_dev_%s' % epoch], tile_pairs['water_fraction_%s' % epoch],
+        max_nodata=args.max_nodata, min_std_dev=args.min_std_dev, max_water=args.max_water)
+
+use_tile_index = tile_index.available() \
+    and os.path.isfile(tile_index.tile_index_path(tiled_data_dir, args.before_csv_infile)) \
+    and os.path.isfile(tile_index.tile_index_path(tiled_data_dir, args.after_csv_infile))
+
+before_tiles = read_tiles(args.before_csv_infile)
+after_tiles = read_tiles(args.after_csv_infile)
+
+# pair the before and after tiles by their tile grid position
+tile_pairs = before_tiles.merge(after_tiles, on=['tile_row', 'tile_col'], how='outer', suffixes=('_before', '_after'), indicator='paired')
+unpaired = tile_pairs['paired'] != 'both'
+print("Found %d before / after tile pairs" % (~unpaired).sum())
+# keep the tiles without a partner in the other epoch, they're never culled and
+# create_manifest.py reports them as mismatched rows
+if unpaired.any():
+    print("WARNING: %d before tiles and %d after tiles have no tile in the other epoch, keeping them:" % (
+        (tile_pairs['paired'] == 'left_only').sum(), (tile_pairs['paired'] == 'right_only').sum()))
+    for tif_file_before, tif_file_after in tile_pairs.loc[unpaired, ['tif_file_before', 'tif_file_after']].values:
+        print("  %s" % (tif_file_before if pd.notnull(tif_file_before) else tif_file_after))
+
+for epoch in ['before', 'after']:
+    print("Computing the %s tile stats..." % epoch)
+    epoch_pairs = tile_pairs[tile_pairs['tif_file_%s' % epoch].notnull()]
+    tif_paths = ["%s/tiles_%s_tiff/%s" % (tiled_data_dir, epoch, tif_file) for tif_file in epoch_pairs['tif_file_%s' % epoch]]
+    epoch_stats, stats_failures = tile_stats.compute_stats(tif_paths, overview_size=args.overview_size, workers=args.workers, band_order=args.band_order)
+
+    if len(stats_failures) > 0:
+        print("ERROR: couldn't read %d %s tiles:" % (len(stats_failures), epoch))
+        for tif_path, error in stats_failures:
+            print("  %s: %s" % (tif_path, error))
+        sys.exit(1)
+
+    epoch_stats_df = pd.DataFrame([epoch_stats[tif_path] for tif_path in tif_paths], columns=tile_stats.stats_columns, index=epoch_pairs.index)
+    # the water test needs the green and nir, or the red and blue, bands
+    unknown_band_orders = [band_order for band_order in epoch_stats_df['band_order'].unique()
+        if not (set('gn').issubset(band_order) or set('rb').issubset(band_order))]
+    if len(unknown_band_orders) > 0:
+        print("WARNING: can't tell which %s bands are which (%s), so no tiles are culled as water, use --band-order" % (epoch, ', '.join(unknown_band_orders)))
+    tile_pairs = tile_pairs.join(epoch_stats_df.add_suffix('_%s' % epoch))
+
+tile_pairs['empty_before'] = is_empty(tile_pairs, 'before')
+tile_pairs['empty_after'] = is_empty(tile_pairs, 'after')
+# a tile missing from an epoch has NaN stats there, so isn't empty and its row is kept
+tile_pairs['culled'] = tile_pairs['empty_before'] & tile_pairs['empty_after']
+
+culled_pairs = tile_pairs[tile_pairs['culled']]
+num_culled = len(culled_pairs)
+culled_bytes = culled_pairs['file_bytes_before'].sum() + culled_pairs['file_bytes_after'].sum()
+print("Culled %d of %d tile pairs (%.1f%%)" % (num_culled, len(tile_pairs), 100.0 * num_culled / max(len(tile_pairs), 1)))
+print("  saves converting %d tiles (%.1f MB of tiff) and uploading %d subjects (%d media files)" % (2 * num_culled, culled_bytes / 1e6, num_culled, 2 * num_culled))
+
+stats_outfile = "%s/%s" % (tiled_data_dir, args.before_csv_infile.replace(".csv", "_tile_stats.csv"))
+tile_pairs.to_csv(stats_outfile, index=False)
+print("Wrote the tile stats to %s" % stats_outfile)
+
+if args.dry_run:
+    sys.exit(0)
+
+kept_pairs = tile_pairs[~tile_pairs['culled']]
+for epoch, csv_infile, epoch_tiles in [('before', args.before_csv_infile, before_tiles), ('after', args.after_csv_infile, after_tiles)]:
+    culled_outfile = csv_infile.replace(".csv", "_culled.csv")
+    kept_tiles = kept_pairs[kept_pairs['tif_file_%s' % epoch].notnull()]
+    epoch_columns = ['tif_file_%s' % epoch, 'x_m_min_%s' % epoch, 'x_m_max_%s' % epoch, 'y_m_min_%s' % epoch, 'y_m_max_%s' % epoch]
+    # headerless, the same as the make_tiff_tiles.py output
+    kept_tiles[epoch_columns].to_csv("%s/%s" % (tiled_data_dir, culled_outfile), header=False, index=False)
+    print("Wrote the %s tiles to keep to %s, use this with convert_tiles_to_jpg.py" % (epoch, culled_outfile))
+
+    if use_tile_index:
+        epoch_index_columns = {"%s_%s" % (column, epoch): column for column in tiler.tile_table_columns if column not in ['tile_row', 'tile_col']}
+        epoch_index_df = kept_tiles[list(epoch_index_columns.keys()) + ['tile_row', 'tile_col']].rename(columns=epoch_index_columns)
+        # the outer join makes the columns nullable, put back the epoch's own types
+        epoch_index_df = epoch_index_df[tiler.tile_table_columns].astype(epoch_tiles[tiler.tile_table_columns].dtypes.to_dict())
+        tile_index.write_tile_index(epoch_index_df, tile_index.tile_index_path(tiled_data_dir, culled_outfile))
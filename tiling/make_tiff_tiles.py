@@ -1,14 +1,14 @@
 '''
 
 make_tiff_tiles.py takes a tiff file and tiles it, plus exports some information.
-It basically runs gdal_retile.py but does so in a way that standardizes the format of filenames and folders etc
-so that you can feed this information into convert_tiles_to_jpg.py.
+It tiles the image in-process (see tiler.py) on the same grid, with the same filenames and
+the same csv output as gdal_retile.py, so that you can feed this information into convert_tiles_to_jpg.py.
 
 gdal_retile options at http://www.gdal.org/gdal_retile.html
 
 '''
 
-import sys, os
+import sys, os, json
 import numpy as np
 import pandas as pd
 import ujson
@@ -18,6 +18,8 @@ from pyproj import Proj, transform
 #import urllib
 #from PIL import ImageFile
 from PIL import Image
+import tiler
+import tile_index
 
 executable = sys.argv[0]
 
@@ -34,6 +36,18 @@ except:
     print("       image dimensions in x and y (default: x=500 y=500)")
     print("    overlap=N")
     print("       number of pixels by which you want the tiles to overlap (default: 250)")
+    print("    workers=N")
+    print("       number of processes to tile with (default: number of cpus)")
+    print("    strip=N")
+    print("       number of rows of tiles each worker reads from the image at once (default: 4)")
+    print("       lower this for very wide images if you run out of memory")
+    print("    manifest=outputs/event_name.json")
+    print("       only make the tiles that intersect the event manifest bounding_box_coords")
+    print("    buffer=N")
+    print("       with manifest=, extend the bounding box by N metres (image projection units) (default: 0)")
+    print("    pair=other_epoch_image.tif")
+    print("       tile the other epoch image in the same run on one shared pixel grid (the before image grid),")
+    print("       so the before and after tiles pair up exactly by their row / col")
     sys.exit(0)
 
 
@@ -71,6 +85,11 @@ if not os.path.exists(tiledir_tiff):
 size_x = 500
 size_y = 500
 overlap = 250
+workers = None
+rows_per_strip = 4
+event_manifest_path = None
+roi_buffer = 0
+pair_infile = None
 
 # check for other command-line arguments
 if len(sys.argv) > 3:
@@ -84,34 +103,81 @@ if len(sys.argv) > 3:
             size_y = int(arg[1])
         if (arg[0] == "overlap") | (arg[0] == "offset"):
             overlap = int(arg[1])
+        if arg[0] == "workers":
+            workers = int(arg[1])
+        if arg[0] == "strip":
+            rows_per_strip = int(arg[1])
+        if arg[0] == "manifest":
+            event_manifest_path = arg[1]
+        if arg[0] == "buffer":
+            roi_buffer = float(arg[1])
+        if arg[0] == "pair":
+            pair_infile = arg[1]
 
 # this is just for suggesting parameters in the next step
-# no magnification happens in the gdal_retile step
+# no magnification happens in the tiling step
 if size_x < 350:
     magnify = " cparams=\"-magnify\""
 else:
     magnify = ""
 
-if overlap > 0:
-    overlapstr = "-overlap %d" % overlap
-else:
-    overlapstr = ''
-
-#gdal_retile.py -v -ps 300 300 -overlap 150 -co COMPRESS=JPEG -co TILED=YES -csv st_thomas_before.csv -csvDelim "," -tileIndex st_thomas_before.shp -targetDir ./st_thomas_before_tiles_tiff/ st_thomas_before.tif
 infile_path = "%s/%s" % (data_input_dir, infile)
-retile_command = "gdal_retile.py -v -ps %d %d %s -co COMPRESS=JPEG -co TILED=YES -csv %s.csv -csvDelim \",\" -tileIndex %s.shp -targetDir %s %s" % (size_x, size_y, overlapstr, infile_stem, infile_stem, tiledir_tiff, infile_path)
+tile_stem = os.path.basename(infile_stem)
 
-print(retile_command)
-os.system(retile_command)
+def write_tile_outputs(stem, tile_rows):
+    csv_outfile = "%s/%s.csv" % (data_output_dir, stem)
+    tiler.write_tile_csv(tile_rows, csv_outfile)
+    print("Wrote %d tile coordinates to %s" % (len(tile_rows), csv_outfile))
 
-# now move the CSV file out of the tiled directory
-csv_move_command = "mv %s/%s.csv %s" % (tiledir_tiff, infile_stem, data_output_dir)
-print(csv_move_command)
-os.system(csv_move_command)
+    # and the typed tile index for the later stages to add to
+    if tile_index.available():
+        index_outfile = tile_index.tile_index_path(data_output_dir, csv_outfile)
+        tile_index.write_tile_index(tiler.tile_table(tile_rows), index_outfile)
+        print("Wrote the tile index to %s" % index_outfile)
 
+# clip the tiling to the event region of interest
+roi_bbox = None
+if event_manifest_path is not None:
+    with open(event_manifest_path, 'r') as f:
+        roi_bbox = json.load(f)['bounding_box_coords']
 
+if pair_infile is None:
+    tile_rows, tile_failures = tiler.tile_image(infile_path, tiledir_tiff, tile_stem, size_x, size_y, overlap, workers=workers, rows_per_strip=rows_per_strip, roi_bbox=roi_bbox, roi_buffer=roi_buffer)
+    write_tile_outputs(infile_stem, tile_rows)
+
+else:
+    # tile both epochs on one shared grid
+    pair_epoch_l = 'after' if epoch_l == 'before' else 'before'
+    pair_infile_stem = os.path.splitext(pair_infile)[0]
+    pair_tiledir_tiff = "%s/tiles_%s_tiff" % (data_output_dir, pair_epoch_l)
+    if not os.path.exists(pair_tiledir_tiff):
+        os.mkdir(pair_tiledir_tiff)
+
+    epochs = {
+        epoch_l: (infile_path, tiledir_tiff, infile_stem),
+        pair_epoch_l: ("%s/%s" % (data_input_dir, pair_infile), pair_tiledir_tiff, pair_infile_stem)
+    }
+    before_path, before_tiledir, before_stem = epochs['before']
+    after_path, after_tiledir, after_stem = epochs['after']
+
+    before_tile_rows, after_tile_rows, tile_failures = tiler.tile_epochs(
+        before_path, after_path, before_tiledir, after_tiledir,
+        os.path.basename(before_stem), os.path.basename(after_stem),
+        size_x, size_y, overlap, workers=workers, rows_per_strip=rows_per_strip, roi_bbox=roi_bbox, roi_buffer=roi_buffer)
+
+    write_tile_outputs(before_stem, before_tile_rows)
+    write_tile_outputs(after_stem, after_tile_rows)
+
+if len(tile_failures) > 0:
+    print("\nERROR: %d tiles failed:" % len(tile_failures))
+    for tif_file, error in tile_failures:
+        print("  %s: %s" % (tif_file, error))
+    print("Re-run the same command to retry them, tiles that already exist are skipped.")
+    sys.exit(1)
 
 print("  ... images are tiled and saved to %s/ with tiled image coordinates in %s.csv. You may want to run:\npython %s %s.csv %s%s" % (tiledir_tiff, infile_stem, executable.replace("make_tiff_tiles.py", "convert_tiles_to_jpg.py"), infile_stem, epoch_l, magnify))
+if pair_infile is not None:
+    print("  ... and for the %s images in %s/ and %s.csv:\npython %s %s.csv %s%s" % (pair_epoch_l, pair_tiledir_tiff, pair_infile_stem, executable.replace("make_tiff_tiles.py", "convert_tiles_to_jpg.py"), pair_infile_stem, pair_epoch_l, magnify))
 
 
 #by
@@ -0,0 +1,89 @@
+'''
+
+manifest.py builds the zooniverse subject manifest rows from the before and after tile
+metadata tables, for create_manifest.py and the streamed manifest of stream_event.py.
+
+'''
+
+import pandas as pd
+
+# TODO: fix the YEAR metadata input
+attribution_texts = {
+    'dg': 'DigitalGlobe Open Data Program - Creative Commons Attribution Non Commercial 4.0',
+    'planet': 'Planet Team ([YEAR]). Planet Application Program Interface: In Space For Life on Earth. San Francisco, CA. https://api.planet.com License: CC-BY-SA',
+    'sentinel': 'Copernicus Sentinel data [Year] for Sentinel data',
+    'landsat': 'USGS/NASA Landsat',
+}
+
+# the tile metadata columns used to build the manifest
+manifest_input_columns = [
+    'tif_file', 'jpg_file', 'tile_row', 'tile_col',
+    'google_maps_link', 'openstreetmap_link', 'projection_orig',
+    'lat_ctr', 'lat_max', 'lat_min', 'lon_ctr', 'lon_max', 'lon_min',
+    'x_m_ctr', 'x_m_max', 'x_m_min', 'y_m_ctr', 'y_m_max', 'y_m_min',
+    'imsize_x_pix', 'imsize_y_pix', 'tifsize_x_pix', 'tifsize_y_pix'
+]
+
+# create the metadata that will not be shown to users
+#
+# Headers that begin with "#" or "//" denote private fields that will not be
+#   visible to classifiers in the main classification interface or in the
+#   Talk discussion tool.
+#
+# Headers that begin with "!" denote fields that will not be visible to
+#    classifiers in the main classification interface but will be visible
+#    after classification in the Talk discussion tool.
+#
+# https://github.com/zooniverse/Panoptes-Front-End/blob/21cf42485929a62938112d5e2d4bca1a6702b00e/app/pages/lab/subject-set.cjsx#L212
+
+hidden_existing_output_columns = (
+    'projection_orig',
+    'lat_ctr',
+    'lat_max',
+    'lat_min',
+    'lon_ctr',
+    'lon_max',
+    'lon_min',
+    'x_m_ctr',
+    'x_m_max',
+    'x_m_min',
+    'y_m_ctr',
+    'y_m_max',
+    'y_m_min',
+    'imsize_x_pix',
+    'imsize_y_pix',
+    'tifsize_x_pix',
+    'tifsize_y_pix'
+)
+
+# add image scale coords in (put this into the convert_tiles_to_jpg.py script?)
+def calculate_km_scale(manifest_df, col_name_prefix):
+    max_col = '%s_m_max' % col_name_prefix
+    min_col = '%s_m_min' % col_name_prefix
+    return (manifest_df[max_col] - manifest_df[min_col]) / 1000
+
+def build_manifest(before_manifest_df, after_manifest_df, attribution_text):
+    '''
+    Build the manifest from the before and after tile metadata, the after rows
+    must already be lined up with the before rows (same index).
+    '''
+    # create the export data frame
+    prn_zoo_manifest = pd.DataFrame(index=before_manifest_df.index, columns=[])
+
+    # create the metadata to show to users
+    prn_zoo_manifest['jpg_file_before'] = before_manifest_df['jpg_file']
+    prn_zoo_manifest['jpg_file_after'] = after_manifest_df['jpg_file']
+    prn_zoo_manifest['tif_file_before'] = before_manifest_df['tif_file']
+    prn_zoo_manifest['tif_file_after'] = after_manifest_df['tif_file']
+    prn_zoo_manifest['google_maps_link'] = after_manifest_df['google_maps_link']
+    prn_zoo_manifest['openstreetmap_link'] = after_manifest_df['openstreetmap_link']
+    prn_zoo_manifest['attribution'] = attribution_text
+
+    prn_zoo_manifest['x_km'] = calculate_km_scale(before_manifest_df, 'x')
+    prn_zoo_manifest['y_km'] = calculate_km_scale(before_manifest_df, 'y')
+
+    for column_name in hidden_existing_output_columns:
+        metadata_header = "!%s" % column_name
+        prn_zoo_manifest[metadata_header] = before_manifest_df[column_name]
+
+    return prn_zoo_manifest
@@ -0,0 +1,96 @@
+'''
+
+pacing.py paces the subject uploads to keep the API request rate near, but under, the
+Panoptes API rate limit and sizes the subject set link batches from their measured latency.
+
+RequestPacer is a token bucket shared by the subject saves and the subject set links.
+Its rate is cut in half (and every request paused, doubling while it continues) on a rate
+limited response and creeps back up towards the max rate as the requests succeed.
+
+LinkBatchSizer grows the link batch size while the link requests come back faster than
+the target latency and shrinks it when they're slower or get rate limited.
+
+'''
+
+import time, random, threading
+
+# back off for this many seconds after a rate limited response,
+# doubling while the rate limiting continues up to the max
+initial_backoff = 1.0
+max_backoff = 60.0
+
+class RequestPacer(object):
+    '''
+    Token bucket of API requests per second shared by all the upload workers.
+    '''
+    def __init__(self, max_rate, min_rate=0.5, initial_backoff=initial_backoff, max_backoff=max_backoff):
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        # allow a burst of up to a second's worth of requests
+        self.tokens = self.max_rate
+        self.updated_at = time.time()
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.backoff = 0.0
+        self.resume_at = 0.0
+        self.rate_limited_count = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, cost=1):
+        '''
+        Block until the request can go, cost is the number of API requests it makes.
+        '''
+        while True:
+            with self.lock:
+                now = time.time()
+                self.refill(now)
+                if now >= self.resume_at and self.tokens >= min(cost, max(self.rate, 1.0)):
+                    self.tokens -= cost
+                    return
+                pause = max(self.resume_at - now, (min(cost, max(self.rate, 1.0)) - self.tokens) / self.rate)
+            time.sleep(pause)
+
+    def rate_limited(self):
+        '''
+        Halve the request rate and pause all the requests, returns the pause in seconds.
+        '''
+        with self.lock:
+            self.rate_limited_count += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.backoff = min(self.max_backoff, self.backoff * 2 if self.backoff else self.initial_backoff)
+            # jitter the pause so the workers don't all retry at once
+            self.resume_at = max(self.resume_at, time.time() + self.backoff * random.uniform(0.5, 1.0))
+            return self.backoff
+
+    def succeeded(self):
+        with self.lock:
+            self.backoff = self.backoff / 2 if self.backoff > self.initial_backoff else 0.0
+            # additive increase, about one request per second more every second's worth of requests
+            self.rate = min(self.max_rate, self.rate + 1.0 / max(self.rate, 1.0))
+
+class LinkBatchSizer(object):
+    '''
+    Link batch size from the measured link latency, between minimum and maximum.
+    '''
+    def __init__(self, initial, minimum=1, maximum=500, target_latency=5.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.size = min(self.maximum, max(self.minimum, initial))
+        self.target_latency = target_latency
+
+    def linked(self, batch_size, latency):
+        if latency > self.target_latency:
+            # aim for the target latency with the next batch
+            self.size = int(self.size * self.target_latency / latency)
+        elif batch_size >= self.size:
+            # only a full batch says the next one can be bigger
+            self.size = int(self.size * 1.5) + 1
+        self.size = min(self.maximum, max(self.minimum, self.size))
+
+    def rate_limited(self):
+        self.size = max(self.minimum, self.size // 2)
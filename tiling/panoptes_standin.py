@@ -0,0 +1,300 @@
+'''
+
+panoptes_standin.py is a local HTTP stand-in for the parts of the Panoptes API that
+upload_manifest.py uses through the panoptes_client, so the uploads can be tuned and
+benchmarked without touching the production API.
+
+It serves the sign in / oauth token endpoints, creating subjects (with media upload urls
+back to itself), uploading the media, checking and linking subjects to a subject set,
+finding and deleting objects and listing the subjects in a subject set. It has configurable
+latencies, random server errors and 429 rate limited responses, either at random or past
+a request rate.
+
+Run it on its own and point the client at it with PANOPTES_ENDPOINT, e.g.
+  python panoptes_standin.py --port 8080 --api-latency 0.2 --rate-limit 20
+  PANOPTES_ENDPOINT=http://localhost:8080 python upload_manifest.py --subject-set 1 outputs/subject_manifest.csv
+or see benchmark_upload.py which runs it in process.
+
+'''
+
+import re, json, time, random, argparse, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+def add_arguments(parser):
+    parser.add_argument('--api-latency', dest='api_latency', type=float, default=0.1, help='seconds each API request takes (default: 0.1)')
+    parser.add_argument('--media-latency', dest='media_latency', type=float, default=0.05, help='seconds each media upload takes (default: 0.05)')
+    parser.add_argument('--link-latency', dest='link_latency', type=float, default=0.1, help='seconds each subject set link request takes (default: 0.1)')
+    parser.add_argument('--link-latency-per-subject', dest='link_latency_per_subject', type=float, default=0.002, help='extra seconds per subject in a link request (default: 0.002)')
+    parser.add_argument('--jitter', dest='jitter', type=float, default=0.2, help='the latencies vary randomly by up to this fraction (default: 0.2)')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0, help='fraction of requests that fail with a 500 error (default: 0)')
+    parser.add_argument('--rate-limited-rate', dest='rate_limited_rate', type=float, default=0.0, help='fraction of API requests that get a 429 response at random (default: 0)')
+    parser.add_argument('--rate-limit', dest='rate_limit', type=float, default=0.0, help='API requests per second above which requests get a 429 response, 0 for no limit (default: 0)')
+
+class RateLimiter(object):
+    '''
+    Token bucket of API requests per second, with a burst of up to a second's worth of requests.
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class StandinState(object):
+    def __init__(self, settings):
+        self.settings = settings
+        self.rate_limiter = RateLimiter(settings.rate_limit)
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.subjects = {}
+        self.linked_subject_ids = set()
+        self.counts = {}
+
+    def new_id(self):
+        with self.lock:
+            new_id = self.next_id
+            self.next_id += 1
+            return str(new_id)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['subjects'] = len(self.subjects)
+            stats['linked_subjects'] = len(self.linked_subject_ids)
+            return stats
+
+class StandinHandler(BaseHTTPRequestHandler):
+    # keep the client connections alive like the real API
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length > 0 else b''
+
+    def send_json(self, status, body, etag=None, headers={}):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_empty(self, status, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def simulate(self, kind, latency):
+        '''
+        Sleep for the request latency and return True if the request was answered with an error.
+        '''
+        settings = self.state.settings
+        self.state.count(kind)
+        if latency > 0:
+            time.sleep(latency * random.uniform(1 - settings.jitter, 1 + settings.jitter))
+
+        if kind != 'media' and (not self.state.rate_limiter.allow() or random.random() < settings.rate_limited_rate):
+            self.state.count('rate_limited')
+            self.send_json(429, {'errors': [{'message': 'Too Many Requests (429), retry later'}]}, headers={'Retry-After': '1'})
+            return True
+        if random.random() < settings.error_rate:
+            self.state.count('server_errors')
+            self.send_json(500, {'errors': [{'message': 'Internal Server Error'}]})
+            return True
+        return False
+
+    def resource(self, resource_type, resource_id):
+        links = {}
+        if resource_type == 'subject_sets':
+            links = {'project': '1', 'subjects': []}
+            with self.state.lock:
+                linked_count = len(self.state.linked_subject_ids)
+            return {'id': resource_id, 'links': links, 'href': '/%s/%s' % (resource_type, resource_id), 'set_member_subjects_count': linked_count}
+        elif resource_type == 'subjects':
+            subject = self.state.subjects.get(resource_id)
+            if subject is not None:
+                return subject
+        return {'id': resource_id, 'links': links, 'href': '/%s/%s' % (resource_type, resource_id)}
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        settings = self.state.settings
+
+        if path == '/users/sign_in':
+            self.state.count('sign_in')
+            self.send_json(200, {}, headers={'x-csrf-token': 'standin-csrf-token'})
+            return
+
+        if path == '/api/set_member_subjects':
+            # the client checks each subject isn't in the set already before linking it
+            if self.simulate('find', settings.api_latency):
+                return
+            query = dict(parse_qsl(urlsplit(self.path).query))
+            with self.state.lock:
+                linked = query.get('subject_id') in self.state.linked_subject_ids
+            set_member_subjects = [{'id': query.get('subject_id'), 'links': {'subject': query.get('subject_id'), 'subject_set': query.get('subject_set_id')}}] if linked else []
+            self.send_json(200, {'set_member_subjects': set_member_subjects, 'meta': {'set_member_subjects': {'page': 1, 'page_count': 1}}})
+            return
+
+        if path == '/api/subjects':
+            # a page of the subjects in a subject set, for upload_manifest.py --reconcile,
+            # or in the project, for finding the subjects of interrupted uploads
+            if self.simulate('find', settings.api_latency):
+                return
+            query = dict(parse_qsl(urlsplit(self.path).query))
+            page = int(query.get('page', 1))
+            page_size = int(query.get('page_size', 20))
+            with self.state.lock:
+                if 'project_id' in query:
+                    subject_ids = [int(subject_id) for subject_id in self.state.subjects]
+                else:
+                    subject_ids = [int(subject_id) for subject_id in self.state.linked_subject_ids if subject_id in self.state.subjects]
+                subject_ids = sorted(subject_ids, reverse=query.get('sort') == '-id')
+                subjects = [dict(self.state.subjects[str(subject_id)], links=dict(self.state.subjects[str(subject_id)].get('links', {}),
+                    subject_sets=['1'] if str(subject_id) in self.state.linked_subject_ids else []))
+                    for subject_id in subject_ids[(page - 1) * page_size:page * page_size]]
+            page_count = max(1, (len(subject_ids) + page_size - 1) // page_size)
+            self.send_json(200, {'subjects': subjects, 'meta': {'subjects': {'page': page, 'page_count': page_count, 'count': len(subject_ids)}}})
+            return
+
+        match = re.match(r'^/api/(\w+)/(\d+)$', path)
+        if match is None:
+            self.send_json(404, {'errors': [{'message': 'Not found: %s' % path}]})
+            return
+        if self.simulate('find', settings.api_latency):
+            return
+        resource_type, resource_id = match.groups()
+        self.send_json(200, {resource_type: [self.resource(resource_type, resource_id)], 'meta': {resource_type: {'page': 1, 'page_count': 1}}}, etag='"%s-%s"' % (resource_type, resource_id))
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        settings = self.state.settings
+        body = self.read_body()
+
+        if path == '/users/sign_in':
+            self.state.count('sign_in')
+            self.send_json(200, {'users': [{'id': '1', 'login': 'standin'}]})
+            return
+
+        if path == '/oauth/token':
+            self.state.count('token')
+            self.send_json(200, {'access_token': 'standin-token', 'refresh_token': 'standin-refresh', 'token_type': 'Bearer', 'expires_in': 7200})
+            return
+
+        if path == '/api/subjects':
+            if self.simulate('save', settings.api_latency):
+                return
+            subject = json.loads(body.decode('utf-8'))['subjects']
+            subject_id = self.state.new_id()
+            host = self.headers.get('Host', '%s:%d' % self.server.server_address[:2])
+            subject['id'] = subject_id
+            subject['created_at'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+            subject['locations'] = [
+                {media_type: 'http://%s/media/%s/%d' % (host, subject_id, i)}
+                for i, media_type in enumerate(subject.get('locations', []))
+            ]
+            with self.state.lock:
+                self.state.subjects[subject_id] = subject
+            self.send_json(201, {'subjects': [subject]}, etag='"subjects-%s"' % subject_id)
+            return
+
+        match = re.match(r'^/api/(\w+)/(\d+)/links/(\w+)$', path)
+        if match is not None:
+            resource_type, resource_id, link_type = match.groups()
+            linked_ids = json.loads(body.decode('utf-8')).get(link_type, [])
+            if self.simulate('link', settings.link_latency + settings.link_latency_per_subject * len(linked_ids)):
+                return
+            if link_type == 'subjects':
+                with self.state.lock:
+                    self.state.linked_subject_ids.update(str(linked_id) for linked_id in linked_ids)
+            self.send_json(200, {resource_type: [self.resource(resource_type, resource_id)]})
+            return
+
+        self.send_json(404, {'errors': [{'message': 'Not found: %s' % path}]})
+
+    def do_PUT(self):
+        path = self.path.split('?')[0]
+        self.read_body()
+        if path.startswith('/media/'):
+            if self.simulate('media', self.state.settings.media_latency):
+                return
+            self.send_empty(200)
+            return
+        self.send_json(404, {'errors': [{'message': 'Not found: %s' % path}]})
+
+    def do_DELETE(self):
+        path = self.path.split('?')[0]
+        self.read_body()
+        match = re.match(r'^/api/(\w+)/(\d+)$', path)
+        if match is None:
+            self.send_json(404, {'errors': [{'message': 'Not found: %s' % path}]})
+            return
+        if self.simulate('delete', self.state.settings.api_latency):
+            return
+        resource_type, resource_id = match.groups()
+        if resource_type == 'subjects':
+            with self.state.lock:
+                self.state.subjects.pop(resource_id, None)
+        self.send_empty(204)
+
+def make_server(settings, host='127.0.0.1', port=0):
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    server.daemon_threads = True
+    server.state = StandinState(settings)
+    return server
+
+def start_server(settings, host='127.0.0.1', port=0):
+    '''
+    Start the stand-in on a background thread, returns the server and its endpoint url.
+    '''
+    server = make_server(settings, host, port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://%s:%d' % server.server_address[:2]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the Panoptes API subject upload endpoints.')
+    parser.add_argument('--host', dest='host', default='127.0.0.1', help='the address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', dest='port', type=int, default=8080, help='the port to listen on (default: 8080)')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_server(args, args.host, args.port)
+    print("Panoptes stand-in listening on http://%s:%d, use it with PANOPTES_ENDPOINT=http://%s:%d" % (server.server_address[:2] + server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("\n%s" % server.state.stats())
+        server.server_close()
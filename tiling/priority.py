@@ -0,0 +1,117 @@
+'''
+
+priority.py orders the subjects by their distance from an event priority location, either
+a point (e.g. the epicentre) or a polygon (e.g. a damage footprint), so the most useful
+imagery gets uploaded and classified first while the rest is still uploading.
+
+The great circle (haversine) distances are computed for the whole tile table at once
+over the lon_ctr / lat_ctr columns. Tiles inside a priority polygon are 0 km away.
+
+'''
+
+import json
+import numpy as np
+
+earth_radius_km = 6371.0088
+
+def add_arguments(parser):
+    parser.add_argument('--priority-point', dest='priority_point', type=parse_point, default=None, help='order the subjects by distance from this lon,lat point, e.g. the event epicentre')
+    parser.add_argument('--priority-polygon', dest='priority_polygon', default=None, help='order the subjects by distance from the polygons in this GeoJSON file, e.g. a damage footprint')
+
+def parse_point(value):
+    lon, lat = [float(coord) for coord in value.split(',')]
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        raise ValueError("%s isn't a lon,lat point" % value)
+    return lon, lat
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(coord, dtype=float)) for coord in (lon1, lat1, lon2, lat2)]
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def read_polygons(geojson_path):
+    '''
+    Read the exterior rings of the (Multi)Polygons in a GeoJSON geometry, feature
+    or feature collection file, as a list of (n, 2) lon / lat arrays.
+    '''
+    with open(geojson_path, 'r') as f:
+        geojson = json.load(f)
+
+    if geojson['type'] == 'FeatureCollection':
+        geometries = [feature['geometry'] for feature in geojson['features']]
+    elif geojson['type'] == 'Feature':
+        geometries = [geojson['geometry']]
+    else:
+        geometries = [geojson]
+
+    rings = []
+    for geometry in geometries:
+        if geometry['type'] == 'Polygon':
+            rings.append(np.asarray(geometry['coordinates'][0], dtype=float)[:, :2])
+        elif geometry['type'] == 'MultiPolygon':
+            rings.extend(np.asarray(polygon[0], dtype=float)[:, :2] for polygon in geometry['coordinates'])
+    if len(rings) == 0:
+        raise ValueError("No polygons found in %s" % geojson_path)
+    return rings
+
+def ring_edges(ring):
+    # the GeoJSON rings are closed, but don't rely on it
+    return ring, np.roll(ring, -1, axis=0)
+
+def inside_ring(lon, lat, ring):
+    # ray casting, one pass over the ring edges for all the points at once
+    inside = np.zeros(len(lon), dtype=bool)
+    for (lon_a, lat_a), (lon_b, lat_b) in zip(*ring_edges(ring)):
+        if lat_a == lat_b:
+            continue
+        crosses = ((lat_a > lat) != (lat_b > lat)) & (lon < lon_a + (lat - lat_a) * (lon_b - lon_a) / (lat_b - lat_a))
+        inside ^= crosses
+    return inside
+
+def distance_to_ring_km(lon, lat, ring):
+    # the nearest point on each edge is found on a local equirectangular plane,
+    # fine at the scale of an event, and its distance measured along the great circle
+    scale = np.cos(np.radians(lat))
+    distance = np.full(len(lon), np.inf)
+    for (lon_a, lat_a), (lon_b, lat_b) in zip(*ring_edges(ring)):
+        if lon_a == lon_b and lat_a == lat_b:
+            # the closing vertex repeats the first one
+            continue
+        edge_x = (lon_b - lon_a) * scale
+        edge_y = lat_b - lat_a
+        t = np.clip(((lon - lon_a) * scale * edge_x + (lat - lat_a) * edge_y) / (edge_x**2 + edge_y**2), 0, 1)
+        distance = np.minimum(distance, haversine_km(lon, lat, lon_a + t * (lon_b - lon_a), lat_a + t * (lat_b - lat_a)))
+    return distance
+
+def priority_distance_km(lon, lat, point=None, polygons=None):
+    '''
+    The distance in km of each lon / lat from the priority point or polygons.
+    '''
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    if point is not None:
+        return haversine_km(lon, lat, point[0], point[1])
+
+    distance = np.full(len(lon), np.inf)
+    for ring in polygons:
+        ring_distance = distance_to_ring_km(lon, lat, ring)
+        ring_distance[inside_ring(lon, lat, ring)] = 0
+        distance = np.minimum(distance, ring_distance)
+    return distance
+
+def from_args(args):
+    '''
+    The priority (point, polygons) from the parsed arguments, or None if there isn't one.
+    '''
+    if args.priority_point is not None and args.priority_polygon is not None:
+        raise ValueError("Use --priority-point or --priority-polygon, not both")
+    if args.priority_point is not None:
+        return args.priority_point, None
+    if args.priority_polygon is not None:
+        return None, read_polygons(args.priority_polygon)
+    return None
+
+def describe(args):
+    if args.priority_point is not None:
+        return "the point %.5f,%.5f" % args.priority_point
+    return "the polygons in %s" % args.priority_polygon
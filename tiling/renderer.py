@@ -0,0 +1,136 @@
+'''
+
+renderer.py turns the tiff tiles into labelled jpg subject images in-process.
+
+It replaces the generated ImageMagick script convert_tiles_to_jpg.py used to run, i.e.
+`convert tile.tif [-magnify] -gravity south ... -annotate 0 "Before" tile.jpg`, with a
+Pillow / NumPy render on a process pool so there's no process fork and ImageMagick
+start up per tile.
+
+'''
+
+import os
+import multiprocessing
+import numpy as np
+from osgeo import gdal
+from PIL import Image, ImageDraw, ImageFont
+
+gdal.UseExceptions()
+
+# match the ImageMagick annotate params we used to use
+label_font_names = ['Arial.ttf', 'arial.ttf', 'DejaVuSans.ttf']
+label_point_size = 16
+label_stroke_width = 3
+# "#000C" - black at 80% opacity
+label_stroke_fill = (0, 0, 0, 204)
+label_text_fill = (255, 255, 255, 255)
+# ImageMagick's default jpg quality when it can't work one out from the input
+jpg_quality = 92
+
+def load_label_font():
+    for font_name in label_font_names:
+        try:
+            return ImageFont.truetype(font_name, label_point_size)
+        except IOError:
+            continue
+    return ImageFont.load_default()
+
+def read_tile_image(tif_path):
+    tile_ds = gdal.Open(tif_path, gdal.GA_ReadOnly)
+    data = tile_ds.ReadAsArray()
+    tile_ds = None
+
+    # single band tiles come back as a 2d array
+    if data.ndim == 2:
+        data = data[np.newaxis, :, :]
+
+    # jpgs are 8 bit, scale down deeper images like convert does
+    if data.dtype == np.uint16:
+        data = (data >> 8).astype(np.uint8)
+    elif data.dtype != np.uint8:
+        data = np.clip(data, 0, 255).astype(np.uint8)
+
+    # jpg has no alpha, so drop anything past rgb
+    if data.shape[0] >= 3:
+        return Image.fromarray(np.ascontiguousarray(data[:3].transpose(1, 2, 0)), 'RGB')
+    return Image.fromarray(data[0], 'L').convert('RGB')
+
+def text_bbox(draw, text, font):
+    try:
+        return draw.textbbox((0, 0), text, font=font)
+    except AttributeError:
+        # older Pillow releases
+        text_width, text_height = draw.textsize(text, font=font)
+        return 0, 0, text_width, text_height
+
+def draw_label(img, label, font):
+    # bottom centre (-gravity south), a translucent black outline then white fill
+    overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    left, top, right, bottom = text_bbox(draw, label, font)
+    x = (img.size[0] - (right - left)) // 2 - left
+    y = img.size[1] - bottom - label_stroke_width - 1
+
+    # draw the outline on its own layer so overlapping strokes don't build up the opacity
+    stroke = Image.new('L', img.size, 0)
+    stroke_draw = ImageDraw.Draw(stroke)
+    for dx in range(-label_stroke_width, label_stroke_width + 1):
+        for dy in range(-label_stroke_width, label_stroke_width + 1):
+            if dx * dx + dy * dy <= label_stroke_width * label_stroke_width:
+                stroke_draw.text((x + dx, y + dy), label, font=font, fill=255)
+    overlay.paste(label_stroke_fill, None, stroke)
+    draw.text((x, y), label, font=font, fill=label_text_fill)
+
+    return Image.alpha_composite(img.convert('RGBA'), overlay).convert('RGB')
+
+def render_jpg(tif_path, jpg_path, label, magfac, font):
+    img = read_tile_image(tif_path)
+    # -magnify doubles the image size for each time it's supplied
+    if magfac > 1:
+        img = img.resize((img.size[0] * magfac, img.size[1] * magfac), Image.NEAREST)
+    img = draw_label(img, label, font)
+
+    # write to a temporary name so a failed render never leaves a partial jpg behind
+    part_path = jpg_path + '.part'
+    img.save(part_path, 'JPEG', quality=jpg_quality)
+    os.rename(part_path, jpg_path)
+
+# each pool worker loads the label font once
+render_settings = None
+
+def init_worker(label, magfac):
+    global render_settings
+    render_settings = (label, magfac, load_label_font())
+
+def render_tile(tile_paths):
+    tif_path, jpg_path = tile_paths
+    label, magfac, font = render_settings
+    try:
+        render_jpg(tif_path, jpg_path, label, magfac, font)
+        return jpg_path, None
+    except Exception as e:
+        return jpg_path, str(e)
+
+def render_tiles(tile_paths, label, magfac=1, workers=None):
+    '''
+    Render the list of (tif_path, jpg_path) tiles on a process pool.
+
+    Returns the list of (jpg_path, error) tiles that failed to render.
+    '''
+    num_tiles = len(tile_paths)
+    failures = []
+    num_done = 0
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(label, magfac))
+    try:
+        for jpg_path, error in pool.imap_unordered(render_tile, tile_paths, chunksize=16):
+            num_done += 1
+            if error is not None:
+                failures.append((jpg_path, error))
+            if num_done % 100 == 0 or num_done == num_tiles:
+                print('Jpgs done: ' + f"{num_done:,d}" + ' of ' + f"{num_tiles:,d}", end='\r')
+    finally:
+        pool.close()
+        pool.join()
+    print('')
+
+    return failures
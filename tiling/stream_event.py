@@ -0,0 +1,309 @@
+'''
+
+stream_event.py tiles, converts and uploads a before / after image pair in one streaming run,
+rather than running make_tiff_tiles.py, convert_tiles_to_jpg.py, create_manifest.py and
+upload_manifest.py one after the other, each one waiting on the whole event.
+
+The before / after tile pairs are tiled on one shared pixel grid and rendered to jpg a block
+at a time on a process pool (see tile_pipeline.py). Each finished block is added to the
+subject manifest and its subjects go through a bounded queue to the uploader, so the first
+subjects are classifiable within minutes of starting. When the uploads fall behind the queue
+fills up and the tiling waits for them. The tile pairs that are empty in both epochs are
+culled as they're cut, with the same stats and thresholds as cull_tiles.py.
+
+The uploads are journaled the same way as upload_manifest.py, re-run the same command
+to resume, the tiles and jpgs that already exist are not made again.
+
+'''
+
+import sys, os, json, time, argparse, signal, threading, queue
+import numpy as np
+import pandas as pd
+from panoptes_client import Panoptes, SubjectSet
+import tiler
+import tile_pipeline
+import tile_stats
+import manifest
+import uploader
+import upload_journal
+import pacing
+import priority
+import tile_coords
+
+# allow OS env to set a defaultS
+default_batch_size = int(os.environ.get('BATCH_SIZE',10))
+default_workers = int(os.environ.get('UPLOAD_WORKERS',4))
+data_input_dir = os.environ.get('DATA_IN_DIR','inputs/')
+data_output_dir = os.environ.get('DATA_OUT_DIR','outputs/')
+# see convert_tiles_to_jpg.py
+mapzoom = int(os.environ.get('SUBJECT_METADATA_MAP_ZOOM',15))
+
+parser = argparse.ArgumentParser(description='Tile, convert and upload a before / after image pair to the Zooniverse as one stream.')
+parser.add_argument('--source', dest='attribution_source', choices=sorted(manifest.attribution_texts.keys()), required=True)
+parser.add_argument('--subject-set', dest='subject_set_id', help='the subject set to upload the data to', required=True)
+parser.add_argument('--x', dest='size_x', type=int, default=500, help='tile width in pixels (default: 500)')
+parser.add_argument('--y', dest='size_y', type=int, default=500, help='tile height in pixels (default: 500)')
+parser.add_argument('--overlap', dest='overlap', type=int, default=250, help='number of pixels the tiles overlap by (default: 250)')
+parser.add_argument('--magnify', dest='magnify', action='count', default=0, help='double the jpg size, once for each time it is given (like convert -magnify)')
+parser.add_argument('--corners', dest='corners', type=int, choices=[2, 4], default=2, help='take the tile lat / lon bounds from the min and max (2) or all 4 corners (default: 2)')
+parser.add_argument('--event-manifest', dest='event_manifest_path', default=None, help='only make the tiles that intersect this event manifest bounding_box_coords')
+parser.add_argument('--buffer', dest='roi_buffer', type=float, default=0, help='with --event-manifest, extend the bounding box by this many metres (image projection units) (default: 0)')
+parser.add_argument('--tile-workers', dest='tile_workers', type=int, default=None, help='number of processes to tile and render with (default: number of cpus)')
+parser.add_argument('--block-rows', dest='block_rows', type=int, default=2, help='rows of tiles each tile worker reads at once (default: 2)')
+parser.add_argument('--block-cols', dest='block_cols', type=int, default=8, help='columns of tiles each tile worker reads at once (default: 8)')
+parser.add_argument('--queue-size', dest='queue_size', type=int, default=200, help='the most finished subjects to hold waiting for upload before the tiling waits (default: 200)')
+parser.add_argument('--workers', dest='workers', type=int, default=default_workers, help='the number of subjects to upload concurrently (default: 4)')
+parser.add_argument('--batch-size', dest='batch_size', type=int, default=default_batch_size, help='the number of subjects to link to the subject set at once to start with, it adapts to the link latency')
+parser.add_argument('--max-batch-size', dest='max_batch_size', type=int, default=500, help='the most subjects to link to the subject set at once (default: 500)')
+parser.add_argument('--link-latency', dest='link_latency', type=float, default=5.0, help='the target seconds per subject set link request the batch size adapts to (default: 5)')
+parser.add_argument('--max-rate', dest='max_rate', type=float, default=uploader.default_max_rate, help='the most API requests per second to make (default: %s)' % uploader.default_max_rate)
+parser.add_argument('--journal', dest='journal_name', default='upload_journal.sqlite', help='file name (in DATA_OUT_DIR) of the upload journal to resume from (default: upload_journal.sqlite)')
+parser.add_argument('--manifest-name', dest='manifest_name', default='subject_manifest.csv', help='file name (in DATA_OUT_DIR) of the subject manifest to write (default: subject_manifest.csv)')
+parser.add_argument('--no-cull', dest='cull', action='store_false', help="upload every tile pair, don't cull the ones that are empty (mostly nodata, featureless or water) in both epochs")
+parser.add_argument('--max-nodata', dest='max_nodata', type=float, default=tile_stats.default_max_nodata, help='a tile with at least this fraction of nodata pixels is empty (default: %s)' % tile_stats.default_max_nodata)
+parser.add_argument('--min-std-dev', dest='min_std_dev', type=float, default=tile_stats.default_min_std_dev, help='a tile with a lower brightness standard deviation (8 bit scale) than this is empty (default: %s)' % tile_stats.default_min_std_dev)
+parser.add_argument('--max-water', dest='max_water', type=float, default=tile_stats.default_max_water, help='a tile with at least this fraction of water pixels is empty (default: %s)' % tile_stats.default_max_water)
+parser.add_argument('--band-order', dest='band_order', type=tile_stats.parse_band_order, default=None, help="the role of each image band, r / g / b / n (near infrared) or x, e.g. bgrn for 4 band Planet analytic imagery (default: the bands' colour interpretation)")
+parser.add_argument('--admin-mode', dest='admin_mode', default=False, help='run the Zooniverse CLI in admin mode')
+parser.add_argument('before_image', help='the before epoch image (in DATA_IN_DIR)')
+parser.add_argument('after_image', help='the after epoch image (in DATA_IN_DIR)')
+priority.add_arguments(parser)
+args = parser.parse_args()
+
+attribution_text = manifest.attribution_texts[args.attribution_source]
+magfac = 2**args.magnify
+try:
+    priority_location = priority.from_args(args)
+except ValueError as e:
+    print("Error: %s" % e)
+    sys.exit(1)
+started_at = time.time()
+
+# setup access to the Zooniverse API
+username = os.environ.get('ZOONIVERSE_USERNAME')
+password = os.environ.get('ZOONIVERSE_PASSWORD')
+if not (username and password):
+    print("Missing zooniverse credentials, pass them in as environment variables")
+    sys.exit(1)
+connect_kwargs = dict(username=username, password=password, admin=args.admin_mode)
+Panoptes.connect(**connect_kwargs)
+subject_set = SubjectSet.find(args.subject_set_id)
+print("Found subject set with id: {} to upload data to.".format(subject_set.id))
+
+# setup the tile output paths, the same as the separate scripts use
+stems = {}
+tile_dirs = {}
+jpg_dirs = {}
+for epoch, image_name in zip(tile_pipeline.epochs, [args.before_image, args.after_image]):
+    stems[epoch] = os.path.splitext(os.path.basename(image_name))[0]
+    tile_dirs[epoch] = "%s/tiles_%s_tiff" % (data_output_dir, epoch)
+    jpg_dirs[epoch] = "%s/tiles_%s_jpg" % (data_output_dir, epoch)
+    for epoch_dir in [tile_dirs[epoch], jpg_dirs[epoch]]:
+        if not os.path.exists(epoch_dir):
+            os.mkdir(epoch_dir)
+
+# clip the tiling to the event region of interest
+roi_bbox = None
+if args.event_manifest_path is not None:
+    with open(args.event_manifest_path, 'r') as f:
+        roi_bbox = json.load(f)['bounding_box_coords']
+
+vrt_paths = dict(zip(tile_pipeline.epochs, tiler.common_grid_vrts(
+    "%s/%s" % (data_input_dir, args.before_image), "%s/%s" % (data_input_dir, args.after_image),
+    "%s/%s_grid.vrt" % (tile_dirs['before'], stems['before']), "%s/%s_grid.vrt" % (tile_dirs['after'], stems['after']))))
+
+geotransform, projection, tile_pairs = tile_pipeline.plan_tile_pairs(
+    vrt_paths['before'], vrt_paths['after'], stems['before'], stems['after'],
+    args.size_x, args.size_y, args.overlap, roi_bbox=roi_bbox, roi_buffer=args.roi_buffer)
+num_pairs = len(tile_pairs)
+
+# cull the empty pairs as cull_tiles.py does, more than 8 bit imagery is stretched from the whole epoch image
+cull_settings = None
+if args.cull:
+    stretches = dict((epoch, tile_stats.image_stretch(vrt_paths[epoch])) for epoch in tile_pipeline.epochs)
+    for epoch in tile_pipeline.epochs:
+        band_order = args.band_order or tile_stats.image_band_order(vrt_paths[epoch])
+        if not (set('gn').issubset(band_order) or set('rb').issubset(band_order)):
+            print("WARNING: can't tell which %s bands are which (%s), so no tiles are culled as water, use --band-order" % (epoch, band_order))
+    cull_settings = tile_pipeline.CullSettings(args.max_nodata, args.min_std_dev, args.max_water, args.band_order, tile_stats.default_overview_size, stretches)
+
+# the tiles and jpgs of a previous run are only reused if they were made the same way
+tile_settings = tiler.tile_run_settings(
+    ["%s/%s" % (data_input_dir, args.before_image), "%s/%s" % (data_input_dir, args.after_image)],
+    args.size_x, args.size_y, args.overlap, magnify=args.magnify)
+for epoch in tile_pipeline.epochs:
+    tiler.check_tile_settings(tile_dirs[epoch], stems[epoch], tile_settings, other_dirs=[jpg_dirs[epoch]])
+
+# the manifest index of every pair is its place in the grid, whatever order they finish in,
+# so the journal lines up with the manifest on a re-run
+manifest_indexes = dict(((before_tile.row, before_tile.col), index) for index, (before_tile, _) in enumerate(tile_pairs))
+jpg_files_before = pd.Series([before_tile.tif_file.replace(".tif", ".jpg") for before_tile, _ in tile_pairs])
+jpg_files_after = pd.Series([after_tile.tif_file.replace(".tif", ".jpg") for _, after_tile in tile_pairs])
+
+journal_path = "%s/%s" % (data_output_dir, args.journal_name)
+journal = upload_journal.UploadJournal(journal_path, subject_set.id)
+try:
+    journal.check_manifest(jpg_files_before)
+except upload_journal.JournalMismatchError as e:
+    print("Error: %s" % e)
+    print("Use --journal to upload this event with a new journal file.")
+    sys.exit(1)
+
+pacer = pacing.RequestPacer(args.max_rate)
+done_indexes = uploader.resume_journal(subject_set, journal, args.batch_size, pacer=pacer, jpg_files_after=jpg_files_after)
+if len(done_indexes) > 0:
+    print("Found {} uploaded subjects in the journal {}, skipping them.".format(len(done_indexes), journal_path))
+
+# handle (Ctrl+C) keyboard interrupt
+stop_requested = False
+def signal_handler(*args):
+    global stop_requested
+    if stop_requested:
+        raise SystemExit
+    print('\nYou pressed Ctrl+C! - finishing the uploads in progress and linking them, press it again to quit now')
+    stop_requested = True
+signal.signal(signal.SIGINT, signal_handler)
+
+manifest_output_path = "%s/%s" % (data_output_dir, args.manifest_name)
+subject_queue = queue.Queue(maxsize=args.queue_size)
+end_of_stream = None
+tile_failures = []
+producer_errors = []
+pairs_done = 0
+pairs_culled = 0
+
+def queue_subject(subject_row):
+    # wait for room in the queue, unless the uploads have stopped
+    while not stop_requested:
+        try:
+            subject_queue.put(subject_row, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def priority_order(blocks):
+    # start with the blocks nearest the priority location, by their nearest tile centre
+    tile_centres = [(0.5*(x_m_min + x_m_max), 0.5*(y_m_min + y_m_max)) for x_m_min, x_m_max, y_m_min, y_m_max in
+        (tiler.tile_bounds(geotransform, before_tile) for block in blocks for before_tile, _ in block)]
+    lon, lat = tile_coords.to_latlong(projection, [x for x, _ in tile_centres], [y for _, y in tile_centres])
+    priority_point, priority_polygons = priority_location
+    distance_km = priority.priority_distance_km(lon, lat, point=priority_point, polygons=priority_polygons)
+
+    block_distances = []
+    tile_start = 0
+    for block in blocks:
+        block_distances.append(distance_km[tile_start:tile_start + len(block)].min())
+        tile_start += len(block)
+    print("Streaming the tiles nearest %s first" % priority.describe(args))
+    return [blocks[block_number] for block_number in sorted(range(len(blocks)), key=lambda block_number: block_distances[block_number])]
+
+def stream_tile_pairs():
+    '''
+    Tile and render the pairs, write them to the manifest and queue their subjects for upload.
+    '''
+    global pairs_done, pairs_culled
+    write_header = True
+    blocks = tile_pipeline.group_into_blocks(tile_pairs, args.block_rows, args.block_cols)
+    if priority_location is not None:
+        blocks = priority_order(blocks)
+    try:
+        for block_results in tile_pipeline.iter_tile_pairs(vrt_paths, tile_dirs, jpg_dirs, blocks, workers=args.tile_workers, magfac=magfac, cull_settings=cull_settings):
+            pairs_done += len(block_results)
+            pairs_culled += sum(1 for _, _, _, culled in block_results if culled)
+            tile_failures.extend((before_tile.tif_file, error) for before_tile, _, error, _ in block_results if error is not None)
+            # the culled pairs are left out of the manifest and the uploads
+            done_pairs = [(before_tile, after_tile) for before_tile, after_tile, error, culled in block_results if error is None and not culled]
+            if len(done_pairs) > 0:
+                before_manifest_df = tile_pipeline.tile_metadata([before_tile for before_tile, _ in done_pairs], geotransform, projection, magfac, mapzoom, all_corners=args.corners == 4)
+                after_manifest_df = tile_pipeline.tile_metadata([after_tile for _, after_tile in done_pairs], geotransform, projection, magfac, mapzoom, all_corners=args.corners == 4)
+                block_index = [manifest_indexes[(before_tile.row, before_tile.col)] for before_tile, _ in done_pairs]
+                before_manifest_df.index = block_index
+                after_manifest_df.index = block_index
+                block_manifest = manifest.build_manifest(before_manifest_df, after_manifest_df, attribution_text)
+                if priority_location is not None:
+                    priority_point, priority_polygons = priority_location
+                    block_manifest['!priority_distance_km'] = np.round(priority.priority_distance_km(
+                        before_manifest_df['lon_ctr'], before_manifest_df['lat_ctr'], point=priority_point, polygons=priority_polygons), 3)
+
+                # the manifest is written as it goes, a block at a time
+                block_manifest.to_csv(manifest_output_path, mode='w' if write_header else 'a', header=write_header)
+                write_header = False
+
+                for index, row in block_manifest.iterrows():
+                    if index in done_indexes:
+                        continue
+                    media_files = ["%s/%s" % (jpg_dirs['before'], row['jpg_file_before']), "%s/%s" % (jpg_dirs['after'], row['jpg_file_after'])]
+                    # the pandas series of the row makes the subject metadata
+                    if not queue_subject((index, row.to_dict(), media_files)):
+                        return
+
+            print('Tile pairs done: ' + f"{pairs_done:,d}" + ' of ' + f"{num_pairs:,d}", end='\r')
+            if stop_requested:
+                return
+    except BaseException as e:
+        producer_errors.append(e)
+    finally:
+        queue_subject(end_of_stream)
+
+def queued_subjects():
+    while True:
+        try:
+            subject_row = subject_queue.get(timeout=1)
+        except queue.Empty:
+            # the tiling stopped without getting to the end of the stream
+            if not producer.is_alive():
+                return
+            continue
+        if subject_row is end_of_stream:
+            return
+        yield subject_row
+
+uploaded_subjects_count = len(done_indexes)
+def subjects_linked(batch):
+    global uploaded_subjects_count
+    if uploaded_subjects_count == len(done_indexes):
+        print("\nFirst subjects linked {:.0f} seconds after starting".format(time.time() - started_at))
+    uploaded_subjects_count += len(batch)
+    print("Uploaded and linked {} subjects".format(uploaded_subjects_count))
+
+print("Streaming %d tile pairs to the subject set with %d upload workers..." % (num_pairs, args.workers))
+producer = threading.Thread(target=stream_tile_pairs)
+producer.start()
+
+batch_sizer = pacing.LinkBatchSizer(args.batch_size, maximum=args.max_batch_size, target_latency=args.link_latency)
+try:
+    linked_count, failure = uploader.upload_subjects(
+        subject_set, subject_set.links.project, queued_subjects(), args.workers, batch_sizer, journal,
+        pacer=pacer, linked_callback=subjects_linked, connect_kwargs=connect_kwargs, stop_requested=lambda: stop_requested)
+finally:
+    # stop the tiling if the uploads stopped early
+    stop_requested = True
+    producer.join()
+journal.close()
+
+if len(producer_errors) > 0:
+    raise producer_errors[0]
+
+if failure is not None:
+    failed_index, error = failure
+    print('\nError occurred on tile pair: {} of the manifest'.format(failed_index))
+    print('Details of error: {}'.format(error))
+    print('Linked {} subjects, re-run the same command to resume'.format(linked_count))
+    sys.exit(1)
+
+if pairs_done < num_pairs:
+    print("\nStopped after {} of {} tile pairs and {} subjects, re-run the same command to resume".format(pairs_done, num_pairs, uploaded_subjects_count))
+    sys.exit(1)
+
+if pairs_culled > 0:
+    print("\nCulled {} of {} tile pairs that were empty in both epochs".format(pairs_culled, num_pairs))
+
+if len(tile_failures) > 0:
+    failures_output_path = "%s/%s_stream_failures.csv" % (data_output_dir, stems['before'])
+    pd.DataFrame(tile_failures, columns=['tif_file_before', 'error']).to_csv(failures_output_path, index=False)
+    print("\nERROR: %d tile pairs failed to tile or render, see %s" % (len(tile_failures), failures_output_path))
+    print("Re-run the same command to retry them, the tiles, jpgs and subjects already made are skipped.")
+    sys.exit(1)
+
+print("\nFinished streaming {} subjects in {:.0f} seconds, the manifest is in {}".format(uploaded_subjects_count, time.time() - started_at, manifest_output_path))
@@ -0,0 +1,152 @@
+'''
+
+subject_set_index.py indexes the subjects already in a subject set by their jpg_file_before /
+jpg_file_after metadata, so upload_manifest.py --reconcile only uploads the manifest rows that
+are missing from the set, whichever machine or run uploaded the others.
+
+The index is cached in a local json file along with the time it was fetched. Later runs page
+through the subject set's subjects newest first and stop at the first page with subjects they
+already have, then check the count against the subject set's and fetch everything again if it
+doesn't match (e.g. subjects were removed from the set, or linked long after they were created).
+
+The subjects of the uploads interrupted mid save aren't in the subject set yet, find_unlinked_subjects
+looks for them by the same metadata among the project's subjects created since they were journaled.
+
+'''
+
+import os, json, time, calendar
+from panoptes_client import Subject
+import uploader
+import pacing
+
+page_size = 100
+# seconds of leeway between the local clock and the API's subject created_at times
+clock_skew = 600
+
+class SubjectSetIndex(object):
+    def __init__(self, cache_path, subject_set_id):
+        self.cache_path = cache_path
+        self.subject_set_id = str(subject_set_id)
+        # subject id to its (jpg_file_before, jpg_file_after)
+        self.subjects = {}
+        self.fetched_at = None
+
+        if os.path.isfile(cache_path):
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+            # a cache for another subject set is just ignored and replaced
+            if cache.get('subject_set_id') == self.subject_set_id:
+                self.subjects = dict((subject_id, tuple(jpg_files)) for subject_id, jpg_files in cache['subjects'].items())
+                self.fetched_at = cache['fetched_at']
+
+    def save(self):
+        part_path = self.cache_path + '.part'
+        with open(part_path, 'w') as f:
+            json.dump({
+                'subject_set_id': self.subject_set_id,
+                'fetched_at': self.fetched_at,
+                'subjects': dict((subject_id, list(jpg_files)) for subject_id, jpg_files in self.subjects.items()),
+            }, f)
+        os.rename(part_path, self.cache_path)
+
+    def add(self, subject_id, jpg_file_before, jpg_file_after):
+        self.subjects[str(subject_id)] = (jpg_file_before, jpg_file_after)
+
+    def fetch_page(self, page, pacer):
+        params = {'subject_set_id': self.subject_set_id, 'page': page, 'page_size': page_size, 'sort': '-id'}
+        (response, _), _ = uploader.with_backoff(pacer, 1, Subject.http_get, '', params)
+        page_count = response.get('meta', {}).get('subjects', {}).get('page_count', 1)
+        return response.get('subjects', []), page_count
+
+    def refresh(self, subject_set, pacer=None):
+        '''
+        Fetch the subjects added to the subject set since the index was cached (or all of them
+        the first time). Returns the number of subjects fetched that weren't in the index.
+        '''
+        if pacer is None:
+            pacer = pacing.RequestPacer(uploader.default_max_rate)
+        started_at = time.time()
+        incremental = len(self.subjects) > 0
+        fetched = {}
+        page = 1
+        while True:
+            raw_subjects, page_count = self.fetch_page(page, pacer)
+            subject_ids = [int(raw_subject['id']) for raw_subject in raw_subjects]
+            if page == 1 and subject_ids != sorted(subject_ids, reverse=True):
+                # the API didn't return them newest first, so we can't stop early
+                incremental = False
+            for raw_subject in raw_subjects:
+                metadata = raw_subject.get('metadata') or {}
+                fetched[str(raw_subject['id'])] = (metadata.get('jpg_file_before'), metadata.get('jpg_file_after'))
+            print('Subject set pages fetched: ' + f"{page:,d}" + ' of ' + f"{page_count:,d}", end='\r')
+            if incremental and any(str(subject_id) in self.subjects for subject_id in subject_ids):
+                break
+            if page >= page_count:
+                break
+            page += 1
+        print('')
+
+        new_count = len(set(fetched) - set(self.subjects))
+        subjects = dict(self.subjects) if incremental else {}
+        subjects.update(fetched)
+
+        # the subject set keeps a count of its subjects, if the index doesn't match it start again
+        set_member_subjects_count = subject_set.set_member_subjects_count
+        if incremental and set_member_subjects_count is not None and len(subjects) != int(set_member_subjects_count):
+            print("The cached index has {} subjects and the subject set {}, fetching them all again.".format(len(subjects), set_member_subjects_count))
+            self.subjects = {}
+            return self.refresh(subject_set, pacer)
+
+        self.subjects = subjects
+        self.fetched_at = started_at
+        return new_count
+
+    def by_jpg_files(self):
+        '''
+        Return a dict of (jpg_file_before, jpg_file_after) to a subject id with that
+        metadata, and the number of duplicate subjects with the same metadata.
+        '''
+        subject_ids = {}
+        duplicate_count = 0
+        # the oldest subject wins, if there are duplicates
+        for subject_id in sorted(self.subjects.keys(), key=int):
+            jpg_files = self.subjects[subject_id]
+            if jpg_files in subject_ids:
+                duplicate_count += 1
+            else:
+                subject_ids[jpg_files] = subject_id
+        return subject_ids, duplicate_count
+
+def created_time(raw_subject):
+    # the API times are UTC, e.g. 2024-01-31T12:00:00.000Z
+    return calendar.timegm(time.strptime(raw_subject['created_at'][:19], '%Y-%m-%dT%H:%M:%S'))
+
+def find_unlinked_subjects(project_id, jpg_files, since, pacer=None):
+    '''
+    Find the subjects created in the project since the unix time since that aren't in any
+    subject set, for jpg_files a dict of the manifest index to its (jpg_file_before, jpg_file_after),
+    with jpg_file_after None to match any. Returns a dict of the manifest index to its subject ids.
+    '''
+    if pacer is None:
+        pacer = pacing.RequestPacer(uploader.default_max_rate)
+    indexes = dict((jpg_file_before, (index, jpg_file_after)) for index, (jpg_file_before, jpg_file_after) in jpg_files.items())
+    found = {}
+    page = 1
+    while True:
+        params = {'project_id': project_id, 'page': page, 'page_size': page_size, 'sort': '-id'}
+        (response, _), _ = uploader.with_backoff(pacer, 1, Subject.http_get, '', params)
+        raw_subjects = response.get('subjects', [])
+        for raw_subject in raw_subjects:
+            if (raw_subject.get('links') or {}).get('subject_sets'):
+                continue
+            metadata = raw_subject.get('metadata') or {}
+            index, jpg_file_after = indexes.get(metadata.get('jpg_file_before'), (None, None))
+            if index is not None and jpg_file_after in (None, metadata.get('jpg_file_after')):
+                found.setdefault(index, []).append(str(raw_subject['id']))
+        page_count = response.get('meta', {}).get('subjects', {}).get('page_count', 1)
+        # newest first, so stop at the subjects created before the uploads started
+        created_times = [created_time(raw_subject) for raw_subject in raw_subjects if raw_subject.get('created_at')]
+        if page >= page_count or (len(created_times) > 0 and min(created_times) < since - clock_skew):
+            break
+        page += 1
+    return found
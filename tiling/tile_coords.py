@@ -0,0 +1,97 @@
+'''
+
+tile_coords.py converts the tile table extents from the image projection to lat / lon and
+builds the map link columns, for the whole table at once.
+
+The projection transform is done in one batched call over NumPy arrays, with the pyproj
+Transformer cached per projection, and the links are built with vectorized string ops,
+rather than calling pyproj and formatting a url once per tile.
+
+'''
+
+import functools
+import numpy as np
+import pyproj
+
+# pyproj >= 2 has Transformer, the older releases only have the transform function
+try:
+    from pyproj import Transformer
+except ImportError:
+    Transformer = None
+
+latlong_projection = 'epsg:4326'
+
+def projection(projection_string):
+    # if you're supplying anything with a colon like 'epsg:32619', you need init= on old pyproj.
+    # if you are supplying something more like '+proj=utm +zone=19 +datum=WGS84 +units=m +no_defs ', which comes from e.g. gdal, using init= will crash things
+    # even though those two strings represent the same projection
+    try:
+        return pyproj.Proj(projection_string)
+    except Exception:
+        return pyproj.Proj(init=projection_string)
+
+@functools.lru_cache(maxsize=None)
+def get_transform_function(projection_in):
+    # returns a function taking x, y arrays in projection_in to lon, lat arrays
+    if Transformer is not None:
+        transformer = Transformer.from_crs(projection_in, latlong_projection, always_xy=True)
+        return transformer.transform
+
+    in_proj = projection(projection_in)
+    out_proj = projection(latlong_projection)
+    return functools.partial(pyproj.transform, in_proj, out_proj)
+
+def to_latlong(projection_in, x, y):
+    transform_function = get_transform_function(projection_in)
+    return transform_function(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+
+def add_latlong_columns(tileparams, projection_in, all_corners=False):
+    '''
+    Add the lon_min, lon_max, lat_min, lat_max columns for the x_m_* / y_m_* tile extents.
+
+    By default only the min and max corners are converted. The projected grid (e.g. UTM)
+    isn't aligned with lat / lon, so use all_corners to take the lat / lon bounds of all
+    four tile corners instead.
+    '''
+    x_min = tileparams['x_m_min'].values
+    x_max = tileparams['x_m_max'].values
+    y_min = tileparams['y_m_min'].values
+    y_max = tileparams['y_m_max'].values
+
+    if all_corners:
+        # convert the 4 corners of every tile in one call
+        corner_x = np.concatenate([x_min, x_max, x_min, x_max])
+        corner_y = np.concatenate([y_min, y_min, y_max, y_max])
+        lon, lat = to_latlong(projection_in, corner_x, corner_y)
+        lon = np.asarray(lon).reshape(4, -1)
+        lat = np.asarray(lat).reshape(4, -1)
+        tileparams['lon_min'] = lon.min(axis=0)
+        tileparams['lon_max'] = lon.max(axis=0)
+        tileparams['lat_min'] = lat.min(axis=0)
+        tileparams['lat_max'] = lat.max(axis=0)
+    else:
+        lon, lat = to_latlong(projection_in, np.concatenate([x_min, x_max]), np.concatenate([y_min, y_max]))
+        lon = np.asarray(lon).reshape(2, -1)
+        lat = np.asarray(lat).reshape(2, -1)
+        tileparams['lon_min'] = lon[0]
+        tileparams['lon_max'] = lon[1]
+        tileparams['lat_min'] = lat[0]
+        tileparams['lat_max'] = lat[1]
+
+    tileparams['lon_ctr'] = 0.5*(tileparams['lon_min'] + tileparams['lon_max'])
+    tileparams['lat_ctr'] = 0.5*(tileparams['lat_min'] + tileparams['lat_max'])
+
+    return tileparams
+
+def add_map_link_columns(tileparams, mapzoom):
+    lat_ctr = np.char.mod('%.7f', tileparams['lat_ctr'].values)
+    lon_ctr = np.char.mod('%.7f', tileparams['lon_ctr'].values)
+    zoom = '%d' % int(mapzoom)
+
+    gmaps = np.char.add(np.char.add(np.char.add("https://www.google.com/maps/@", lat_ctr), ","), lon_ctr)
+    tileparams['google_maps_link'] = np.char.add(gmaps, "," + zoom + "z").astype(object)
+
+    osm = np.char.add(np.char.add("http://www.openstreetmap.org/#map=" + zoom + "/", lat_ctr), "/")
+    tileparams['openstreetmap_link'] = np.char.add(osm, lon_ctr).astype(object)
+
+    return tileparams
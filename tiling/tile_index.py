@@ -0,0 +1,77 @@
+'''
+
+tile_index.py reads and writes the tile index, a typed columnar (Arrow / Feather) table of
+the tiles that is passed between the tiling stages instead of re-parsing csv text.
+
+make_tiff_tiles.py writes it with the tile names, extents, grid row / col and pixel sizes,
+convert_tiles_to_jpg.py appends the lat / lon, jpg and link columns and create_manifest.py
+reads just the columns it needs from it. The files are uncompressed so they can be memory
+mapped, and carry a format version in their schema metadata.
+
+The csv files are still written alongside for anything else that reads them, and
+subject_manifest.csv is still the final export for the Zooniverse upload.
+
+'''
+
+import os
+
+# pyarrow is optional, without it the stages hand off through the csv files
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+tile_index_version = 1
+version_metadata_key = b'tprn_tile_index_version'
+
+class TileIndexVersionError(Exception):
+    """Raised when the tile index file was written by an unknown version of these scripts"""
+    pass
+
+def available():
+    return pa is not None
+
+def tile_index_path(data_dir, csv_file):
+    # outputs/roi_before.csv or roi_before_extra.csv -> outputs/roi_before_tiles.feather
+    stem = os.path.basename(csv_file).replace("_extra.csv", "").replace(".csv", "")
+    return "%s/%s_tiles.feather" % (data_dir, stem)
+
+def write_tile_index(tiles_df, index_path):
+    table = pa.Table.from_pandas(tiles_df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[version_metadata_key] = str(tile_index_version).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    # write to a temporary name so readers never see a partial index
+    part_path = index_path + '.part'
+    feather.write_feather(table, part_path, compression='uncompressed')
+    os.replace(part_path, index_path)
+
+def read_tile_index_table(index_path, columns=None):
+    table = feather.read_table(index_path, columns=columns, memory_map=True)
+    metadata = table.schema.metadata or {}
+    version = int(metadata.get(version_metadata_key, b'0'))
+    if version != tile_index_version:
+        raise TileIndexVersionError("%s is tile index version %d, expected version %d" % (index_path, version, tile_index_version))
+    return table
+
+def read_tile_index(index_path, columns=None):
+    '''
+    Read the tile index as a data frame, only reading the columns listed if columns is given.
+    '''
+    return read_tile_index_table(index_path, columns).to_pandas()
+
+def append_columns(index_path, columns_df):
+    '''
+    Add (or replace) the columns of columns_df, with the rows in the same order, to the tile index.
+    '''
+    table = read_tile_index_table(index_path)
+    if len(columns_df) != table.num_rows:
+        raise ValueError("Can't add %d rows of columns to the %d row tile index %s" % (len(columns_df), table.num_rows, index_path))
+
+    tiles_df = table.to_pandas()
+    table = None
+    for column_name in columns_df.columns:
+        tiles_df[column_name] = columns_df[column_name].values
+    write_tile_index(tiles_df, index_path)
@@ -0,0 +1,164 @@
+'''
+
+tile_pipeline.py tiles the before and after images on their shared pixel grid and renders
+the labelled jpgs of each tile pair in the same worker, handing the finished pairs back a
+block at a time, so stream_event.py can put them in the manifest and upload them while
+the rest of the event is still being tiled.
+
+Each pool worker reads a small block of the grid (a few tile rows high and a few tiles
+wide) from both epochs, cuts the tiles out of memory (see tiler.py) and renders them
+(see renderer.py). The first subjects are ready in seconds rather than after the
+whole of both mosaics has been tiled and converted.
+
+With cull settings the pairs that are empty in both epochs (see cull_tiles.py) are
+left out as they're cut, so they're not rendered or uploaded.
+
+'''
+
+import os, signal, collections
+import multiprocessing
+from osgeo import gdal, osr
+import tiler
+import tile_stats
+import renderer
+import tile_coords
+
+gdal.UseExceptions()
+
+epochs = ['before', 'after']
+
+# the tile_stats thresholds for an empty tile, the band order override and the stats overview
+# size, and the (black, white) stretch of each epoch (None for 8 bit imagery)
+CullSettings = collections.namedtuple('CullSettings', ['max_nodata', 'min_std_dev', 'max_water', 'band_order', 'overview_size', 'stretches'])
+
+def plan_tile_pairs(before_vrt_path, after_vrt_path, before_stem, after_stem, size_x, size_y, overlap, roi_bbox=None, roi_buffer=0):
+    '''
+    Lay out the before / after tile pairs on the shared grid of the common_grid_vrts.
+
+    Returns the grid geotransform, its proj4 projection string and the list of
+    (before_tile, after_tile) pairs in grid order, clipped to the region of interest.
+    '''
+    grid = gdal.Open(before_vrt_path, gdal.GA_ReadOnly)
+    geotransform = grid.GetGeoTransform()
+    grid_srs = osr.SpatialReference()
+    grid_srs.ImportFromWkt(grid.GetProjection())
+    projection = grid_srs.ExportToProj4()
+
+    before_tiles = tiler.tile_grid(grid.RasterXSize, grid.RasterYSize, size_x, size_y, overlap, before_stem)
+    after_tiles = tiler.tile_grid(grid.RasterXSize, grid.RasterYSize, size_x, size_y, overlap, after_stem)
+    print("Tiling both epochs on a shared %d x %d pixel grid" % (grid.RasterXSize, grid.RasterYSize))
+    # both epochs share the grid, so clip the before tiles and keep their pairs
+    roi_tiles = set(tiler.clip_to_roi(before_tiles, grid, roi_bbox, roi_buffer))
+    grid = None
+
+    tile_pairs = [(before_tile, after_tile) for before_tile, after_tile in zip(before_tiles, after_tiles) if before_tile in roi_tiles]
+    return geotransform, projection, tile_pairs
+
+def group_into_blocks(tile_pairs, rows_per_block, cols_per_block):
+    # small blocks of neighbouring pairs, in grid order, so the first ones finish quickly
+    blocks = {}
+    for before_tile, after_tile in tile_pairs:
+        block_key = ((before_tile.row - 1) // rows_per_block, (before_tile.col - 1) // cols_per_block)
+        blocks.setdefault(block_key, []).append((before_tile, after_tile))
+    return [blocks[key] for key in sorted(blocks.keys())]
+
+# each pool worker keeps its own handles on both epoch grids and the label font
+pipeline_settings = None
+
+def init_worker(vrt_paths, tile_dirs, jpg_dirs, creation_options, magfac, cull_settings):
+    global pipeline_settings
+    # the main process handles Ctrl+C, finishing the blocks in progress
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sources = dict((epoch, gdal.Open(vrt_paths[epoch], gdal.GA_ReadOnly)) for epoch in epochs)
+    pipeline_settings = (sources, tile_dirs, jpg_dirs, creation_options, magfac, cull_settings, renderer.load_label_font())
+
+def tile_is_empty(tif_path, epoch, cull_settings):
+    data, band_nodata, band_order = tile_stats.read_tile_data(tif_path, cull_settings.overview_size)
+    nodata_fraction, std_dev, water_fraction = tile_stats.compute_tile_stats(
+        data, band_nodata, cull_settings.band_order or band_order, cull_settings.stretches[epoch])
+    return tile_stats.is_empty(nodata_fraction, std_dev, water_fraction,
+        max_nodata=cull_settings.max_nodata, min_std_dev=cull_settings.min_std_dev, max_water=cull_settings.max_water)
+
+def process_block(block):
+    '''
+    Tile and render both epochs of a block of (before_tile, after_tile) pairs.
+    Returns a list of (before_tile, after_tile, error, culled) with error None for the
+    finished pairs and culled True for the pairs left out as empty.
+    '''
+    sources, tile_dirs, jpg_dirs, creation_options, magfac, cull_settings, font = pipeline_settings
+    errors = {}
+    for epoch_index, epoch in enumerate(epochs):
+        epoch_tiles = [tile_pair[epoch_index] for tile_pair in block]
+        for tile, error in tiler.cut_tiles(sources[epoch], epoch_tiles, tile_dirs[epoch], creation_options):
+            if error is not None:
+                errors.setdefault((tile.row, tile.col), "%s %s" % (epoch, error))
+
+    # a pair is only culled if both epochs are empty, as cull_tiles.py does
+    culled = set()
+    if cull_settings is not None:
+        for tile_pair in block:
+            pair_key = (tile_pair[0].row, tile_pair[0].col)
+            if pair_key in errors:
+                continue
+            try:
+                if all(tile_is_empty(os.path.join(tile_dirs[epoch], tile.tif_file), epoch, cull_settings) for epoch, tile in zip(epochs, tile_pair)):
+                    culled.add(pair_key)
+            except Exception as e:
+                errors[pair_key] = "failed to compute the tile stats: %s" % e
+
+    for epoch_index, epoch in enumerate(epochs):
+        for tile_pair in block:
+            tile = tile_pair[epoch_index]
+            pair_key = (tile.row, tile.col)
+            if pair_key in errors or pair_key in culled:
+                continue
+            # don't redo the jpgs from a previous (partial) run either
+            jpg_path = os.path.join(jpg_dirs[epoch], tile.tif_file.replace(".tif", ".jpg"))
+            if os.path.isfile(jpg_path):
+                continue
+            try:
+                renderer.render_jpg(os.path.join(tile_dirs[epoch], tile.tif_file), jpg_path, epoch.capitalize(), magfac, font)
+            except Exception as e:
+                errors[pair_key] = "%s failed to render %s: %s" % (epoch, jpg_path, e)
+    return [(before_tile, after_tile, errors.get((before_tile.row, before_tile.col)), (before_tile.row, before_tile.col) in culled)
+        for before_tile, after_tile in block]
+
+def iter_tile_pairs(vrt_paths, tile_dirs, jpg_dirs, blocks, workers=None, magfac=1, creation_options=tiler.default_creation_options, cull_settings=None):
+    '''
+    Process the blocks of tile pairs on a process pool, yielding the list of
+    (before_tile, after_tile, error, culled) of each block in order as it's done.
+    The empty pairs are only culled with cull_settings (a CullSettings).
+
+    Only a couple of blocks per worker are started ahead of the ones yielded, so the
+    tiling keeps pace with whatever is consuming the pairs.
+    '''
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    max_pending = workers * 2
+    pending = collections.deque()
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(vrt_paths, tile_dirs, jpg_dirs, creation_options, magfac, cull_settings))
+    try:
+        for block in blocks:
+            pending.append(pool.apply_async(process_block, (block,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        # the blocks still in progress when the consumer stops are redone on a re-run
+        pool.terminate()
+        pool.join()
+
+def tile_metadata(tiles, geotransform, projection, magfac, mapzoom, all_corners=False):
+    '''
+    The tile metadata table (as convert_tiles_to_jpg.py makes) for a list of tiles on the grid.
+    '''
+    tileparams = tiler.tile_table([tiler.tile_table_row(tile, tiler.tile_bounds(geotransform, tile)) for tile in tiles])
+    tileparams['x_m_ctr'] = 0.5*(tileparams['x_m_min'] + tileparams['x_m_max'])
+    tileparams['y_m_ctr'] = 0.5*(tileparams['y_m_min'] + tileparams['y_m_max'])
+    tileparams['projection_orig'] = projection
+    tileparams['jpg_file'] = tileparams['tif_file'].str.replace(".tif", ".jpg", regex=False)
+    tileparams = tile_coords.add_latlong_columns(tileparams, projection, all_corners=all_corners)
+    tileparams['imsize_x_pix'] = magfac * tileparams['tifsize_x_pix']
+    tileparams['imsize_y_pix'] = magfac * tileparams['tifsize_y_pix']
+    return tile_coords.add_map_link_columns(tileparams, mapzoom)
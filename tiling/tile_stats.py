@@ -0,0 +1,232 @@
+'''
+
+tile_stats.py computes per tile image statistics used to cull empty tiles, i.e. how much
+of the tile is nodata, how much texture there is and how much of it looks like water.
+
+The statistics are vectorized NumPy over the decoded tile, or over a low resolution
+overview of it so only a fraction of the pixels have to be decoded.
+
+The thresholds are on the 8 bit scale. Imagery with more bits (e.g. 12 bit data stored as
+uint16) or floats is stretched onto it from the 2 - 98 percentiles of its valid pixel values,
+taken over the whole image (a sample of every tile), not each tile, so a flat tile stays flat
+and water stays darker than land. The band roles (red, green, blue, near infrared) come from
+the GDAL colour interpretation of the bands, or a band order like 'bgrn'.
+
+'''
+
+import os, argparse
+import multiprocessing
+import numpy as np
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+# water heuristic for rgb only imagery (on the 8 bit scale),
+# water is dark and bluer than it is red
+water_max_brightness = 90
+
+stats_columns = ['nodata_fraction', 'std_dev', 'water_fraction', 'file_bytes', 'band_order']
+
+# the band order letters, anything else (x) is ignored
+color_interpretation_letters = {'Red': 'r', 'Green': 'g', 'Blue': 'b', 'NIR': 'n'}
+band_order_letters = 'rgbnx'
+
+# the default thresholds for an empty tile, see cull_tiles.py
+default_max_nodata = 0.95
+default_min_std_dev = 2.0
+default_max_water = 0.98
+default_overview_size = 128
+
+# the value percentiles stretched to 0 and 255, and the values sampled from each tile for them
+stretch_percentiles = (2, 98)
+stretch_sample_size = 256
+
+def parse_band_order(value):
+    # the --band-order argument type
+    band_order = value.lower()
+    if any(letter not in band_order_letters for letter in band_order):
+        raise argparse.ArgumentTypeError("band order %s can only have the letters %s" % (value, band_order_letters))
+    return band_order
+
+def tile_band_order(tile_ds):
+    # one letter per band from its colour interpretation, x if it isn't r / g / b / nir
+    return ''.join(color_interpretation_letters.get(gdal.GetColorInterpretationName(tile_ds.GetRasterBand(band_num).GetColorInterpretation()), 'x')
+        for band_num in range(1, tile_ds.RasterCount + 1))
+
+def read_tile_data(tif_path, overview_size):
+    tile_ds = gdal.Open(tif_path, gdal.GA_ReadOnly)
+    band_nodata = [tile_ds.GetRasterBand(band_num).GetNoDataValue() for band_num in range(1, tile_ds.RasterCount + 1)]
+    band_order = tile_band_order(tile_ds)
+
+    if overview_size and max(tile_ds.RasterXSize, tile_ds.RasterYSize) > overview_size:
+        # gdal uses the image overviews if it has them, otherwise it decimates on read
+        scale = float(overview_size) / max(tile_ds.RasterXSize, tile_ds.RasterYSize)
+        buf_xsize = max(1, int(round(tile_ds.RasterXSize * scale)))
+        buf_ysize = max(1, int(round(tile_ds.RasterYSize * scale)))
+        data = tile_ds.ReadAsArray(buf_xsize=buf_xsize, buf_ysize=buf_ysize)
+    else:
+        data = tile_ds.ReadAsArray()
+    tile_ds = None
+
+    # single band tiles come back as a 2d array
+    if data.ndim == 2:
+        data = data[np.newaxis, :, :]
+
+    return data, band_nodata, band_order
+
+def nodata_mask(data, band_nodata):
+    # nodata pixels have every band set to the nodata value,
+    # without a nodata value treat the black (all 0) collar as nodata
+    nodata_values = np.array([0 if value is None else value for value in band_nodata], dtype=float)[:, np.newaxis, np.newaxis]
+    band_is_nodata = data == nodata_values
+    if np.issubdtype(data.dtype, np.floating):
+        band_is_nodata |= np.isnan(data) & np.isnan(nodata_values)
+    return np.all(band_is_nodata, axis=0)
+
+def value_sample(data, band_nodata, sample_size=stretch_sample_size):
+    # an evenly spaced sample of the valid pixel values (of all the bands)
+    valid_values = data[:, ~nodata_mask(data, band_nodata)].ravel()
+    step = max(1, len(valid_values) // sample_size)
+    return valid_values[::step][:sample_size].astype(np.float64)
+
+def value_stretch(values):
+    # the (black, white) values to stretch to 0 - 255, None if there are no values
+    if len(values) == 0:
+        return None
+    black, white = np.percentile(values, stretch_percentiles)
+    return float(black), float(white)
+
+def image_stretch(image_path, overview_size=1024):
+    # the stretch of a whole image (e.g. an epoch's grid vrt) from a low resolution read of it, None for 8 bit imagery
+    data, band_nodata, _ = read_tile_data(image_path, overview_size)
+    if data.dtype == np.uint8:
+        return None
+    return value_stretch(value_sample(data, band_nodata, sample_size=data[0].size))
+
+def image_band_order(image_path):
+    image_ds = gdal.Open(image_path, gdal.GA_ReadOnly)
+    return tile_band_order(image_ds)
+
+def compute_tile_stats(data, band_nodata, band_order='', stretch=None):
+    '''
+    Return the (nodata_fraction, std_dev, water_fraction) of a tile's (bands, y, x) data,
+    with the valid values stretched from (black, white) to 0 - 255 if stretch is given and
+    band_order the role of each band (see tile_band_order).
+    '''
+    tile_nodata_mask = nodata_mask(data, band_nodata)
+    num_valid = int(np.count_nonzero(~tile_nodata_mask))
+    nodata_fraction = 1.0 - float(num_valid) / tile_nodata_mask.size
+
+    if num_valid == 0:
+        return nodata_fraction, 0.0, 0.0
+
+    valid = data[:, ~tile_nodata_mask].astype(np.float32)
+    if stretch is not None:
+        black, white = stretch
+        valid = np.clip((valid - black) * (255.0 / max(white - black, 1e-6)), 0, 255)
+
+    # 3 bands without roles are rgb, as a tiff reads them
+    if valid.shape[0] == 3 and set(band_order) <= set('x'):
+        band_order = 'rgb'
+
+    # the first band of each role
+    bands = {}
+    for band_index, letter in enumerate(band_order[:valid.shape[0]]):
+        if letter != 'x' and letter not in bands:
+            bands[letter] = valid[band_index]
+
+    if all(letter in bands for letter in 'rgb'):
+        brightness = (bands['r'] + bands['g'] + bands['b']) / 3.0
+    else:
+        brightness = valid[:3].mean(axis=0)
+    std_dev = float(brightness.std())
+
+    if 'g' in bands and 'n' in bands:
+        # the ndwi
+        water_mask = (bands['g'] - bands['n']) > 0
+    elif 'r' in bands and 'b' in bands:
+        water_mask = (bands['b'] > bands['r']) & (brightness < water_max_brightness)
+    else:
+        # without the band roles there's no telling water apart
+        water_mask = np.zeros(brightness.shape, dtype=bool)
+    water_fraction = float(np.count_nonzero(water_mask)) / num_valid
+
+    return nodata_fraction, std_dev, water_fraction
+
+def is_empty(nodata_fraction, std_dev, water_fraction, max_nodata=default_max_nodata, min_std_dev=default_min_std_dev, max_water=default_max_water):
+    # the stats can be single values or (pandas) columns of them
+    return (nodata_fraction >= max_nodata) | (std_dev < min_std_dev) | (water_fraction >= max_water)
+
+# each pool worker gets the overview size and band order once
+stats_settings = None
+
+def init_worker(overview_size, band_order):
+    global stats_settings
+    stats_settings = (overview_size, band_order)
+
+def tile_sample(tif_path):
+    overview_size, _ = stats_settings
+    try:
+        data, band_nodata, _ = read_tile_data(tif_path, overview_size)
+        return tif_path, value_sample(data, band_nodata), None
+    except Exception as e:
+        return tif_path, None, str(e)
+
+def tile_stats(tif_path_stretch):
+    tif_path, stretch = tif_path_stretch
+    overview_size, band_order = stats_settings
+    try:
+        data, band_nodata, tile_band_order = read_tile_data(tif_path, overview_size)
+        band_order = band_order or tile_band_order
+        nodata_fraction, std_dev, water_fraction = compute_tile_stats(data, band_nodata, band_order, stretch)
+        return tif_path, (nodata_fraction, std_dev, water_fraction, os.path.getsize(tif_path), band_order), None
+    except Exception as e:
+        return tif_path, None, str(e)
+
+def tiles_need_stretch(tif_paths):
+    # the tiles of an image all have its data type, 8 bit is already on the scale of the thresholds
+    try:
+        tile_ds = gdal.Open(tif_paths[0], gdal.GA_ReadOnly)
+        return gdal.GetDataTypeName(tile_ds.GetRasterBand(1).DataType) != 'Byte'
+    except Exception:
+        # the stats pass reports the tiles it can't read
+        return False
+
+def compute_stats(tif_paths, overview_size=None, workers=None, band_order=None):
+    '''
+    Compute the stats for the list of tif_paths on a process pool, with the band roles from
+    band_order (e.g. 'bgrn') or else the colour interpretation of the tile bands.
+
+    Returns a dict of tif_path to (nodata_fraction, std_dev, water_fraction, file_bytes, band_order)
+    and the list of (tif_path, error) tiles that couldn't be read.
+    '''
+    num_tiles = len(tif_paths)
+    stats = {}
+    failures = []
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(overview_size, band_order))
+    try:
+        # sample all the tiles first for the stretch of more than 8 bit imagery
+        stretch = None
+        if tiles_need_stretch(tif_paths):
+            samples = []
+            for tif_path, sample, error in pool.imap_unordered(tile_sample, tif_paths, chunksize=16):
+                if error is None:
+                    samples.append(sample)
+            stretch = value_stretch(np.concatenate(samples) if len(samples) > 0 else [])
+            if stretch is not None:
+                print("Stretching the tile values %g - %g to the 8 bit scale" % stretch)
+
+        for tif_path, tif_stats, error in pool.imap_unordered(tile_stats, [(tif_path, stretch) for tif_path in tif_paths], chunksize=16):
+            if error is None:
+                stats[tif_path] = tif_stats
+            else:
+                failures.append((tif_path, error))
+            num_done = len(stats) + len(failures)
+            if num_done % 100 == 0 or num_done == num_tiles:
+                print('Tiles checked: ' + f"{num_done:,d}" + ' of ' + f"{num_tiles:,d}", end='\r')
+    finally:
+        pool.close()
+        pool.join()
+    print('')
+
+    return stats, failures
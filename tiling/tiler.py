@@ -0,0 +1,431 @@
+'''
+
+tiler.py cuts a GeoTIFF mosaic into overlapping tiles in-process via the GDAL bindings.
+
+It lays the tiles out on the same grid as gdal_retile.py, names them the same way
+(image_name_YY_XX.tif) and produces the same headerless
+tif_file,x_m_min,x_m_max,y_m_min,y_m_max csv rows, so the output can be fed straight
+into convert_tiles_to_jpg.py.
+
+Rather than decoding every source pixel once per tile that covers it (about 4 times
+with the default 500px tiles and 250px overlap) each worker reads a horizontal strip
+of the mosaic a few tile rows high once and cuts the overlapping tiles out of memory.
+
+The before and after images can also be tiled together on one shared pixel grid, so
+the tiles pair up exactly by their (row, col) grid index.
+
+The tiling can be clipped to a lat / lon region of interest (e.g. the event manifest
+bounding box), only the tiles intersecting it are read and written but they keep their
+whole image grid names and positions.
+
+Tiles already made by a previous (partial) run are skipped, as long as the run was with the
+same grid settings and source images. These are recorded in a <stem>_tiles.json file next to
+the tiles, and the tiles are remade (like gdal_retile.py overwrote them) when they change.
+
+'''
+
+import os, re, json, math
+import multiprocessing
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from osgeo import gdal, osr
+
+gdal.UseExceptions()
+
+# the creation options make_tiff_tiles.py used to pass to gdal_retile.py
+default_creation_options = ['COMPRESS=JPEG', 'TILED=YES']
+
+# row / col are the 1 based gdal_retile grid indexes, the offsets and sizes are in source pixels
+Tile = namedtuple('Tile', 'row col xoff yoff width height tif_file')
+
+def tile_count(raster_size, tile_size, overlap):
+    # same as gdal_retile.py: the first tile starts at pixel 0, every following tile
+    # starts (tile_size - overlap) pixels on and the last one is clipped to the image edge
+    if raster_size <= tile_size:
+        return 1
+    return 1 + int(math.ceil((raster_size - tile_size) / float(tile_size - overlap)))
+
+def tile_name(image_stem, row, col, count_x, count_y):
+    # gdal_retile.py zero pads both indexes to the number of digits of the larger count
+    num_digits = len(str(max(count_x, count_y)))
+    index_format = "%0" + str(num_digits) + "d"
+    return "%s_%s_%s.tif" % (image_stem, index_format % row, index_format % col)
+
+def tile_grid_index(tif_files):
+    # parse the (row, col) grid indexes back out of a series of tile file names
+    grid_index = tif_files.str.extract(r'_(\d+)_(\d+)\.tif$', expand=True)
+    if grid_index.isnull().any().any():
+        raise ValueError("Can't find the tile row / col in tile names like %s" % tif_files[grid_index[0].isnull()].iloc[0])
+    grid_index.columns = ['tile_row', 'tile_col']
+    return grid_index.astype(int)
+
+def tile_grid(raster_x, raster_y, size_x, size_y, overlap, image_stem):
+    if overlap >= size_x or overlap >= size_y:
+        raise ValueError("Tile overlap (%d) must be smaller than the tile size (%d x %d)" % (overlap, size_x, size_y))
+
+    count_x = tile_count(raster_x, size_x, overlap)
+    count_y = tile_count(raster_y, size_y, overlap)
+
+    tiles = []
+    for row in range(1, count_y + 1):
+        yoff = (row - 1) * (size_y - overlap)
+        height = min(size_y, raster_y - yoff)
+        for col in range(1, count_x + 1):
+            xoff = (col - 1) * (size_x - overlap)
+            width = min(size_x, raster_x - xoff)
+            tif_file = tile_name(image_stem, row, col, count_x, count_y)
+            tiles.append(Tile(row, col, xoff, yoff, width, height, tif_file))
+
+    return tiles
+
+def tile_bounds(geotransform, tile):
+    # assumes a north up image, as gdal_retile.py does for the csv extents
+    x_m_min = geotransform[0] + tile.xoff * geotransform[1]
+    x_m_max = x_m_min + tile.width * geotransform[1]
+    y_m_max = geotransform[3] + tile.yoff * geotransform[5]
+    y_m_min = y_m_max + tile.height * geotransform[5]
+    return x_m_min, x_m_max, y_m_min, y_m_max
+
+def roi_pixel_window(source, bbox, buffer=0):
+    '''
+    Get the (col_min, row_min, col_max, row_max) source pixel window covering the
+    [west, south, east, north] lat / lon bbox, plus a buffer in source projection units.
+    '''
+    raster_srs = osr.SpatialReference()
+    if source.GetProjection() == '' or raster_srs.ImportFromWkt(source.GetProjection()) != 0:
+        raise ValueError("Can't clip to the region of interest, the image has no projection")
+    latlong_srs = osr.SpatialReference()
+    latlong_srs.ImportFromEPSG(4326)
+    # gdal >= 3 defaults to lat / lon axis order for epsg:4326
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        latlong_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    to_raster = osr.CoordinateTransformation(latlong_srs, raster_srs)
+
+    # the bbox edges aren't straight lines in the raster projection,
+    # so transform points along all of them, not just the corners
+    west, south, east, north = bbox
+    lons = np.linspace(west, east, 21)
+    lats = np.linspace(south, north, 21)
+    edge_points = [(lon, south) for lon in lons] + [(lon, north) for lon in lons] \
+        + [(west, lat) for lat in lats] + [(east, lat) for lat in lats]
+    raster_points = [to_raster.TransformPoint(float(lon), float(lat))[:2] for lon, lat in edge_points]
+    x_min = min(point[0] for point in raster_points) - buffer
+    x_max = max(point[0] for point in raster_points) + buffer
+    y_min = min(point[1] for point in raster_points) - buffer
+    y_max = max(point[1] for point in raster_points) + buffer
+
+    # and then into source pixels, assuming a north up image
+    gt = source.GetGeoTransform()
+    col_min = max(0, int(math.floor((x_min - gt[0]) / gt[1])))
+    col_max = min(source.RasterXSize, int(math.ceil((x_max - gt[0]) / gt[1])))
+    row_min = max(0, int(math.floor((y_max - gt[3]) / gt[5])))
+    row_max = min(source.RasterYSize, int(math.ceil((y_min - gt[3]) / gt[5])))
+
+    return col_min, row_min, col_max, row_max
+
+def tiles_in_window(tiles, window):
+    col_min, row_min, col_max, row_max = window
+    return [tile for tile in tiles
+        if tile.xoff < col_max and tile.xoff + tile.width > col_min
+        and tile.yoff < row_max and tile.yoff + tile.height > row_min]
+
+def group_into_strips(tiles, rows_per_strip):
+    # group the tiles by their grid row, rows_per_strip grid rows to a strip
+    strips = {}
+    for tile in tiles:
+        strip_key = (tile.row - 1) // rows_per_strip
+        strips.setdefault(strip_key, []).append(tile)
+    return [strips[key] for key in sorted(strips.keys())]
+
+# each pool worker keeps its own handle on the source image, gdal datasets can't be pickled
+source_ds = None
+tile_settings = None
+
+def init_worker(source_path, tile_dir, creation_options):
+    global source_ds, tile_settings
+    source_ds = gdal.Open(source_path, gdal.GA_ReadOnly)
+    tile_settings = (tile_dir, creation_options)
+
+def write_tile(source, data, tile, tile_path, creation_options):
+    band_count = data.shape[0]
+    first_band = source.GetRasterBand(1)
+    driver = gdal.GetDriverByName('GTiff')
+
+    # write to a temporary name first so an interrupted run never leaves
+    # a partial tile behind that a resumed run would then skip
+    part_path = tile_path + '.part'
+    tile_ds = driver.Create(part_path, tile.width, tile.height, band_count, first_band.DataType, creation_options)
+    tile_ds.SetProjection(source.GetProjection())
+    gt = source.GetGeoTransform()
+    tile_ds.SetGeoTransform((
+        gt[0] + tile.xoff * gt[1] + tile.yoff * gt[2], gt[1], gt[2],
+        gt[3] + tile.xoff * gt[4] + tile.yoff * gt[5], gt[4], gt[5]
+    ))
+
+    for band_num in range(1, band_count + 1):
+        source_band = source.GetRasterBand(band_num)
+        tile_band = tile_ds.GetRasterBand(band_num)
+        tile_band.SetColorInterpretation(source_band.GetColorInterpretation())
+        nodata = source_band.GetNoDataValue()
+        if nodata is not None:
+            tile_band.SetNoDataValue(nodata)
+        color_table = source_band.GetColorTable()
+        if color_table is not None:
+            tile_band.SetColorTable(color_table)
+        tile_band.WriteArray(data[band_num - 1])
+
+    tile_ds.FlushCache()
+    tile_ds = None
+    os.rename(part_path, tile_path)
+
+def cut_tiles(source, strip_tiles, tile_dir, creation_options):
+    '''
+    Cut the strip_tiles (a strip of neighbouring tiles) out of the open source image into
+    tile_dir, reading the source pixels they cover once. Returns a list of (tile, error).
+    '''
+    results = []
+
+    # don't redo work from a previous (partial) run
+    todo_tiles = []
+    for tile in strip_tiles:
+        if os.path.isfile(os.path.join(tile_dir, tile.tif_file)):
+            results.append((tile, None))
+        else:
+            todo_tiles.append(tile)
+    if len(todo_tiles) == 0:
+        return results
+
+    # read the strip covering all the tiles left to make once
+    strip_x_min = min(tile.xoff for tile in todo_tiles)
+    strip_x_max = max(tile.xoff + tile.width for tile in todo_tiles)
+    strip_y_min = min(tile.yoff for tile in todo_tiles)
+    strip_y_max = max(tile.yoff + tile.height for tile in todo_tiles)
+    try:
+        strip_data = source.ReadAsArray(strip_x_min, strip_y_min, strip_x_max - strip_x_min, strip_y_max - strip_y_min)
+    except Exception as e:
+        return results + [(tile, "failed to read source strip: %s" % e) for tile in todo_tiles]
+
+    # single band images come back as a 2d array
+    if strip_data.ndim == 2:
+        strip_data = strip_data[np.newaxis, :, :]
+
+    # and cut the overlapping tiles out of it
+    for tile in todo_tiles:
+        x0 = tile.xoff - strip_x_min
+        y0 = tile.yoff - strip_y_min
+        tile_data = strip_data[:, y0:y0 + tile.height, x0:x0 + tile.width]
+        try:
+            write_tile(source, tile_data, tile, os.path.join(tile_dir, tile.tif_file), creation_options)
+            results.append((tile, None))
+        except Exception as e:
+            results.append((tile, str(e)))
+
+    return results
+
+def tile_strip(strip_tiles):
+    tile_dir, creation_options = tile_settings
+    return cut_tiles(source_ds, strip_tiles, tile_dir, creation_options)
+
+def source_signature(source_path):
+    # a re-made mosaic with the same name has a different size or modified time
+    source_stat = os.stat(source_path)
+    return [os.path.abspath(source_path), source_stat.st_size, int(source_stat.st_mtime)]
+
+def tile_run_settings(source_paths, size_x, size_y, overlap, creation_options=default_creation_options, **other_settings):
+    '''
+    The settings that decide the content of a tile with a given grid name: the grid
+    parameters and the source images (both epochs for a shared grid).
+    '''
+    settings = {
+        'sources': [source_signature(source_path) for source_path in source_paths],
+        'size_x': size_x, 'size_y': size_y, 'overlap': overlap,
+        'creation_options': list(creation_options)
+    }
+    settings.update(other_settings)
+    return settings
+
+def check_tile_settings(tile_dir, image_stem, settings, other_dirs=[]):
+    '''
+    Remove the image_stem tiles in tile_dir (and the jpgs of them in other_dirs) that were
+    made with different settings (see tile_run_settings) than this run, or by a run that
+    didn't record them, so only the tiles this run would make the same way are skipped.
+    '''
+    settings_path = os.path.join(tile_dir, "%s_tiles.json" % image_stem)
+    previous_settings = None
+    if os.path.isfile(settings_path):
+        with open(settings_path, 'r') as f:
+            previous_settings = json.load(f)
+    if previous_settings == settings:
+        return
+
+    stem_tile_re = re.compile(r'\A%s_\d+_\d+\.(tif|jpg)(\.part)?\Z' % re.escape(image_stem))
+    stale_files = []
+    for stale_dir in [tile_dir] + list(other_dirs):
+        with os.scandir(stale_dir) as entries:
+            stale_files.extend(entry.path for entry in entries if entry.is_file() and stem_tile_re.match(entry.name))
+    if len(stale_files) > 0:
+        print("Removing %d %s tiles made with different settings, they will be remade" % (len(stale_files), image_stem))
+        for stale_file in stale_files:
+            os.remove(stale_file)
+
+    # record the settings once the stale tiles are gone, so an interrupted run resumes
+    with open(settings_path + '.part', 'w') as f:
+        json.dump(settings, f, indent=2)
+    os.replace(settings_path + '.part', settings_path)
+
+def make_tiles(source_path, tile_dir, tiles, workers=None, rows_per_strip=4, creation_options=default_creation_options):
+    # returns the set of tiles that exist and the list of (tif_file, error) tiles that failed
+    strips = group_into_strips(tiles, rows_per_strip)
+    num_tiles = len(tiles)
+    print("Tiling %s into %d tiles (%d strips)" % (source_path, num_tiles, len(strips)))
+
+    done_tiles = set()
+    failures = []
+    pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(source_path, tile_dir, creation_options))
+    try:
+        for strip_results in pool.imap_unordered(tile_strip, strips):
+            for tile, error in strip_results:
+                if error is None:
+                    done_tiles.add(tile)
+                else:
+                    failures.append((tile.tif_file, error))
+            num_done = len(done_tiles) + len(failures)
+            print('Tiles done: ' + f"{num_done:,d}" + ' of ' + f"{num_tiles:,d}", end='\r')
+    finally:
+        pool.close()
+        pool.join()
+    print('')
+
+    return done_tiles, failures
+
+def clip_to_roi(tiles, source, roi_bbox, roi_buffer):
+    if roi_bbox is None:
+        return tiles
+    roi_tiles = tiles_in_window(tiles, roi_pixel_window(source, roi_bbox, roi_buffer))
+    print("Clipping to the region of interest %s: %d of %d tiles (%.1f%%)" % (roi_bbox, len(roi_tiles), len(tiles), 100.0 * len(roi_tiles) / len(tiles)))
+    return roi_tiles
+
+def tile_image(source_path, tile_dir, image_stem, size_x, size_y, overlap, workers=None, rows_per_strip=4, creation_options=default_creation_options, roi_bbox=None, roi_buffer=0):
+    '''
+    Tile the source image into tile_dir on a process pool.
+
+    If roi_bbox ([west, south, east, north] lat / lon) is given only the tiles
+    intersecting it (plus roi_buffer in source projection units) are made.
+
+    Returns the list of tile table rows (see tile_table_columns) in grid order for the
+    tiles that exist and the list of (tif_file, error) tiles that failed.
+    '''
+    source = gdal.Open(source_path, gdal.GA_ReadOnly)
+    geotransform = source.GetGeoTransform()
+    tiles = tile_grid(source.RasterXSize, source.RasterYSize, size_x, size_y, overlap, image_stem)
+    tiles = clip_to_roi(tiles, source, roi_bbox, roi_buffer)
+    source = None
+
+    check_tile_settings(tile_dir, image_stem, tile_run_settings([source_path], size_x, size_y, overlap, creation_options))
+    done_tiles, failures = make_tiles(source_path, tile_dir, tiles, workers, rows_per_strip, creation_options)
+
+    tile_rows = []
+    for tile in tiles:
+        if tile in done_tiles:
+            tile_rows.append(tile_table_row(tile, tile_bounds(geotransform, tile)))
+
+    return tile_rows, failures
+
+def image_bounds(ds):
+    # (x_min, y_min, x_max, y_max) of a north up image
+    gt = ds.GetGeoTransform()
+    return gt[0], gt[3] + ds.RasterYSize * gt[5], gt[0] + ds.RasterXSize * gt[1], gt[3]
+
+def common_grid_vrts(before_path, after_path, before_vrt_path, after_vrt_path):
+    '''
+    Put both epochs on the before image pixel grid, clipped to the area they both cover.
+
+    Writes a vrt for each epoch, the before one is a plain window on the before image and
+    the after one is warped (reprojected / resampled if it has to be) onto the same grid.
+    '''
+    before = gdal.Open(before_path, gdal.GA_ReadOnly)
+    gt = before.GetGeoTransform()
+    projection = before.GetProjection()
+
+    # the after image footprint in the before projection
+    after_reprojected = gdal.Warp('', after_path, format='VRT', dstSRS=projection)
+    before_x_min, before_y_min, before_x_max, before_y_max = image_bounds(before)
+    after_x_min, after_y_min, after_x_max, after_y_max = image_bounds(after_reprojected)
+    after_reprojected = None
+
+    x_min = max(before_x_min, after_x_min)
+    x_max = min(before_x_max, after_x_max)
+    y_min = max(before_y_min, after_y_min)
+    y_max = min(before_y_max, after_y_max)
+    if x_min >= x_max or y_min >= y_max:
+        raise ValueError("The before and after images don't overlap")
+
+    # snap the overlap inwards to whole before image pixels
+    col_min = int(math.ceil((x_min - gt[0]) / gt[1] - 1e-6))
+    col_max = int(math.floor((x_max - gt[0]) / gt[1] + 1e-6))
+    row_min = int(math.ceil((y_max - gt[3]) / gt[5] - 1e-6))
+    row_max = int(math.floor((y_min - gt[3]) / gt[5] + 1e-6))
+    grid_bounds = (gt[0] + col_min * gt[1], gt[3] + row_max * gt[5], gt[0] + col_max * gt[1], gt[3] + row_min * gt[5])
+
+    gdal.Translate(before_vrt_path, before, format='VRT', srcWin=[col_min, row_min, col_max - col_min, row_max - row_min])
+    gdal.Warp(after_vrt_path, after_path, format='VRT', dstSRS=projection, outputBounds=grid_bounds,
+        xRes=abs(gt[1]), yRes=abs(gt[5]), resampleAlg='bilinear')
+    before = None
+
+    return before_vrt_path, after_vrt_path
+
+def tile_epochs(before_path, after_path, before_tile_dir, after_tile_dir, before_stem, after_stem, size_x, size_y, overlap, workers=None, rows_per_strip=4, creation_options=default_creation_options, roi_bbox=None, roi_buffer=0):
+    '''
+    Tile the before and after images on one shared pixel grid, so the before and after
+    tiles with the same (row, col) cover exactly the same ground.
+
+    Returns the before and after tile table rows (see tile_image), with the tile_row / tile_col
+    that pair them, and the list of failed tiles.
+    '''
+    before_vrt_path, after_vrt_path = common_grid_vrts(before_path, after_path,
+        "%s/%s_grid.vrt" % (before_tile_dir, before_stem), "%s/%s_grid.vrt" % (after_tile_dir, after_stem))
+
+    grid = gdal.Open(before_vrt_path, gdal.GA_ReadOnly)
+    geotransform = grid.GetGeoTransform()
+    before_tiles = tile_grid(grid.RasterXSize, grid.RasterYSize, size_x, size_y, overlap, before_stem)
+    after_tiles = tile_grid(grid.RasterXSize, grid.RasterYSize, size_x, size_y, overlap, after_stem)
+    print("Tiling both epochs on a shared %d x %d pixel grid" % (grid.RasterXSize, grid.RasterYSize))
+    before_tiles = clip_to_roi(before_tiles, grid, roi_bbox, roi_buffer)
+    after_tiles = clip_to_roi(after_tiles, grid, roi_bbox, roi_buffer)
+    grid = None
+
+    # the shared grid depends on both images
+    settings = tile_run_settings([before_path, after_path], size_x, size_y, overlap, creation_options)
+    check_tile_settings(before_tile_dir, before_stem, settings)
+    check_tile_settings(after_tile_dir, after_stem, settings)
+    before_done, before_failures = make_tiles(before_vrt_path, before_tile_dir, before_tiles, workers, rows_per_strip, creation_options)
+    after_done, after_failures = make_tiles(after_vrt_path, after_tile_dir, after_tiles, workers, rows_per_strip, creation_options)
+
+    before_tile_rows = []
+    after_tile_rows = []
+    for before_tile, after_tile in zip(before_tiles, after_tiles):
+        bounds = tile_bounds(geotransform, before_tile)
+        if before_tile in before_done:
+            before_tile_rows.append(tile_table_row(before_tile, bounds))
+        if after_tile in after_done:
+            after_tile_rows.append(tile_table_row(after_tile, bounds))
+
+    return before_tile_rows, after_tile_rows, before_failures + after_failures
+
+# the first 5 columns are the gdal_retile.py csv columns
+tile_table_columns = ['tif_file', 'x_m_min', 'x_m_max', 'y_m_min', 'y_m_max', 'tile_row', 'tile_col', 'tifsize_x_pix', 'tifsize_y_pix']
+
+def tile_table_row(tile, bounds):
+    return (tile.tif_file,) + tuple(bounds) + (tile.row, tile.col, tile.width, tile.height)
+
+def tile_table(tile_rows):
+    return pd.DataFrame(tile_rows, columns=tile_table_columns)
+
+def write_tile_csv(tile_rows, csv_path):
+    # headerless, same as the gdal_retile.py -csv output
+    # repr keeps the full float precision of the extents
+    with open(csv_path, 'w') as f:
+        for tif_file, x_m_min, x_m_max, y_m_min, y_m_max in [tile_row[:5] for tile_row in tile_rows]:
+            f.write("%s,%r,%r,%r,%r\n" % (tif_file, float(x_m_min), float(x_m_max), float(y_m_min), float(y_m_max)))
@@ -0,0 +1,109 @@
+'''
+
+upload_journal.py records the upload state of every manifest row in a SQLite database, so an
+interrupted or crashed upload_manifest.py run can resume exactly where it was up to.
+
+Each row is journaled as
+  pending  - the subject is being saved, it might have been created (without an id to journal)
+  created  - the subject was created (with its id) but couldn't be removed after a failed save
+  uploaded - the subject and its media were saved but it isn't linked to the subject set yet
+  linked   - the subject is in the subject set
+and the states are written in one transaction per batch of rows. The pending rows are written
+by the upload worker threads, so the journal can be written from any thread.
+
+'''
+
+import time, sqlite3, threading
+
+pending = 'pending'
+created = 'created'
+uploaded = 'uploaded'
+linked = 'linked'
+
+class JournalMismatchError(Exception):
+    """Raised when the journal has rows for a different manifest file"""
+    pass
+
+class UploadJournal(object):
+    def __init__(self, journal_path, subject_set_id):
+        self.journal_path = journal_path
+        self.subject_set_id = str(subject_set_id)
+        # the upload workers journal their pending subjects, one write at a time
+        self.connection = sqlite3.connect(journal_path, check_same_thread=False)
+        self.lock = threading.RLock()
+        # the journal is written a batch at a time, WAL keeps the commits cheap
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS subjects (
+                    subject_set_id TEXT NOT NULL,
+                    manifest_index INTEGER NOT NULL,
+                    jpg_file_before TEXT,
+                    subject_id TEXT,
+                    state TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (subject_set_id, manifest_index)
+                )''')
+
+    def close(self):
+        self.connection.close()
+
+    def rows(self):
+        '''
+        Return a dict of manifest index to (state, subject_id, jpg_file_before) for the subject set.
+        '''
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT manifest_index, state, subject_id, jpg_file_before FROM subjects WHERE subject_set_id = ?',
+                (self.subject_set_id,))
+            return {manifest_index: (state, subject_id, jpg_file_before) for manifest_index, state, subject_id, jpg_file_before in cursor}
+
+    def oldest_update(self, state):
+        # the unix time the oldest row in state was journaled, or None
+        with self.lock:
+            cursor = self.connection.execute(
+                'SELECT MIN(updated_at) FROM subjects WHERE subject_set_id = ? AND state = ?',
+                (self.subject_set_id, state))
+            return cursor.fetchone()[0]
+
+    def check_manifest(self, jpg_files_before):
+        '''
+        Check the journaled rows are for the same manifest, jpg_files_before is a
+        dict (or series) of the manifest index to its jpg_file_before.
+        '''
+        for manifest_index, (_, _, jpg_file_before) in self.rows().items():
+            if jpg_file_before is not None and jpg_files_before.get(manifest_index) != jpg_file_before:
+                raise JournalMismatchError("%s has row %s as %s, this manifest has %s, is it for a different manifest?" % (
+                    self.journal_path, manifest_index, jpg_file_before, jpg_files_before.get(manifest_index)))
+
+    def record(self, state, rows):
+        '''
+        Journal the [(manifest_index, jpg_file_before, subject_id)] rows as state, in one transaction.
+        '''
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO subjects (subject_set_id, manifest_index, jpg_file_before, subject_id, state, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                [(self.subject_set_id, int(manifest_index), jpg_file_before, None if subject_id is None else str(subject_id), state, now)
+                    for manifest_index, jpg_file_before, subject_id in rows])
+
+    def forget(self, manifest_indexes):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'DELETE FROM subjects WHERE subject_set_id = ? AND manifest_index = ?',
+                [(self.subject_set_id, int(manifest_index)) for manifest_index in manifest_indexes])
+
+    def import_state_tracker(self, upload_state_tracker_path, jpg_files_before):
+        '''
+        Journal the rows up to the last index in an old upload_state_tracker.txt file as linked.
+        '''
+        with open(upload_state_tracker_path, 'r') as f:
+            lines = [line for line in f.read().splitlines() if line]
+        if len(lines) == 0:
+            return 0
+        # file format is index,last_file_name.txt
+        last_index = int(lines[-1].split(',')[0])
+        linked_rows = [(manifest_index, jpg_file_before, None) for manifest_index, jpg_file_before in jpg_files_before.items() if manifest_index <= last_index]
+        self.record(linked, linked_rows)
+        return len(linked_rows)
@@ -5,21 +5,30 @@ zooniverse upload csv manifest for use by the panoptes cli subject uploader
 
 '''
 
-import sys, os, re, argparse, signal
+import sys, os, re, time, argparse, signal
 import pandas as pd
-import pdb # pdb.set_trace()
 from panoptes_client import Panoptes, SubjectSet
-from panoptes_client.panoptes import PanoptesAPIException
 import uploader
+import upload_journal
+import pacing
+import subject_set_index
 
 # allow OS env to set a defaultS
-default_batch_size = os.environ.get('BATCH_SIZE',10)
-default_marshal_dir = os.environ.get('MARSHAL_DIR','marshal_dir')
+default_batch_size = int(os.environ.get('BATCH_SIZE',10))
+default_workers = int(os.environ.get('UPLOAD_WORKERS',4))
+default_marshal_dir = os.environ.get('MARSHAL_DIR')
 tiled_data_dir = os.environ.get('DATA_OUT_DIR','outputs/')
 
 parser = argparse.ArgumentParser(description='Create a tiled image data csv manifest to upload subjects to the Zooniverse.')
-parser.add_argument('--marshal-dir', dest='marshal_dir', default=default_marshal_dir, help='the directory to marshal the file uploads from')
-parser.add_argument('--batch-size', dest='batch_size', default=default_batch_size, help='the number of subjects to attempt to upload at once')
+parser.add_argument('--marshal-dir', dest='marshal_dir', default=default_marshal_dir, help='symlink the files to upload into this directory (in DATA_OUT_DIR) and upload them from there, by default the jpgs are uploaded straight from the tile directories')
+parser.add_argument('--batch-size', dest='batch_size', type=int, default=default_batch_size, help='the number of subjects to link to the subject set at once to start with, it adapts to the link latency')
+parser.add_argument('--max-batch-size', dest='max_batch_size', type=int, default=500, help='the most subjects to link to the subject set at once, set it to --batch-size for a fixed batch size (default: 500)')
+parser.add_argument('--link-latency', dest='link_latency', type=float, default=5.0, help='the target seconds per subject set link request the batch size adapts to (default: 5)')
+parser.add_argument('--max-rate', dest='max_rate', type=float, default=uploader.default_max_rate, help='the most API requests per second to make, shared by the subject saves and links (default: %s)' % uploader.default_max_rate)
+parser.add_argument('--workers', dest='workers', type=int, default=default_workers, help='the number of subjects to upload concurrently (default: 4)')
+parser.add_argument('--journal', dest='journal_name', default='upload_journal.sqlite', help='file name (in DATA_OUT_DIR) of the upload journal to resume from (default: upload_journal.sqlite)')
+parser.add_argument('--reconcile', dest='reconcile', action='store_true', help='skip the manifest rows that are already in the subject set, from their jpg_file_before / jpg_file_after metadata')
+parser.add_argument('--subject-index', dest='subject_index_name', default=None, help='with --reconcile, file name (in DATA_OUT_DIR) of the cached subject set index (default: subject_set_<id>_index.json)')
 parser.add_argument('--admin-mode', dest='admin_mode', default=False, help='run the Zooniverse CLI in admin mode')
 parser.add_argument('--subject-set', dest='subject_set_id', help='the subject set to upload the data to', required=True)
 parser.add_argument('manifest_csv_file',help='the path to the subject manifest csv file')
@@ -27,8 +36,11 @@ parser.add_argument('manifest_csv_file',help='the path to the subject manifest c
 args = parser.parse_args()
 
 manifest_csv_file_path = args.manifest_csv_file
-marshal_dir = "%s/%s" % (tiled_data_dir, args.marshal_dir)
+marshal_dir = None if args.marshal_dir is None else "%s/%s" % (tiled_data_dir, args.marshal_dir)
 batch_size = args.batch_size
+# the saves and links share the API request rate
+pacer = pacing.RequestPacer(args.max_rate)
+workers = args.workers
 admin_mode = args.admin_mode
 subject_set_id = args.subject_set_id
 
@@ -39,103 +51,152 @@ creds_exist = username and password
 if not creds_exist:
     print("Missing zooniverse credentials, pass them in as environment variables")
     exit(1)
-Panoptes.connect(username=username, password=password, admin=admin_mode)
+connect_kwargs = dict(username=username, password=password, admin=admin_mode)
+Panoptes.connect(**connect_kwargs)
 
 # setup the tile output paths
-if not os.path.exists(marshal_dir):
+if marshal_dir is not None and not os.path.exists(marshal_dir):
     os.mkdir(marshal_dir)
 
 # find / create the subject set to upload to
-# print("Marshaling the manifest subject file data into directory for uploads...")
 subject_set = SubjectSet.find(subject_set_id)
 print("Found subject set with id: {} to upload data to.".format(subject_set.id))
 
-manifest_csv_file_df = pd.read_csv(manifest_csv_file_path)
+# the manifest index is the first (unnamed) column
+manifest_csv_file_df = pd.read_csv(manifest_csv_file_path, index_col=0)
 
-# TODO: find out if we are resuming a previously borked upload
-# use a file to indicate this state
+# the journal of every manifest row's upload state to resume from
+journal_path = "%s/%s" % (tiled_data_dir, args.journal_name)
+journal = upload_journal.UploadJournal(journal_path, subject_set.id)
+jpg_files_before = manifest_csv_file_df['jpg_file_before']
+
+# carry on from an upload that was tracked by the old state tracker file
 upload_state_tracker_path = "%s/%s" % (tiled_data_dir, 'upload_state_tracker.txt')
-last_uploaded_index = uploader.last_uploaded_index(upload_state_tracker_path)
-# the restartable count of subjects that have been uploaded
-uploaded_subjects_count = last_uploaded_index
+if len(journal.rows()) == 0 and os.path.isfile(upload_state_tracker_path):
+    imported_count = journal.import_state_tracker(upload_state_tracker_path, jpg_files_before)
+    print("Imported {} linked rows from {} into the upload journal.".format(imported_count, upload_state_tracker_path))
+
+try:
+    journal.check_manifest(jpg_files_before)
+except upload_journal.JournalMismatchError as e:
+    print("Error: %s" % e)
+    print("Use --journal to upload this manifest with a new journal file.")
+    raise SystemExit(1)
+
+done_indexes = uploader.resume_journal(subject_set, journal, batch_size, pacer=pacer, jpg_files_after=manifest_csv_file_df['jpg_file_after'])
+if len(done_indexes) > 0:
+    print("Found {} uploaded subjects in the journal {}, skipping them.".format(len(done_indexes), journal_path))
+
+# skip the rows another run (or machine) already put in the subject set
+subject_index = None
+if args.reconcile:
+    subject_index_name = args.subject_index_name or "subject_set_{}_index.json".format(subject_set.id)
+    subject_index = subject_set_index.SubjectSetIndex("%s/%s" % (tiled_data_dir, subject_index_name), subject_set.id)
+    if subject_index.fetched_at is None:
+        print("Indexing the subjects in the subject set...")
+    else:
+        print("Updating the subject set index cached at {}...".format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(subject_index.fetched_at))))
+    new_count = subject_index.refresh(subject_set, pacer=pacer)
+    subject_index.save()
+    existing_subject_ids, duplicate_count = subject_index.by_jpg_files()
+    print("Fetched {} new subjects, the subject set has {}.".format(new_count, len(subject_index.subjects)))
+    if duplicate_count > 0:
+        print("Warning: the subject set has {} duplicate subjects with the same jpg files as another.".format(duplicate_count))
+
+    present_rows = []
+    for index, jpg_file_before, jpg_file_after in zip(manifest_csv_file_df.index, manifest_csv_file_df['jpg_file_before'], manifest_csv_file_df['jpg_file_after']):
+        subject_id = existing_subject_ids.get((jpg_file_before, jpg_file_after))
+        if subject_id is not None and index not in done_indexes:
+            present_rows.append((index, jpg_file_before, subject_id))
+    journal.record(upload_journal.linked, present_rows)
+    done_indexes.update(index for index, _, _ in present_rows)
+    print("Found {} more manifest rows in the subject set, skipping them.".format(len(present_rows)))
 
-# hold a list of created but unlinked subject set subjects
-saved_subjects = []
+# the restartable count of subjects that have been uploaded
+uploaded_subjects_count = len(done_indexes)
+if uploaded_subjects_count == 0:
+    print("Starting at the beginning of the manifest file.")
+
+# check all the media files to upload are there before starting, in one listing per jpg directory
+upload_rows_df = manifest_csv_file_df[~manifest_csv_file_df.index.isin(done_indexes)]
+jpg_dirs = dict((epoch, "%s/tiles_%s_jpg" % (tiled_data_dir, epoch)) for epoch in ['before', 'after'])
+missing_media_files = []
+upload_bytes = 0
+for epoch, jpg_dir in jpg_dirs.items():
+    jpg_files = upload_rows_df['jpg_file_%s' % epoch]
+    jpg_file_sizes = jpg_files.map(uploader.media_file_sizes(jpg_dir))
+    missing_media_files.extend("%s/%s" % (jpg_dir, jpg_file) for jpg_file in jpg_files[jpg_file_sizes.isnull()])
+    upload_bytes += jpg_file_sizes.sum()
+
+if len(missing_media_files) > 0:
+    print("Error: {} of the media files to upload are missing:".format(len(missing_media_files)))
+    for media_file in missing_media_files[:20]:
+        print("  %s" % media_file)
+    if len(missing_media_files) > 20:
+        print("  ... and {} more".format(len(missing_media_files) - 20))
+    raise SystemExit(1)
+print("{:,d} subjects to upload, {:,d} media files, {:,.1f} MB".format(len(upload_rows_df), 2 * len(upload_rows_df), upload_bytes / 1e6))
 
 # handle (Ctrl+C) keyboard interrupt
+stop_requested = False
 def signal_handler(*args):
-    print('You pressed Ctrl+C! - attempting to clean up gracefully')
-    remaining_subjects_to_link = len(saved_subjects)
-    try:
-        print("Linking %s remaining uploaded subjects" % remaining_subjects_to_link)
-        uploader.add_batch_to_subject_set(subject_set, saved_subjects)
-        uploader.update_state_tracker(upload_state_tracker_path, index, row['jpg_file_before'])
-        uploader.remove_symlinks(row_media_files)
-    except PanoptesAPIException as e:
-        print('Failed to link %s remaining subjects' % remaining_subjects_to_link)
-        uploader.handle_batch_failure(saved_subjects)
-    finally:
+    global stop_requested
+    if stop_requested:
         raise SystemExit
+    print('\nYou pressed Ctrl+C! - finishing the uploads in progress and linking them, press it again to quit now')
+    stop_requested = True
 #register the handler for interrupt signal
 signal.signal(signal.SIGINT, signal_handler)
 
-# symlink all the tiled jpg data to the marshaling dir for uplaod
-print("Marshaling the manifest subject file data into directory for uploads...")
-for index, row in manifest_csv_file_df.iterrows():
-    # skip to where we were up to
-    if index <= last_uploaded_index:
-        continue
-
-    # before_symlink_path = uploader.symlink_image(marshal_dir, tiled_data_dir, row['jpg_file_before'])
-    # after_symlink_path = uploader.symlink_image(marshal_dir, tiled_data_dir, row['jpg_file_after'])
-
-    # TODO: why does the above function leave the after as a broken symlink?
-    # [print("%s file exists? %s" % (file, os.path.isfile(file))) for file in row_media_files]
-    before_file_path = "%s/tiles_before_jpg/%s" % (tiled_data_dir, row['jpg_file_before'])
-    before_symlink_path = "%s/%s" % (marshal_dir, row['jpg_file_before'])
-    if not os.path.isfile(before_symlink_path):
-        os.symlink(os.path.abspath(before_file_path), before_symlink_path)
-
-    after_file_path = "%s/tiles_after_jpg/%s" % (tiled_data_dir, row['jpg_file_after'])
-    after_symlink_path = "%s/%s" % (marshal_dir, row['jpg_file_after'])
-    if not os.path.isfile(after_symlink_path):
-        os.symlink(os.path.abspath(after_file_path), after_symlink_path)
-
-    # try and handle api failures, intermittent network, etc.
-    try:
-        # read the pandas series here without the index from row
-        # to construct a dict object for use as metadata
-        metadata = row[1:-1].to_dict()
-        row_media_files = [ before_symlink_path, after_symlink_path ]
-        subject = uploader.create_subject(subject_set.links.project, metadata, row_media_files)
-        # save the list of subjects to add to the subject set above
-        saved_subjects.append(subject)
-        # clean up the linked media files
-        uploader.remove_symlinks(row_media_files)
-
-    except PanoptesAPIException as e:
-        print('\nError occurred on row: {} of the csv file'.format(len(saved_subjects)+1))
-        print('Details of error: {}'.format(e))
-        uploader.handle_batch_failure(saved_subjects)
-        raise SystemExit
-
-    # link each batch of new subjects to the subject set
-    if len(saved_subjects) % batch_size == 0:
-        uploader.add_batch_to_subject_set(subject_set, saved_subjects)
-        uploaded_subjects_count += len(saved_subjects)
-        saved_subjects = []
-
-        # TODO: move this to a progress bar
-        print("Uploaded and linked {} subjects".format(uploaded_subjects_count))
-
-        uploader.update_state_tracker(upload_state_tracker_path, index, row['jpg_file_before'])
-
-
-# catch any left over batches in the file
-if len(saved_subjects) > 0:
-    uploader.add_batch_to_subject_set(subject_set, saved_subjects)
-    uploaded_subjects_count += len(saved_subjects)
-    # cleanup the state tracker file to ensure we don't replay the last set of data
+def manifest_subject_rows():
+    for index, row in upload_rows_df.iterrows():
+        media_files = ["%s/%s" % (jpg_dirs['before'], row['jpg_file_before']), "%s/%s" % (jpg_dirs['after'], row['jpg_file_after'])]
+        # symlink the tiled jpg data to the marshaling dir for upload as each row is started
+        if marshal_dir is not None:
+            media_files = [uploader.symlink_image(marshal_dir, media_file) for media_file in media_files]
+
+        # the pandas series of the row makes the subject metadata
+        yield index, row.to_dict(), media_files
+
+def subjects_linked(batch):
+    global uploaded_subjects_count
+    uploaded_subjects_count += len(batch)
+    # TODO: move this to a progress bar
+    print("Uploaded and linked {} subjects".format(uploaded_subjects_count))
+
+    # clean up the linked media files
+    if marshal_dir is not None:
+        for _, _, _, row_media_files in batch:
+            uploader.remove_symlinks(row_media_files)
+
+    # and keep the subject set index up to date with them
+    if subject_index is not None:
+        for index, jpg_file_before, subject, _ in batch:
+            subject_index.add(subject.id, jpg_file_before, manifest_csv_file_df.at[index, 'jpg_file_after'])
+
+print("Uploading the manifest subjects with %d workers..." % workers)
+batch_sizer = pacing.LinkBatchSizer(batch_size, maximum=args.max_batch_size, target_latency=args.link_latency)
+linked_count, failure = uploader.upload_subjects(
+    subject_set, subject_set.links.project, manifest_subject_rows(), workers, batch_sizer, journal,
+    pacer=pacer, linked_callback=subjects_linked, connect_kwargs=connect_kwargs, stop_requested=lambda: stop_requested)
+
+if subject_index is not None:
+    subject_index.save()
+
+if failure is not None:
+    failed_index, error = failure
+    print('\nError occurred on row: {} of the csv file'.format(failed_index))
+    print('Details of error: {}'.format(error))
+    print('Linked {} subjects, re-run the same command to resume the upload'.format(linked_count))
+    raise SystemExit(1)
+
+if stop_requested:
+    print("Stopped after uploading {} subjects, re-run the same command to resume".format(uploaded_subjects_count))
+    raise SystemExit(1)
+
+# the journal now has every row linked, so the old tracker file isn't needed
+if os.path.isfile(upload_state_tracker_path):
     os.remove(upload_state_tracker_path)
+journal.close()
 
 print("Finished uploading {} subjects".format(uploaded_subjects_count))
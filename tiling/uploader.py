@@ -1,24 +1,42 @@
-import subprocess, os, pdb
-from panoptes_client import Subject
-
-def last_uploaded_index(upload_state_tracker_path):
-    proc_to_find_last_uploaded_index = subprocess.run(["tail", "-n", "1", upload_state_tracker_path], capture_output=True)
-    # Proxy for missing file
-    # CompletedProcess(args=['tail', '-n', '1', 'outputs/upload_state_tracker.txt'],
-    #   returncode=1, stdout=b'',
-    #   stderr=b"tail: cannot open 'outputs/upload_state_tracker.txt' for reading: No such file or directory\n"
-    #)
-    if proc_to_find_last_uploaded_index.returncode == 1:
-        # start at the beginning
-        print("Starting at the beginning of the manifest file.")
-        return 0
-    else:
-        # file format is index,last_file_name.txt
-        tail_output = str(proc_to_find_last_uploaded_index.stdout, 'utf-8')
-        last_uploaded_index = int(tail_output.split(',')[0])
-        print("Found last loaded index from file.")
-        print("Starting at the row %s of the manifest file." % last_uploaded_index)
-        return last_uploaded_index
+import os, time, collections
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from panoptes_client import Panoptes, Subject
+from panoptes_client.panoptes import PanoptesAPIException
+import upload_journal
+import subject_set_index
+import pacing
+
+max_rate_limit_retries = 8
+# API requests per second to pace the uploads to
+default_max_rate = 10.0
+
+def is_rate_limited(error):
+    # the media uploads raise a requests HTTPError with the response,
+    # the panoptes client raises a PanoptesAPIException with the details in the message
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) == 429:
+        return True
+    message = str(error).lower()
+    return '429' in message or 'too many requests' in message or 'rate limit' in message
+
+def with_backoff(pacer, cost, api_call, *args):
+    '''
+    Call api_call(*args), which makes cost API requests, paced by the shared pacer and
+    retried after backing off when it's rate limited. Returns the result and the number
+    of times it was rate limited.
+    '''
+    for attempt in range(max_rate_limit_retries + 1):
+        pacer.acquire(cost)
+        try:
+            result = api_call(*args)
+        except Exception as e:
+            if not is_rate_limited(e) or attempt == max_rate_limit_retries:
+                raise
+            delay = pacer.rate_limited()
+            print('\nRate limited by the API, backing off for up to %.1f seconds' % delay)
+        else:
+            pacer.succeeded()
+            return result, attempt
 
 def create_subject(project, metadata, media_files):
     subject = Subject()
@@ -26,22 +44,241 @@ def create_subject(project, metadata, media_files):
     for media_file in media_files:
         subject.add_location(media_file)
     subject.metadata.update(metadata)
-    subject.save()
+    try:
+        subject.save()
+    except Exception as e:
+        # the subject can be created before a media upload fails,
+        # remove it so a retry doesn't leave a subject without its images behind
+        if getattr(subject, 'id', None) is not None:
+            try:
+                subject.delete()
+            except Exception:
+                print('Failed to remove the partly created subject with id: {}'.format(subject.id))
+                # let the caller journal it to remove later
+                e.subject_id = subject.id
+        raise
     return subject
 
 def add_batch_to_subject_set(subject_set, subjects):
     print('Linking {} subjects to the set with id: {}'.format(len(subjects), subject_set.id))
     subject_set.add(subjects)
 
-def handle_batch_failure(saved_subjects):
-    print('\nRolling back, attempting to clean up any unlinked subjects.')
-    for subject in saved_subjects :
-        print('Removing the subject with id: {}'.format(subject.id))
-        subject.delete()
+def link_new_subjects(subject_set, subjects):
+    # SubjectSet.add checks each subject isn't linked already with an API request per subject,
+    # the subjects were just created so link them all with the one request
+    print('Linking {} subjects to the set with id: {}'.format(len(subjects), subject_set.id))
+    subject_set.http_post('{}/links/subjects'.format(subject_set.id), json={'subjects': [str(subject.id) for subject in subjects]})
+
+def remove_subjects(subject_ids, verbose=True):
+    for subject_id in subject_ids:
+        if verbose:
+            print('Removing the subject with id: {}'.format(subject_id))
+        try:
+            Subject.find(subject_id).delete()
+        except PanoptesAPIException as e:
+            # it may have been removed already
+            print('Failed to remove the subject with id: {}, {}'.format(subject_id, e))
+
+def link_journaled_subjects(subject_set, journal, subject_rows, batch_size, pacer=None):
+    '''
+    Link the [(index, jpg_file_before, subject_id)] subject_rows that were uploaded
+    but never linked to the subject set, journaling each batch as it's linked.
+    '''
+    if pacer is None:
+        pacer = pacing.RequestPacer(default_max_rate)
+    for batch_start in range(0, len(subject_rows), batch_size):
+        batch = subject_rows[batch_start:batch_start + batch_size]
+        # these might have been linked before the journal was written, so check them
+        with_backoff(pacer, 1 + len(batch), add_batch_to_subject_set, subject_set, [subject_id for _, _, subject_id in batch])
+        journal.record(upload_journal.linked, batch)
+
+def resume_journal(subject_set, journal, batch_size, pacer=None, jpg_files_after=None):
+    '''
+    Tidy up after an interrupted upload from its journal: remove the partly created subjects
+    so they get re-uploaded and link the subjects that were uploaded but never linked.
+    The subjects of the rows that were still being saved are looked up by their jpg_file_before
+    metadata (and jpg_file_after, if jpg_files_after maps the manifest index to it).
+    Returns the set of manifest indexes that are uploaded, so can be skipped.
+    '''
+    journal_rows = journal.rows()
+
+    # a save that was cut off might have created the subject, without its media, so find and remove it
+    pending_rows = dict((index, jpg_file_before) for index, (state, _, jpg_file_before) in journal_rows.items() if state == upload_journal.pending)
+    if len(pending_rows) > 0:
+        print("Looking for the subjects of {} interrupted uploads to re-upload them.".format(len(pending_rows)))
+        if jpg_files_after is None:
+            jpg_files_after = {}
+        found_subjects = subject_set_index.find_unlinked_subjects(
+            subject_set.links.project.id, dict((index, (jpg_file_before, jpg_files_after.get(index))) for index, jpg_file_before in pending_rows.items()),
+            journal.oldest_update(upload_journal.pending), pacer=pacer)
+        remove_subjects([subject_id for subject_ids in found_subjects.values() for subject_id in subject_ids])
+        journal.forget(pending_rows.keys())
+
+    # remove the subjects that were created but couldn't be removed after their save failed, and re-upload them
+    partial_rows = [(index, subject_id) for index, (state, subject_id, _) in sorted(journal_rows.items()) if state == upload_journal.created]
+    if len(partial_rows) > 0:
+        print("Removing {} partly created subjects to re-upload them.".format(len(partial_rows)))
+        remove_subjects([subject_id for _, subject_id in partial_rows])
+        journal.forget([index for index, _ in partial_rows])
+
+    # link the subjects that were uploaded but never linked, instead of re-uploading them
+    orphaned_rows = [(index, jpg_file_before, subject_id) for index, (state, subject_id, jpg_file_before) in sorted(journal_rows.items()) if state == upload_journal.uploaded]
+    if len(orphaned_rows) > 0:
+        print("Linking {} subjects that were uploaded but not linked.".format(len(orphaned_rows)))
+        link_journaled_subjects(subject_set, journal, orphaned_rows, batch_size, pacer=pacer)
+
+    return set(index for index, (state, _, _) in journal_rows.items() if state in (upload_journal.uploaded, upload_journal.linked))
+
+def upload_subjects(subject_set, project, subject_rows, workers, batch_sizer, journal, pacer=None, linked_callback=None, connect_kwargs=None, stop_requested=lambda: False, timings=None):
+    '''
+    Create the subjects for subject_rows, an iterable of (index, metadata, media_files) in
+    manifest order, on a pool of worker threads and link them to the subject set in batches
+    sized by the batch_sizer (a pacing.LinkBatchSizer) from the link latency.
+
+    Every subject is journaled as pending (by its worker, before it's saved), then as uploaded
+    and as linked, one transaction per batch, so after a crash a restart can remove the partly
+    created subjects and link the orphaned subjects instead of re-uploading them.
+    The subjects are linked in manifest order and linked_callback(batch) is called with the
+    [(index, jpg_file_before, subject, media_files)] of each linked batch.
+    The saves and links share the pacer (a pacing.RequestPacer) API request rate and are
+    retried after backing off when rate limited. If timings is given, the seconds each
+    subject save and link batch request took (without the pacing and backoff waits) are
+    appended to its 'save' and 'link' lists.
+
+    On a failed save or stop_requested() no more subjects are started, the saves in progress
+    are finished and all the saved subjects are linked.
+    Returns the number of subjects linked and the (index, error) of the failed save, or None.
+    '''
+    if pacer is None:
+        pacer = pacing.RequestPacer(default_max_rate)
+    # keep a bounded number of saves queued up for the workers
+    max_in_flight = workers * 2
+    in_flight = {}
+    # indexes in manifest order that are waiting to be linked
+    waiting = collections.deque()
+    # the manifest order of each index, the rows needn't be in index order
+    manifest_order = {}
+    saved = {}
+    to_link = []
+    linked_count = 0
+    failure = None
+
+    def timed_link(subjects):
+        # the link request latency, without the pacing waits
+        started_at = time.time()
+        link_new_subjects(subject_set, subjects)
+        return time.time() - started_at
 
-def symlink_image(marshal_dir, tiled_data_dir, file_name):
-    file_path = "%s/tiles_before_jpg/%s" % (tiled_data_dir, file_name)
-    symlink_path = "%s/%s" % (marshal_dir, file_name)
+    def link(batch):
+        latency, times_rate_limited = with_backoff(pacer, 1, timed_link, [subject for _, _, subject, _ in batch])
+        if times_rate_limited > 0:
+            batch_sizer.rate_limited()
+        else:
+            batch_sizer.linked(len(batch), latency)
+        if timings is not None:
+            timings['link'].append(latency)
+        journal.record(upload_journal.linked, [(index, jpg_file_before, subject.id) for index, jpg_file_before, subject, _ in batch])
+        if linked_callback is not None:
+            linked_callback(batch)
+        return len(batch)
+
+    def link_in_batches(subjects):
+        count = 0
+        while count < len(subjects):
+            count += link(subjects[count:count + batch_sizer.size])
+        return count
+
+    def journal_saves(done):
+        newly_saved = []
+        for future in done:
+            index, jpg_file_before, media_files = in_flight.pop(future)
+            try:
+                subject = future.result()
+            except Exception as e:
+                # a partly created subject that couldn't be removed is journaled as created to remove later
+                if getattr(e, 'subject_id', None) is None:
+                    journal.forget([index])
+                else:
+                    journal.record(upload_journal.created, [(index, jpg_file_before, e.subject_id)])
+                yield index, e
+            else:
+                saved[index] = (index, jpg_file_before, subject, media_files)
+                newly_saved.append((index, jpg_file_before, subject.id))
+        journal.record(upload_journal.uploaded, newly_saved)
+
+    def save(index, jpg_file_before, metadata, media_files):
+        def timed_create():
+            # the subject save latency, without the pacing waits, the same as timed_link
+            started_at = time.time()
+            subject = create_subject(project, metadata, media_files)
+            return subject, time.time() - started_at
+        # the subject id isn't known until the save returns, if it never does resume_journal looks it up
+        journal.record(upload_journal.pending, [(index, jpg_file_before, None)])
+        (subject, latency), _ = with_backoff(pacer, 1, timed_create)
+        if timings is not None:
+            timings['save'].append(latency)
+        return subject
+
+    # the panoptes client connection is per thread, so each worker logs in once
+    if connect_kwargs is None:
+        pool = ThreadPoolExecutor(workers)
+    else:
+        pool = ThreadPoolExecutor(workers, initializer=lambda: Panoptes.connect(**connect_kwargs))
+
+    subject_rows = iter(subject_rows)
+    try:
+        while True:
+            while failure is None and not stop_requested() and len(in_flight) < max_in_flight:
+                try:
+                    index, metadata, media_files = next(subject_rows)
+                except StopIteration:
+                    break
+                waiting.append(index)
+                manifest_order[index] = len(manifest_order)
+                jpg_file_before = metadata.get('jpg_file_before')
+                in_flight[pool.submit(save, index, jpg_file_before, metadata, media_files)] = (index, jpg_file_before, media_files)
+
+            if len(in_flight) == 0:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for index, error in list(journal_saves(done)):
+                if failure is None or manifest_order[index] < manifest_order[failure[0]]:
+                    failure = (index, error)
+
+            # move the saved subjects that are next in manifest order to the link batch
+            while len(waiting) > 0 and waiting[0] in saved:
+                to_link.append(saved.pop(waiting.popleft()))
+
+            while len(to_link) >= batch_sizer.size:
+                batch, to_link = to_link[:batch_sizer.size], to_link[batch_sizer.size:]
+                linked_count += link(batch)
+
+        # and the saves after a failed row, they're journaled so the order no longer matters
+        linked_count += link_in_batches(to_link + sorted(saved.values(), key=lambda saved_row: manifest_order[saved_row[0]]))
+
+    except BaseException:
+        # journal the saves that finish after an error so a restart links them
+        pool.shutdown(wait=True)
+        list(journal_saves([future for future in in_flight if future.exception() is None]))
+        raise
+    finally:
+        pool.shutdown(wait=True)
+
+    return linked_count, failure
+
+def media_file_sizes(media_dir):
+    '''
+    Return a dict of the file name to its size in bytes for the files in media_dir,
+    from one directory listing rather than looking up each file path.
+    '''
+    if not os.path.isdir(media_dir):
+        return {}
+    with os.scandir(media_dir) as entries:
+        return dict((entry.name, entry.stat().st_size) for entry in entries if entry.is_file())
+
+def symlink_image(marshal_dir, file_path):
+    symlink_path = "%s/%s" % (marshal_dir, os.path.basename(file_path))
     if not os.path.isfile(symlink_path):
         os.symlink(os.path.abspath(file_path), symlink_path)
     return symlink_path
@@ -50,9 +287,3 @@ def remove_symlinks(linked_media_files):
     for symlink_file in linked_media_files:
         # os.path.isfile(symlink_path)
         os.unlink(symlink_file)
-
-# write the index state to the tracker file path
-def update_state_tracker(upload_state_tracker_path, index, before_file_name):
-    upload_state_tracker_file = open(upload_state_tracker_path, "a")
-    upload_state_tracker_file.write("%s,%s\n" % (index, before_file_name))
-    upload_state_tracker_file.close()